@@ -0,0 +1,133 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Benchmarks helpers.
+
+Benchmarks are plain scripts, to run from the src directory, e.g.::
+
+  python -m benchmarks.bench_stream_clone
+
+They need the hg executable on the PATH.
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+from subprocess import call, Popen
+
+def hg(cwd, *args):
+    """Run the hg executable in cwd, raising RuntimeError on failure."""
+    null = open(os.devnull, 'w')
+    status = call(('hg',) + args, cwd=cwd, stdout=null)
+    null.close()
+    if status:
+        raise RuntimeError("hg %s failed in %s (status %d)" % (
+                ' '.join(args), cwd, status))
+
+def make_repo(path, changesets=50, files=20, file_size=4096):
+    """Create a repository with some history.
+
+    Each changeset rewrites one file with random (hence uncompressible)
+    contents."""
+    os.makedirs(path)
+    hg(path, 'init')
+    for i in range(changesets):
+        fpath = os.path.join(path, 'file%d' % (i % files))
+        f = open(fpath, 'wb')
+        f.write(os.urandom(file_size))
+        f.close()
+        hg(path, 'commit', '-A', '-m', 'changeset %d' % i)
+
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class HgServe(object):
+    """A local hg serve process, serving a repository or a directory."""
+
+    def __init__(self, path, web_conf=None):
+        self.path = path
+        self.web_conf = web_conf
+        self.port = free_port()
+        self.url = 'http://localhost:%d' % self.port
+        self.process = None
+
+    def start(self):
+        cmd = ['hg', 'serve', '-a', 'localhost', '-p', str(self.port)]
+        if self.web_conf is not None:
+            cmd.extend(('--webdir-conf', self.web_conf))
+        null = open(os.devnull, 'w')
+        self.process = Popen(cmd, cwd=self.path, stdout=null, stderr=null)
+        null.close()
+
+        # wait for the server to accept connections
+        for i in range(100):
+            s = socket.socket()
+            try:
+                try:
+                    s.connect(('localhost', self.port))
+                    return
+                except socket.error:
+                    time.sleep(0.1)
+            finally:
+                s.close()
+        raise RuntimeError("hg serve did not start on port %d" % self.port)
+
+    def stop(self):
+        if self.process is not None:
+            os.kill(self.process.pid, 15)
+            self.process.wait()
+            self.process = None
+
+def timed(func, *args, **kw):
+    """Return elapsed wall-clock time and result of the call."""
+    start = time.time()
+    res = func(*args, **kw)
+    return time.time() - start, res
+
+def best_of(repeat, func, *args, **kw):
+    """Return the best elapsed time of repeat calls."""
+    return min(timed(func, *args, **kw)[0] for i in range(repeat))
+
+def tmpdir(prefix='hgbundler-bench-'):
+    return tempfile.mkdtemp(prefix=prefix)
+
+def rss():
+    """Return the resident memory of the process, in bytes (Linux only).
+
+    None if that can't be known."""
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def report(title, rows, out=sys.stdout):
+    """Write a simple table of (label, seconds) rows."""
+    out.write(title + os.linesep)
+    for label, seconds in rows:
+        out.write('  %-40s %8.3fs%s' % (label, seconds, os.linesep))
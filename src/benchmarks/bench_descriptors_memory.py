@@ -0,0 +1,92 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Memory taken by the resolution of a very large bundle.
+
+Reports the resident memory after resolution of the descriptors, and
+after the XML tree of the manifest has been dropped. No clone is made.
+
+Usage: python -m benchmarks.bench_descriptors_memory [components [servers]]
+"""
+
+import os
+import gc
+import sys
+import shutil
+import logging
+
+from benchmarks import tmpdir, rss
+from bundle import Bundle, MANIFEST_FILE
+
+def write_manifest(bundle_dir, components, servers):
+    f = open(os.path.join(bundle_dir, MANIFEST_FILE), 'w')
+    f.write('<?xml version="1.0"?>\n<bundle>\n')
+    per_server = components // servers + 1
+    for i in range(servers):
+        f.write('  <server name="server%d" url="http://hg%d.example.com/'
+                'some/path" push-url="ssh://hg%d.example.com/some/path">\n'
+                % (i, i, i))
+        for j in range(i * per_server, min(components, (i + 1) * per_server)):
+            f.write('    <branch path="products/Component%d" '
+                    'target="Component%d" name="integration" '
+                    'testing="continuous"/>\n' % (j, j))
+        f.write('  </server>\n')
+    f.write('</bundle>\n')
+    f.close()
+
+def mb(nbytes):
+    if nbytes is None:
+        return 'unknown'
+    return '%.1f MB' % (nbytes / 1048576.0)
+
+def main():
+    components = len(sys.argv) > 1 and int(sys.argv[1]) or 5000
+    servers = len(sys.argv) > 2 and int(sys.argv[2]) or 10
+    logging.getLogger('hgbundler').setLevel(logging.WARN)
+
+    base = tmpdir()
+    try:
+        write_manifest(base, components, servers)
+        gc.collect()
+        start = rss()
+        bundle = Bundle(base)
+        descs = bundle.getRepoDescriptors()
+        gc.collect()
+        resolved = rss()
+        bundle.dropTree()
+        gc.collect()
+        dropped = rss()
+    finally:
+        shutil.rmtree(base)
+
+    out = sys.stdout
+    out.write("Resolution of %d components on %d servers%s" % (
+            len(descs), servers, os.linesep))
+    if start is not None:
+        out.write("  %-40s %12s%s" % ("with XML tree", mb(resolved - start),
+                                      os.linesep))
+        out.write("  %-40s %12s%s" % ("after dropping XML tree",
+                                      mb(dropped - start), os.linesep))
+    if hasattr(sys, 'getsizeof'):
+        desc = descs[0]
+        size = sys.getsizeof(desc) + sys.getsizeof(desc.xml_attrs)
+        out.write("  %-40s %10d B%s" % ("descriptor and its attributes",
+                                        size, os.linesep))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""End-to-end timings of hgbundler commands on a synthetic bundle.
+
+The components and included bundles are served by a local hg serve.
+Each command runs in a separate hgbundler process, as for real. Results
+are written as JSON, to compare revisions of hgbundler, e.g.::
+
+  python -m benchmarks.bench_end_to_end -o before.json
+  (change things)
+  python -m benchmarks.bench_end_to_end -o after.json --compare before.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+from optparse import OptionParser
+from subprocess import call
+
+from benchmarks import hg, HgServe, timed, tmpdir, report
+from common import json
+from bundle import MANIFEST_FILE
+from releaser import Releaser
+
+HGBUNDLER = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'hgbundler.py')
+
+CHANGES = """Requires
+~~~~~~~~
+-
+New features
+~~~~~~~~~~~~
+-%s
+Bug fixes
+~~~~~~~~~
+-%s
+New internal features
+~~~~~~~~~~~~~~~~~~~~~
+-
+"""
+
+# as written by a previous release (see Releaser.updateVersionFiles)
+HISTORY = """===========================================================
+Package: %s %s
+===========================================================
+First release built by: bench at: 2010-01-01T00:00:00
+"""
+
+def write(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+def branch_name(k):
+    return k and 'branch%d' % k or 'default'
+
+def make_component(path, name, changesets, branches):
+    """Create a component repo, releasable on all its named branches.
+
+    It looks released before: with a CHANGES file, the release is not an
+    initial one, and needs the HISTORY file too."""
+    os.makedirs(path)
+    hg(path, 'init')
+    write(os.path.join(path, 'VERSION'),
+          Releaser.tpl_version % (name, '1.0.0', '1'))
+    write(os.path.join(path, 'HISTORY'), HISTORY % (name, '1.0.0'))
+    write(os.path.join(path, 'CHANGES'), CHANGES % (' Some feature', ''))
+    for i in range(changesets):
+        write(os.path.join(path, 'file%d' % (i % 10)),
+              os.urandom(1024).encode('hex'))
+        hg(path, 'commit', '-A', '-m', 'changeset %d' % i)
+    for k in range(1, branches):
+        hg(path, 'update', '-C', 'default')
+        hg(path, 'branch', branch_name(k))
+        write(os.path.join(path, 'file_%s' % branch_name(k)), 'branch\n')
+        hg(path, 'commit', '-A', '-m', 'start of %s' % branch_name(k))
+
+def branch_elements(first, last, branches):
+    return ''.join('    <branch path="comp%d" name="%s"/>\n' % (
+            i, branch_name(i % branches)) for i in range(first, last))
+
+def make_bundles(base, url, components, includes, branches):
+    """Create the served repo of included bundles and the main bundle.
+
+    Components are split evenly between the main bundle and the
+    included ones."""
+    per_bundle = components // (includes + 1)
+    bundles_path = os.path.join(base, 'served', 'bundles')
+    os.makedirs(bundles_path)
+    hg(bundles_path, 'init')
+    for j in range(includes):
+        sub = os.path.join(bundles_path, 'Sub%d' % j)
+        os.mkdir(sub)
+        first = (j + 1) * per_bundle
+        last = j == includes - 1 and components or first + per_bundle
+        write(os.path.join(sub, MANIFEST_FILE),
+              '<?xml version="1.0"?>\n<bundle>\n'
+              '  <server name="bench" url="%s">\n%s  </server>\n</bundle>\n'
+              % (url, branch_elements(first, last, branches)))
+    if includes:
+        hg(bundles_path, 'commit', '-A', '-m', 'included bundles')
+
+    bundle_dir = os.path.join(base, 'bundle')
+    os.mkdir(bundle_dir)
+    hg(bundle_dir, 'init')
+    write(os.path.join(bundle_dir, MANIFEST_FILE),
+          '<?xml version="1.0"?>\n<bundle>\n'
+          '  <server name="bench" url="%s">\n%s  </server>\n%s</bundle>\n' % (
+            url, branch_elements(0, includes and per_bundle or components,
+                                 branches),
+            ''.join('  <include-bundles server-url="%s">\n'
+                    '    <branch path="bundles" subpath="Sub%d" '
+                    'target="Sub%d"/>\n'
+                    '  </include-bundles>\n' % (url, j, j)
+                    for j in range(includes))))
+    write(os.path.join(bundle_dir, '.hgignore'), 'syntax: glob\ncomp*\nSub*\n'
+          '.hgbundler\n')
+    hg(bundle_dir, 'commit', '-A', '-m', 'bundle')
+    return bundle_dir
+
+def hgbundler(bundle_dir, *args):
+    null = open(os.devnull, 'w')
+    status = call((sys.executable, HGBUNDLER, '-d', bundle_dir) + args,
+                  stdout=null, stderr=null)
+    null.close()
+    if status:
+        raise RuntimeError("hgbundler %s failed (status %d)" % (
+                ' '.join(args), status))
+
+def add_bug_fixes(bundle_dir, components):
+    """Commit a CHANGES entry in all clones, for a second release."""
+    for i in range(components):
+        path = os.path.join(bundle_dir, 'comp%d' % i)
+        write(os.path.join(path, 'CHANGES'), CHANGES % ('', ' Some fix'))
+        hg(path, 'commit', '-m', 'bug fix')
+
+def run(options):
+    base = tmpdir()
+    served = os.path.join(base, 'served')
+    web_conf = os.path.join(base, 'web.conf')
+    write(web_conf, '[collections]\n%s = %s\n' % (served, served))
+    results = []
+    try:
+        server = HgServe(base, web_conf=web_conf)
+        for i in range(options.components):
+            make_component(os.path.join(served, 'comp%d' % i), 'comp%d' % i,
+                           options.changesets, options.branches)
+        bundle_dir = make_bundles(base, server.url, options.components,
+                                  options.includes, options.branches)
+        archive = os.path.join(base, 'archive')
+
+        server.start()
+        try:
+            steps = (('make-clones', ('make-clones',)),
+                     ('update-clones', ('update-clones',)),
+                     ('clones-out', ('clones-out',)),
+                     ('release-bundle (first)', ('release-bundle', 'B1')),
+                     (None, add_bug_fixes),
+                     ('release-bundle (second)', ('release-bundle', 'B2')),
+                     ('bundle-changelog', ('bundle-changelog', 'B1', 'B2')),
+                     ('archive', ('archive', 'B2', archive)))
+            for label, step in steps:
+                if label is None:
+                    step(bundle_dir, options.components)
+                    continue
+                results.append((label, timed(hgbundler, bundle_dir,
+                                             *step)[0]))
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(base)
+    return results
+
+def main():
+    parser = OptionParser(usage="python -m benchmarks.bench_end_to_end "
+                          "[options]")
+    parser.add_option('-n', '--components', type='int', default=20)
+    parser.add_option('-m', '--changesets', type='int', default=20,
+                      help="Changesets on the default branch of components")
+    parser.add_option('-k', '--branches', type='int', default=2,
+                      help="Named branches in components (including "
+                      "default). Components use them in turn")
+    parser.add_option('-i', '--includes', type='int', default=1,
+                      help="Number of included bundles")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="Write results as JSON in FILE")
+    parser.add_option('--compare', metavar='FILE',
+                      help="Compare with the JSON results in FILE")
+    options, args = parser.parse_args()
+
+    logging.getLogger('hgbundler').setLevel(logging.WARN)
+    os.environ.setdefault('HGUSER', 'hgbundler-bench')
+    params = dict(components=options.components,
+                  changesets=options.changesets,
+                  branches=options.branches, includes=options.includes)
+    results = run(options)
+
+    report("hgbundler commands, %(components)d components, %(changesets)d "
+           "changesets, %(branches)d branches, %(includes)d includes" %
+           params, results)
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(dict(parameters=params, date=time.time(),
+                       results=dict(results)), f, indent=2)
+        f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        previous = json.load(f)
+        f.close()
+        if previous['parameters'] != params:
+            sys.stderr.write("Warning: parameters differ from %s%s" % (
+                    options.compare, os.linesep))
+        sys.stdout.write("Ratios to %s%s" % (options.compare, os.linesep))
+        for label, seconds in results:
+            before = previous['results'].get(label)
+            if before:
+                sys.stdout.write('  %-40s %8.2f%s' % (label, seconds / before,
+                                                      os.linesep))
+
+if __name__ == '__main__':
+    main()
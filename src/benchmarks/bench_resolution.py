@@ -0,0 +1,181 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Microbenchmarks of manifest resolution and include handling.
+
+No repository is involved: the included manifests are written beforehand
+where the clones of the included bundles would be, and the sub bundles
+information is fed to the bundle without making any clone.
+
+Each scenario is timed at two sizes, and an AssertionError is raised if
+some phase does not scale about linearly, which is the typical symptom of
+an accidental quadratic behaviour.
+
+Usage: python -m benchmarks.bench_resolution [components [factor]]
+"""
+
+import os
+import sys
+import shutil
+import logging
+
+from benchmarks import tmpdir, timed, report
+from bundle import Bundle, MANIFEST_FILE
+
+REPEAT = 5
+SUB_BUNDLES = 10
+
+def component(j, indent='    '):
+    return ('%s<branch path="products/Component%d" target="Component%d" '
+            'name="integration"/>\n' % (indent, j, j))
+
+def write_file(path, lines):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    f = open(path, 'w')
+    f.write('<?xml version="1.0"?>\n<bundle>\n')
+    f.writelines(lines)
+    f.write('</bundle>\n')
+    f.close()
+
+def server_lines(name, components):
+    lines = ['  <server name="%s" url="http://hg.example.com/%s">\n' % (
+            name, name)]
+    lines.extend(component(j) for j in components)
+    lines.append('  </server>\n')
+    return lines
+
+def include_lines(components, excluded):
+    """Include components, spread over SUB_BUNDLES bundles.
+
+    Their manifests are to be written by write_sub_bundles()."""
+    lines = ['  <include-bundles server-url="http://hg.example.com/bundles">\n']
+    lines.extend('    <exclude target="Component%d"/>\n' % j
+                 for j in excluded)
+    lines.extend('    <branch path="bundles" subpath="Sub%d" '
+                 'target="Sub%d"/>\n' % (i, i) for i in range(SUB_BUNDLES))
+    lines.append('  </include-bundles>\n')
+    return lines
+
+def write_sub_bundles(bundle_dir, components):
+    components = list(components)
+    for i in range(SUB_BUNDLES):
+        write_file(os.path.join(bundle_dir, 'Sub%d' % i, MANIFEST_FILE),
+                   server_lines('sub%d' % i, components[i::SUB_BUNDLES]))
+
+def flat(bundle_dir, n):
+    """n components at toplevel."""
+    write_file(os.path.join(bundle_dir, MANIFEST_FILE),
+               server_lines('main', range(n)))
+    return n
+
+def includes(bundle_dir, n):
+    """n components through includes, a tenth of them excluded."""
+    write_sub_bundles(bundle_dir, range(n))
+    write_file(os.path.join(bundle_dir, MANIFEST_FILE),
+               include_lines(range(n), range(0, n, 10)))
+    return n - len(range(0, n, 10))
+
+def toplevel_after(bundle_dir, n):
+    """n components included, half of them overridden at toplevel later.
+
+    This is the 'second wins' case of the precedence rules."""
+    write_sub_bundles(bundle_dir, range(n))
+    write_file(os.path.join(bundle_dir, MANIFEST_FILE),
+               include_lines(range(n), ()) +
+               server_lines('main', range(0, n, 2)))
+    return n
+
+def toplevel_before(bundle_dir, n):
+    """n components included, half of them already defined at toplevel.
+
+    This is the 'first wins' case of the precedence rules."""
+    write_sub_bundles(bundle_dir, range(n))
+    write_file(os.path.join(bundle_dir, MANIFEST_FILE),
+               server_lines('main', range(0, n, 2)) +
+               include_lines(range(n), ()))
+    return n
+
+SCENARIOS = (flat, includes, toplevel_after, toplevel_before)
+PHASES = ('parse', 'sub bundles', 'resolution')
+
+def run_once(bundle_dir):
+    """Time the phases on a fresh Bundle instance.
+
+    The resolution phase includes the expansion of includes and the
+    precedence rules."""
+    bundle = Bundle(bundle_dir)
+    parse, root = timed(bundle.getRoot)
+    sub, sub_bundles = timed(bundle.parseSubBundles)
+    bundle.sub_bundles = sub_bundles
+    resolution, descs = timed(bundle.getRepoDescriptors)
+    return (parse, sub, resolution), len(descs)
+
+def measure(scenario, n):
+    """Return the best time of each phase and the number of descriptors."""
+    base = tmpdir()
+    try:
+        expected = scenario(base, n)
+        best = None
+        for i in range(REPEAT):
+            times, count = run_once(base)
+            if count != expected:
+                raise AssertionError("%s: got %d descriptors instead of %d"
+                                     % (scenario.__name__, count, expected))
+            if best is None:
+                best = times
+            else:
+                best = tuple(min(b, t) for b, t in zip(best, times))
+        return best
+    finally:
+        shutil.rmtree(base)
+
+def check_linear(scenario, small, large, factor):
+    """Raise AssertionError if some phase looks quadratic.
+
+    A linear phase takes about factor times longer on the large size,
+    a quadratic one factor ** 2 times. The bound in between leaves room
+    for measurement noise."""
+    bound = factor ** 1.5
+    for phase, s, l in zip(PHASES, small, large):
+        if s <= 0.0:
+            continue
+        if l / s > bound:
+            raise AssertionError(
+                "%s, phase %s: %.1f times slower for %d times more "
+                "components (bound is %.1f)" % (
+                    scenario.__name__, phase, l / s, factor, bound))
+
+def main():
+    n = len(sys.argv) > 1 and int(sys.argv[1]) or 500
+    factor = len(sys.argv) > 2 and int(sys.argv[2]) or 8
+    logging.getLogger('hgbundler').setLevel(logging.WARN)
+
+    for scenario in SCENARIOS:
+        small = measure(scenario, n)
+        large = measure(scenario, n * factor)
+        rows = []
+        for size, times in ((n, small), (n * factor, large)):
+            rows.extend(('%s (%d components)' % (phase, size), t)
+                        for phase, t in zip(PHASES, times))
+        report(scenario.__name__, rows)
+        check_linear(scenario, small, large, factor)
+
+if __name__ == '__main__':
+    main()
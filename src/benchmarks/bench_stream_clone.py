@@ -0,0 +1,63 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Compare ordinary and uncompressed stream clones from a local hg serve.
+
+Usage: python -m benchmarks.bench_stream_clone [changesets [file size]]
+"""
+
+import os
+import sys
+import shutil
+import logging
+
+from benchmarks import make_repo, HgServe, best_of, tmpdir, report
+from repodescriptor import make_clone
+
+REPEAT = 3
+
+def clone(url, dest, stream):
+    make_clone(url, dest, noupdate=True, stream=stream)
+    shutil.rmtree(dest)
+
+def main():
+    changesets = len(sys.argv) > 1 and int(sys.argv[1]) or 200
+    file_size = len(sys.argv) > 2 and int(sys.argv[2]) or 65536
+    logging.getLogger('hgbundler').setLevel(logging.WARN)
+
+    base = tmpdir()
+    try:
+        repo_path = os.path.join(base, 'served')
+        make_repo(repo_path, changesets=changesets, file_size=file_size)
+        server = HgServe(repo_path)
+        server.start()
+        try:
+            dest = os.path.join(base, 'clones', 'clone')
+            rows = [(label, best_of(REPEAT, clone, server.url, dest, stream))
+                    for label, stream in (('ordinary clone', False),
+                                          ('stream clone', True))]
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(base)
+
+    report("Clone of %d changesets of %d bytes (best of %d)" % (
+            changesets, file_size, REPEAT), rows)
+
+if __name__ == '__main__':
+    main()
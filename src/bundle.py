@@ -21,17 +21,25 @@
 import os
 import sys
 import logging
-from subprocess import Popen, PIPE
+import itertools
+import threading
+import urlparse
 
 from mercurial import hg
 from mercurial.node import short as hg_hex
+from mercurial.node import hex as hg_fullhex
+from mercurial.node import bin as hg_bin
 from mercurial import commands as hg_commands
 
 from bundleman.utils import rst_title
 
 from common import etree
+from common import sha1
+from common import json
 from common import _findrepo, _currentNodeRev
 from common import NodeNotFoundError, RepoNotFoundError
+from common import PushError
+from common import pool_map
 
 from releaser import RepoReleaseError
 from server import known_servers
@@ -39,17 +47,36 @@ from repodescriptor import Branch, Tag
 from repodescriptor import HG_UI
 from repodescriptor import SEVERAL_PARENTS
 from constants import (ASIDE_REPOS,
+                       USER_CACHE_DIR,
+                       DEFAULT_JOBS,
+                       DEFAULT_SERVER_JOBS,
                       )
+from exportcache import ExportCache
+from diskcache import DiskCache
+import repopool
+from statusengine import StatusEngine
+from watcher import Watcher
+from releasejournal import ReleaseJournal
+from lockmanager import LockManager
+from xmlwriter import write_pretty
 from common import HG_VERSION, HG_VERSION_STR
 
 MANIFEST_FILE = "BUNDLE_MANIFEST.xml"
+LOCK_FILE = "BUNDLE_MANIFEST.lock"
 INCLUDES = '.hgbundler_incl'
+CHANGELOG_CACHE = 'changelog-marshal' # former JSON entries are in 'changelog'
 BUNDLE_RELEASE_BRANCH_PREFIX='hgbundler-release-'
 
 logger = logging.getLogger('hgbundler.bundle')
 
 _default = object()
 
+def server_key(url):
+    """Identify the server of url, for limits of simultaneous connections.
+    """
+    split = urlparse.urlsplit(url)
+    return split[0], split[1]
+
 class Server(object):
 
     @classmethod
@@ -82,6 +109,7 @@ class Server(object):
             raise ValueError('Missing url in serveur with name=%s' % self.name)
 
         self.push_url = self._normTrailingSlash(attrib.get('push-url'))
+        self.stream = attrib.get('stream', '').strip().lower() == 'true'
 
     def getRepoUrl(self, path, push=False):
         if not path.startswith('/'):
@@ -97,6 +125,14 @@ class Bundle(object):
 
     element2class = {'tag': Tag, 'branch': Branch}
 
+    # command methods that need the exclusive lock of the bundle, e.g.,
+    # because they write the manifest or update the bundle working dir
+    # (archive does it too, but upgrades its shared lock just for that)
+    exclusive_commands = ('release', 'lock_manifest',
+                          'changelog', 'changelog_range')
+    # command methods that don't lock the bundle at all
+    unlocked_commands = ('watch',)
+
     def __init__(self, bundle_dir):
         self.bundle_dir = bundle_dir
         if MANIFEST_FILE not in os.listdir(bundle_dir):
@@ -109,10 +145,56 @@ class Bundle(object):
         self.sub_bundles = None
         self.descriptors = None
         self.initial_node = None
+        self.locked_nodes = None
+        self.locks = LockManager(bundle_dir)
+        self.command_lock = None # see commandLock()
+        self.tree_dropped = False
 
     def getManifestPath(self):
         return os.path.join(self.bundle_dir, MANIFEST_FILE)
 
+    def getLockPath(self):
+        return os.path.join(self.bundle_dir, LOCK_FILE)
+
+    def manifestHash(self):
+        f = open(self.getManifestPath())
+        h = sha1(f.read()).hexdigest()
+        f.close()
+        return h
+
+    def readLockFile(self):
+        """Read the lock file, so that resolution uses the locked nodes.
+
+        Must be called before any descriptor is built.
+        """
+        path = self.getLockPath()
+        if not os.path.isfile(path):
+            raise RuntimeError("No lock file in %s" % self.bundle_dir)
+
+        root = etree.parse(path).getroot()
+        if root.attrib.get('manifest-sha1') != self.manifestHash():
+            logger.warn("The manifest file has changed since the lock file "
+                        "has been written. Unlocked components will be "
+                        "resolved as usual.")
+
+        locked = {}
+        for elt in root:
+            if elt.tag != 'clone':
+                continue
+            attrib = elt.attrib
+            included = attrib.get('included', '').lower() == 'true'
+            locked[attrib['target'], included] = hg_bin(attrib['node'])
+        self.locked_nodes = locked
+
+    def lockedNode(self, desc, included=False):
+        """Return the locked node for desc, or None if not locked."""
+        if self.locked_nodes is None:
+            return None
+        node = self.locked_nodes.get((desc.target, included))
+        if node is None:
+            logger.warn("Target %s not found in lock file", desc.target)
+        return node
+
     def initBundleRepo(self):
         """Store repo and initial node info for the bundle itself if needed.
         Raise an error if repo or initial node can't be found.
@@ -150,11 +232,26 @@ class Bundle(object):
         root = self.root
         if self.root is not None:
             return self.root
+        if self.tree_dropped:
+            raise RuntimeError("XML tree of %s has been dropped" %
+                               self.bundle_dir)
 
         self.tree = etree.parse(self.getManifestPath())
         root = self.root = self.tree.getroot()
         return root
 
+    def dropTree(self):
+        """Resolve the descriptors, then release the XML tree to save memory.
+
+        Operations that need the tree (e.g., release) are then impossible
+        with this Bundle instance.
+        """
+        self.getRepoDescriptors()
+        for s in self.sub_bundles or ():
+            s['element'] = None
+        self.tree = self.root = None
+        self.tree_dropped = True
+
     @classmethod
     def repoClass(self, elt):
         """Return the class for repo XML elt, or None if not a repo but valid.
@@ -221,16 +318,28 @@ class Bundle(object):
 
         repo = klass(server.getRepoUrl(path), self.bundle_dir,
                      target, name, attrib, from_include=server.from_include,
-                     remote_url_push=server.getRepoUrl(path, push=True))
+                     remote_url_push=server.getRepoUrl(path, push=True),
+                     stream=server.stream)
         return repo
 
     def getSubBundles(self):
-        """Extract and return subbundles information."""
+        """Extract and return subbundles information, making their clones."""
 
         sub_bundles = self.sub_bundles
         if sub_bundles is not None:
             return sub_bundles
 
+        sub_bundles = self.parseSubBundles()
+        for s in sub_bundles:
+            for repo in s['descriptors']:
+                repo.make_clone()
+                repo.update(node=self.lockedNode(repo, included=True))
+
+        self.sub_bundles = sub_bundles
+        return sub_bundles
+
+    def parseSubBundles(self):
+        """Extract subbundles information from the XML tree only."""
         sub_bundles = []
         for pos, elt in enumerate(self.getRoot()):
             if elt.tag != 'include-bundles':
@@ -256,17 +365,12 @@ class Bundle(object):
                 repo = self.makeRepo(server, r)
                 if repo is None: # happens, e.g, with XML comments
                     continue
-                repo.make_clone()
-                repo.update()
-
                 descs.append(repo)
 
             sub_bundles.append(dict(server=server, position=pos,
                                     excluded=excluded,
                                     element=elt,
                                     descriptors=tuple(descs)))
-
-        self.sub_bundles = sub_bundles
         return sub_bundles
 
     def includeBundles(self, server=None, position=None, excluded=None,
@@ -311,7 +415,8 @@ class Bundle(object):
             return self.descriptors
 
         repos = {} # target -> repo
-        targets = [] # *ordered* list of repo names
+        order = {} # target -> rank, ordering the final result
+        rank = itertools.count()
 
         for s in self.getSubBundles():
             self.includeBundles(**s)
@@ -329,7 +434,7 @@ class Bundle(object):
                 target = repo.target
                 existing = repos.get(target)
                 if existing is None:
-                    targets.append(target)
+                    order[target] = rank.next()
                     repos[target] = repo
                 else:
                     if repo.from_include:
@@ -341,55 +446,316 @@ class Bundle(object):
                         logger.info(("Got target %s first through "
                                      "include-bundles and then at toplevel. "
                                      "Second wins"), target)
-                        targets.remove(target)
-                        targets.append(target)
+                        # moving to the end without list.remove(), which
+                        # is quadratic with many overrides
+                        order[target] = rank.next()
                         repos[target] = repo
                     else:
                         raise ValueError("Target name conflict: %s" % target)
 
+        targets = sorted(order, key=order.get)
         descriptors = tuple(repos[target] for target in targets)
+        repopool.pool.reserve(self.bundle_dir, len(descriptors) + sum(
+                len(s['descriptors']) for s in self.getSubBundles()))
         if store:
             self.descriptors = descriptors
         return descriptors
 
-    def pull_clones(self, from_bundle=None, targets=(), update=False):
-        """Perform a pull for targets from the given (local) bundle."""
+    def sharedPairs(self, other, targets=None):
+        """Return (descriptor, other bundle's descriptor) pairs.
 
-        logger.info("Pulling %s from %s", targets, from_bundle.bundle_dir)
-        for target in targets:
+        These are for the given targets (defaults to all) present in both
+        bundles with a local repository.
+        """
+        pairs = []
+        for desc in self.getRepoDescriptors():
+            if targets is not None and desc.target not in targets:
+                continue
             try:
-                our_desc = self.getRepoDescriptorByTarget(target)
+                other_desc = other.getRepoDescriptorByTarget(desc.target)
             except KeyError:
-                logger.debug("Target %s not present in %s", target,
-                             self.bundle_dir)
+                logger.debug("Target %s not present in %s", desc.target,
+                             other.bundle_dir)
                 continue
-            our_repo = our_desc.getRepo()
+            if not [d for d in (desc, other_desc) if not
+                    os.path.isdir(os.path.join(d.local_path, '.hg'))]:
+                pairs.append((desc, other_desc))
+        return pairs
+
+    def syncClones(self, pairs, update=False, options=None):
+        """Pull in each (descriptor, source descriptor) pair, on a worker pool.
 
-            from_path = from_bundle.getRepoDescriptorByTarget(target).local_path
-            logger.debug("Pulling %s from %s", our_desc.local_path_rel,
-                         from_path)
-            hg_commands.pull(HG_UI, our_repo, source=from_path)
+        Pairs whose clones have the same heads are already in sync, and
+        therefore not pulled.
+        Return the list of (local path, exception) failures.
+        """
+        def sync(x):
+            desc, source = x
+            heads = set(desc.getRepo().heads())
+            if heads != set(source.getRepo().heads()):
+                self.lockedCall(desc, desc.pullFrom, source.local_path,
+                                update=update)
+                return
+            logger.debug("%s already in sync with %s",
+                         desc.local_path_rel, source.local_path)
             if update:
-                logger.debug("Updating %s", our_desc.local_path_rel)
-                our_desc.update()
+                self.lockedCall(desc, desc.update)
+
+        jobs = getattr(options, 'jobs', None) or DEFAULT_JOBS
+        return [(x[0].local_path, exc_info[1])
+                for x, (_, exc_info) in zip(pairs, pool_map(sync, pairs,
+                                                            jobs=jobs))
+                if exc_info is not None]
+
+    def pull_clones(self, from_bundle=None, targets=(), update=False,
+                    options=None):
+        """Perform a pull for targets from the given (local) bundle.
+
+        targets=None stands for all shared targets.
+        Return the list of (local path, exception) failures."""
+
+        logger.info("Pulling %s from %s", targets, from_bundle.bundle_dir)
+        return self.syncClones(self.sharedPairs(from_bundle, targets=targets),
+                               update=update, options=options)
 
-    def push_clones(self, from_bundle=None, targets=(), update=False):
-        """Perform a push for targets to the given (local_ bundle."""
+    def push_clones(self, to_bundle=None, targets=(), update=False,
+                    options=None):
+        """Perform a push for targets to the given (local) bundle.
 
-        raise NotImplementedError
+        Between local clones, this is a pull from the destination side.
+        Return the list of (local path, exception) failures."""
+
+        logger.info("Pushing %s to %s", targets, to_bundle.bundle_dir)
+        return to_bundle.syncClones(
+            [(d, o) for o, d in self.sharedPairs(to_bundle, targets=targets)],
+            update=update, options=options)
+
+    def clones_sync_from(self, other_dir, options=None):
+        """Pull all targets shared with the other bundle."""
+        other = Bundle(other_dir)
+        lock = other.locks.bundleLock()
+        try:
+            return self.reportFailures(
+                self.syncClones(self.sharedPairs(other), options=options),
+                'pull')
+        finally:
+            lock.release()
+
+    def clones_sync_to(self, other_dir, options=None):
+        """Push all targets shared with the other bundle."""
+        other = Bundle(other_dir)
+        lock = other.locks.bundleLock()
+        try:
+            return self.reportFailures(
+                self.push_clones(to_bundle=other, targets=None,
+                                 options=options))
+        finally:
+            lock.release()
+
+    def pushDescriptors(self, descriptors, options=None):
+        """Push the given branch descriptors, on a worker pool.
+
+        There are at most options.server_jobs pushes to a same server at
+        a given time.
+        Return the list of (local path, exception) failures.
+        """
+        jobs = getattr(options, 'jobs', None) or DEFAULT_JOBS
+        server_jobs = (getattr(options, 'server_jobs', None)
+                       or DEFAULT_SERVER_JOBS)
+
+        by_server = {}
+        for desc in descriptors:
+            by_server.setdefault(server_key(desc.pushUrl()), []).append(desc)
+        semaphores = dict((key, threading.BoundedSemaphore(server_jobs))
+                          for key in by_server)
+
+        # interleave servers, so that workers don't all wait for the same
+        queues = by_server.values()
+        ordered = []
+        for i in xrange(max([len(q) for q in queues] or [0])):
+            ordered.extend(q[i] for q in queues if i < len(q))
+
+        def push(desc):
+            semaphore = semaphores[server_key(desc.pushUrl())]
+            semaphore.acquire()
+            try:
+                desc.push()
+            finally:
+                semaphore.release()
+
+        return [(desc.local_path_rel, exc_info[1])
+                for desc, (_, exc_info) in zip(ordered, pool_map(
+                    push, ordered, jobs=jobs))
+                if exc_info is not None]
+
+    def autoPush(self, targets, options=None, bundle_repo=True):
+        """Push the clones of released targets, then the bundle repository.
+
+        Return the list of (local path, exception) failures.
+        """
+        descriptors = [self.getRepoDescriptorByTarget(target)
+                       for target in targets]
+        failures = self.pushDescriptors(descriptors, options=options)
+        if bundle_repo:
+            self.initBundleRepo()
+            repo = self.bundle_repo
+            logger.info("Pushing bundle repository %s", repo.root)
+            try:
+                # the release branch is new by construction
+                status = hg_commands.push(repo.ui, repo, new_branch=True)
+                if status:
+                    raise PushError("Push failed (status %r)" % status)
+            except Exception, e:
+                failures.append((repo.root, e))
+        return failures
+
+    def reportFailures(self, failures, what='push'):
+        """Log a summary of failures (of pushes by default), return status.
+        """
+        if not failures:
+            return 0
+        logger.error("%d %s operation(s) failed:", len(failures), what)
+        for path, exc in failures:
+            logger.error("  %s: %s", path, exc)
+        return 1
 
     #
     # Command-line operations
     #
 
+    def commandLock(self, meth):
+        """Acquire the bundle lock needed by the given command method.
+
+        Return the lock, or None."""
+        if meth in self.unlocked_commands:
+            return
+        self.command_lock = self.locks.bundleLock(
+            exclusive=meth in self.exclusive_commands)
+        return self.command_lock
+
+    def lockedCall(self, desc, func, *args, **kw):
+        """Call func, holding the exclusive lock of the clone of desc."""
+        lock = self.locks.cloneLock(desc.local_path, exclusive=True)
+        try:
+            return func(*args, **kw)
+        finally:
+            lock.release()
+
+    def cloneMap(self, func, descs, jobs=DEFAULT_JOBS):
+        """Apply func to all descs on the worker pool, clone by clone.
+
+        Descriptors sharing a clone (such as subpath targets in the same
+        aside repository) are treated in order by the same worker, holding
+        the exclusive lock of the clone.
+        Return the list of (result, exc_info) pairs, as pool_map() does.
+        """
+        groups = {} # local path -> list of (index, desc)
+        paths = [] # in order of first appearance
+        for i, desc in enumerate(descs):
+            if desc.local_path not in groups:
+                groups[desc.local_path] = []
+                paths.append(desc.local_path)
+            groups[desc.local_path].append((i, desc))
+
+        def work(path):
+            results = []
+            for i, desc in groups[path]:
+                try:
+                    results.append((i, (self.lockedCall(desc, func, desc),
+                                        None)))
+                except:
+                    results.append((i, (None, sys.exc_info())))
+            return results
+
+        results = [None] * len(descs)
+        for group, exc_info in pool_map(work, paths, jobs=jobs):
+            for i, result in group:
+                results[i] = result
+        return results
+
+    def getExportCache(self, options=None):
+        cache_dir = getattr(options, 'export_cache', None)
+        if cache_dir is None:
+            cache_dir = USER_CACHE_DIR
+        return ExportCache(cache_dir)
+
     def make_clones(self, options=None):
+        """Make the missing clones and update them.
+
+        Recognized options (as attributes of the options object):
+          - export_tags: materialize tags as plain file trees, taken from
+                         the export cache
+          - export_cache: path to the export cache directory
+          - minimal: restrict new clones to the history of the named branch
+                     or of the tag
+          - locked: use the nodes recorded in the lock file
+        """
+        export_tags = getattr(options, 'export_tags', False)
+        minimal = getattr(options, 'minimal', False)
+        if export_tags:
+            cache = self.getExportCache(options)
+        if getattr(options, 'locked', False):
+            self.readLockFile()
+
         for desc in self.getRepoDescriptors():
-            if desc.make_clone():
-                desc.update()
+            node = self.lockedNode(desc)
+            if export_tags and isinstance(desc, Tag):
+                self.lockedCall(desc, desc.export, cache, node=node)
+            elif self.lockedCall(desc, desc.make_clone, minimal=minimal,
+                                 node=node):
+                self.lockedCall(desc, desc.update, node=node)
 
     def update_clones(self, options=None):
+        """Update the clones, and the exports of tags (see make_clones)."""
+        if getattr(options, 'locked', False):
+            self.readLockFile()
+
+        cache = None
         for desc in self.getRepoDescriptors():
-            desc.update()
+            node = self.lockedNode(desc)
+            if isinstance(desc, Tag) and desc.isExported():
+                if cache is None:
+                    cache = self.getExportCache(options)
+                self.lockedCall(desc, desc.export, cache, node=node)
+            else:
+                self.lockedCall(desc, desc.update, node=node)
+
+    def lock_manifest(self, options=None):
+        """Write the lock file, recording the current node of all resolved
+        descriptors.
+        """
+        root = etree.Element('bundle-lock')
+        root.attrib['manifest-sha1'] = self.manifestHash()
+        root.text = '\n  '
+
+        def add(desc, included):
+            elt = etree.SubElement(root, 'clone')
+            if isinstance(desc, Tag) and desc.isExported():
+                node = desc.exportedNode()
+            else:
+                node = hg_fullhex(desc.tip())
+            elt.attrib['target'] = desc.target
+            elt.attrib['node'] = node
+            if included:
+                elt.attrib['included'] = 'true'
+            elt.tail = '\n  '
+            logger.debug("Locking %s at %s", desc.target, node)
+
+        for s in self.getSubBundles():
+            for desc in s['descriptors']:
+                add(desc, True)
+        for desc in self.getRepoDescriptors():
+            add(desc, False)
+        if len(root):
+            root[-1].tail = '\n'
+
+        f = open(self.getLockPath(), 'w')
+        f.write('<?xml version="1.0"?>\n')
+        etree.ElementTree(root).write(f)
+        f.write('\n')
+        f.close()
+        logger.info("Wrote lock file for %d components", len(root))
+        return 0
 
     def clones_refresh_url(self, options=None):
         for s in self.getSubBundles():
@@ -397,7 +763,9 @@ class Bundle(object):
                 desc.updateUrls()
 
         for desc in self.getRepoDescriptors():
-            desc.updateUrls()
+            if isinstance(desc, Tag) and desc.isExported():
+                continue
+            self.lockedCall(desc, desc.updateUrls)
 
     def clones_list(self, options=None, outfile=sys.stdout):
         """List all the clones, according to options.
@@ -407,6 +775,8 @@ class Bundle(object):
           - branches_only: only tags will be listed
           - attributes_filter: a dict
                      (name of XML attribute -> expected values)
+          - dirty_only: only clones with uncommited changes (asked to the
+                        watcher if running)
         """
 
         tags_only = getattr(options, 'tags_only', False)
@@ -439,9 +809,82 @@ class Bundle(object):
         for desc in self.getRepoDescriptors():
             add_path(desc)
 
+        if getattr(options, 'dirty_only', False):
+            engine = StatusEngine(jobs=getattr(options, 'jobs', None)
+                                  or DEFAULT_JOBS)
+            states = engine.localStates(self.allDescriptors(),
+                                        bundle_dir=self.bundle_dir,
+                                        locks=self.locks)
+            paths = [p for p in paths if states.get(p, {}).get('dirty')]
+
         for path in paths:
             outfile.write(path + os.linesep)
 
+    def clones_status(self, options=None, outfile=sys.stdout):
+        """Output the status of all descriptors, including included ones.
+
+        Statuses are computed on a worker pool (see StatusEngine). Network
+        checks (outgoing and incoming) are skipped if options.local_only is
+        set. The output is JSON if options.json is set, a table otherwise.
+        Return 1 if some status could not be computed.
+        """
+        local_only = getattr(options, 'local_only', False)
+        engine = StatusEngine(jobs=getattr(options, 'jobs', None)
+                              or DEFAULT_JOBS)
+        statuses = engine.cloneStatuses(self.allDescriptors(),
+                                        bundle_dir=self.bundle_dir,
+                                        locks=self.locks,
+                                        local_only=local_only)
+
+        if getattr(options, 'json', False):
+            json.dump(statuses, outfile, indent=2)
+            outfile.write(os.linesep)
+        else:
+            def yes_no(value):
+                if value is None:
+                    return '-'
+                return value and 'yes' or 'no'
+
+            header = ['TARGET', 'BRANCH', 'NODE', 'AT TIP', 'DIRTY']
+            if not local_only:
+                header.extend(('OUT', 'IN'))
+            rows = [header]
+            for st in statuses:
+                if 'error' in st:
+                    rows.append([st['target'], 'ERROR: ' + st['error']])
+                    continue
+                node = st['node'][:12]
+                if st.get('merge'):
+                    node += '+'
+                row = [st['target'], st.get('branch', '-'), node,
+                       yes_no(st.get('at_tip')), yes_no(st.get('dirty'))]
+                if not local_only:
+                    row.extend(str(st.get(k, '-'))
+                               for k in ('outgoing', 'incoming'))
+                rows.append(row)
+
+            widths = [max([len(row[i]) for row in rows if len(row) > i])
+                      for i in range(len(header))]
+            for row in rows:
+                outfile.write('  '.join(cell.ljust(width) for cell, width
+                                        in zip(row, widths)).rstrip()
+                              + os.linesep)
+
+        return [st for st in statuses if 'error' in st] and 1 or 0
+
+    def allDescriptors(self):
+        """Descriptors of included bundles, then the resolved ones."""
+        descs = [desc for s in self.getSubBundles()
+                 for desc in s['descriptors']]
+        descs.extend(self.getRepoDescriptors())
+        return descs
+
+    def watch(self, options=None):
+        """Run the watcher daemon (see the watcher module)."""
+        descriptors = self.allDescriptors()
+        self.dropTree() # long running
+        return Watcher(descriptors).serve(self.bundle_dir)
+
     def clones_out(self, options=None):
         for s in self.getSubBundles():
             for desc in s['descriptors']:
@@ -453,6 +896,38 @@ class Bundle(object):
             if o:
                 logger.warn("%d changeset subtree(s) not in %s", o, dest)
 
+    def fingerprint(self, options=None, outfile=sys.stdout):
+        """Output a hash of the resolved descriptors, using remote lookups.
+
+        The hash covers target, remote url, subpath and remote node of all
+        descriptors, including those of included bundles (the latter are
+        still cloned to read their manifests).
+        """
+        jobs = getattr(options, 'jobs', None) or DEFAULT_JOBS
+        descs = [(True, desc) for s in self.getSubBundles()
+                 for desc in s['descriptors']]
+        descs.extend((False, desc) for desc in self.getRepoDescriptors())
+
+        results = pool_map(lambda d: d[1].remoteNode(), descs, jobs=jobs)
+        lines = []
+        failed = False
+        for (included, desc), (node, exc_info) in zip(descs, results):
+            if exc_info is not None:
+                logger.error("Could not resolve %s on %s: %s", desc.target,
+                             desc.remote_url, exc_info[1])
+                failed = True
+                continue
+            lines.append(' '.join((included and 'included' or 'toplevel',
+                                   desc.target, desc.remote_url,
+                                   desc.xml_attrs.get('subpath', ''),
+                                   hg_fullhex(node))))
+            logger.debug("Fingerprint line: %s", lines[-1])
+        if failed:
+            return 1
+
+        outfile.write(sha1('\n'.join(lines)).hexdigest() + os.linesep)
+        return 0
+
     def getRepoDescriptorByTarget(self, target, default=_default):
         found = [desc for desc in self.getRepoDescriptors()
                  if desc.target == target]
@@ -472,47 +947,34 @@ class Bundle(object):
             return 1
 
         try:
-            desc.release(multiple_heads=options.multiple_heads,
-                         release_again=options.release_again,
-                         increment_major=options.increment_major)
-            msg = "Release of %s (branch '%s') done. "
-            if not getattr(options, 'auto_push', False):
-                msg += "You may want to push "
-                "(default is %s)" % desc.remote_url_push
-            logger.warn(msg, desc.local_path_rel, desc.getName())
-            return 0
+            self.lockedCall(desc, desc.release,
+                            multiple_heads=options.multiple_heads,
+                            release_again=options.release_again,
+                            increment_major=options.increment_major)
         except RepoReleaseError:
             logger.error("Could not release '%s'" % target)
             return 1
 
+        msg = "Release of %s (branch '%s') done. "
+        if getattr(options, 'auto_push', False):
+            logger.warn(msg, desc.local_path_rel, desc.getName())
+            return self.reportFailures(
+                self.pushDescriptors((desc,), options=options))
+        msg += "You may want to push (default is %s)" % desc.pushUrl()
+        logger.warn(msg, desc.local_path_rel, desc.getName())
+        return 0
 
-    def writeManifest(self):
-        """Dumps the XML tree in the manifest file."""
-
-        # We go through tidy since pretty_print not present in all lxml
-        # versions)
-
-        tidy = Popen('tidy -xml -asxml -wrap 79 --indent yes '
-                     '--indent-attributes yes --indent-spaces 2',
-                     shell=True,   # for PATH lookup
-                     stdout=PIPE, stdin=PIPE, stderr=PIPE,)
-
-        tidy.stdin.write('<?xml version="1.0"?>')
-        self.tree.write(tidy.stdin)
-        tidy.stdin.close()
-        status = tidy.wait()
-        if status:
-            logger.critical(
-                "Error in tidy (exit status %d). stderr: %s", status,
-                tidy.stderr.read())
-            sys.exit(status)
-
-        formatted = tidy.stdout.read()
-        tidy.stdout.close()
 
-        f = open(self.getManifestPath(), 'w')
-        f.write(formatted)
-        f.close()
+    def writeManifest(self):
+        """Dumps the XML tree in the manifest file, pretty printed."""
+        path = self.getManifestPath()
+        tmp = '%s.tmp-%d' % (path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            write_pretty(self.tree, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
 
     def release_repo_check(self, release_name, options=None):
         """Does the mercurial checkings for release of the whole bundle.
@@ -538,6 +1000,191 @@ class Bundle(object):
 
         return branch_name
 
+    def releasePreflight(self, descriptors, options=None):
+        """Check all descriptors before release, and log all problems.
+
+        Return the list of (descriptor, problem) pairs."""
+        engine = StatusEngine(jobs=getattr(options, 'jobs', None)
+                              or DEFAULT_JOBS)
+        problems = engine.releaseProblems(
+            descriptors,
+            multiple_heads=getattr(options, 'multiple_heads', False))
+        for desc, problem in problems:
+            logger.error("Can't release %s: %s", desc.target, problem)
+        if problems:
+            logger.critical("%d problem(s) found. Aborting release.",
+                            len(problems))
+        return problems
+
+    def release_plan(self, release_name, options=None, outfile=sys.stdout):
+        """Tell what release-bundle would do, without any write.
+
+        New versions and problems of all branches are computed in parallel.
+        The output is JSON if options.json is set, human readable otherwise.
+        Return 1 if there are blocking problems, 0 otherwise.
+        """
+        problems = []
+        if self.release_repo_check(release_name, options=options) is None:
+            problems.append(dict(target=None, problem="bundle repository "
+                                 "not ready for release %s" % release_name))
+
+        engine = StatusEngine(jobs=getattr(options, 'jobs', None)
+                              or DEFAULT_JOBS)
+        plans, desc_problems = engine.releasePlans(
+            [desc for desc in self.getRepoDescriptors()
+             if isinstance(desc, Branch)],
+            multiple_heads=getattr(options, 'multiple_heads', False),
+            increment_major=getattr(options, 'increment_major', False),
+            read_only=True)
+        problems.extend(dict(target=desc.target, problem=problem)
+                        for desc, problem in desc_problems)
+
+        if getattr(options, 'json', False):
+            json.dump(dict(release=release_name, plans=plans,
+                           problems=problems), outfile, indent=2)
+            outfile.write(os.linesep)
+        else:
+            for plan in plans:
+                if plan['action'] == 'release':
+                    line = '%(target)s: %(current)s -> %(tag)s (%(bump)s)'
+                elif plan['action'] == 'tag':
+                    line = '%(target)s: tag %(tag)s'
+                elif plan['action'] == 'existing':
+                    line = '%(target)s: already released as %(tag)s'
+                else:
+                    line = '%(target)s: nothing to do'
+                outfile.write(line % plan + os.linesep)
+            for problem in problems:
+                outfile.write('PROBLEM %s: %s%s' % (
+                        problem['target'] or 'bundle', problem['problem'],
+                        os.linesep))
+
+        return problems and 1 or 0
+
+    def releaseJournal(self, release_name, options=None, descriptors=None):
+        """Start or resume the release journal.
+
+        Return the journal and the dict (target -> Tag descriptor) of
+        components it records as released, or None if release can't go on.
+        The recorded components are looked for among the given
+        descriptors, defaulting to those of the bundle.
+        """
+        journal = ReleaseJournal(self.bundle_dir)
+        resume = getattr(options, 'resume', False)
+        if journal.exists():
+            try:
+                journal.load()
+            except ValueError, e:
+                logger.critical("%s. Remove it to start over.", e)
+                return
+        if journal.data is None or not journal.released():
+            if resume:
+                logger.warn("No interrupted release to resume.")
+            journal.start(release_name)
+            return journal, {}
+
+        if not resume:
+            logger.critical("Found the journal of an interrupted release. "
+                            "Use --resume, or remove %s to start over.",
+                            journal.path)
+            return
+        previous = journal.data['release']
+        if previous != release_name:
+            logger.critical("Can't resume: the interrupted release is %r",
+                            previous)
+            return
+
+        if descriptors is None:
+            descriptors = self.getRepoDescriptors()
+        released = {}
+        for desc in descriptors:
+            entry = journal.released().get(desc.target)
+            if entry is None or not isinstance(desc, Branch):
+                continue
+            repo = desc.getRepo()
+            nodemap = repo.changelog.nodemap
+            if (entry['tag'] not in repo.tags()
+                or [n for n in entry['nodes'] if hg_bin(n) not in nodemap]):
+                logger.critical("Release %s of %s recorded in journal not "
+                                "found in %s.", entry['tag'], desc.target,
+                                desc.local_path_rel)
+                return
+            logger.info("Resuming: %s already released as %s", desc.target,
+                        entry['tag'])
+            released[desc.target] = Tag(desc.remote_url, desc.bundle_dir,
+                                        desc.target, entry['tag'],
+                                        desc.xml_attrs)
+        return journal, released
+
+    def releaseDescriptors(self, descriptors, options=None, journal=None):
+        """Release the branch descriptors in two phases, on a worker pool.
+
+        First, all new versions are computed, without any write. Then, if
+        no problem occurred, the commits and tags are made, and recorded
+        in the journal, if any. If any of them fails, all of them are
+        rolled back.
+        Return a dict (target -> new Tag descriptor), or None on failure.
+        """
+        jobs = getattr(options, 'jobs', None) or DEFAULT_JOBS
+        branches = [desc for desc in descriptors if isinstance(desc, Branch)]
+
+        def prepare(desc):
+            return desc.prepareRelease(
+                multiple_heads=getattr(options, 'multiple_heads', False),
+                increment_major=getattr(options, 'increment_major', False),
+                check=False)
+
+        failed = False
+        to_commit = []
+        prepared = {} # target -> result of prepareRelease()
+        results = self.cloneMap(prepare, branches, jobs=jobs)
+        for desc, (result, exc_info) in zip(branches, results):
+            if exc_info is not None:
+                if not issubclass(exc_info[0], RepoReleaseError):
+                    logger.error("Unexpected error while preparing release "
+                                 "of %s: %s", desc.target, exc_info[1])
+                failed = True
+            elif result is not None:
+                to_commit.append(desc)
+                prepared[desc.target] = result
+        if failed:
+            logger.critical("Release preparation failed. Nothing written.")
+            return None
+
+        def commit(desc):
+            tag = desc.commitRelease(prepared[desc.target])
+            if journal is not None:
+                journal.record(desc.target, tag.name,
+                               [hg_fullhex(n) for n in desc.releaseNodes()])
+            return tag
+
+        results = self.cloneMap(commit, to_commit, jobs=jobs)
+        new_tags = {}
+        for desc, (tag, exc_info) in zip(to_commit, results):
+            if exc_info is not None:
+                logger.error("Release of %s failed: %s", desc.target,
+                             exc_info[1])
+                failed = True
+            else:
+                new_tags[desc.target] = tag
+        if failed:
+            logger.critical("Rolling back the release of all components")
+            def rollback(desc):
+                desc.rollbackRelease()
+                if journal is not None:
+                    journal.forget(desc.target)
+
+            # latest commits first in shared clones
+            to_commit.reverse()
+            for desc, (_, exc_info) in zip(to_commit, self.cloneMap(
+                    rollback, to_commit, jobs=jobs)):
+                if exc_info is not None:
+                    logger.critical("Could not roll back %s: %s. Do it "
+                                    "manually.", desc.target, exc_info[1])
+            return None
+
+        return new_tags
+
     def release(self, release_name, check=True, commit=True, options=None,
                 list_released=False):
         """Release the whole bundle.
@@ -553,24 +1200,42 @@ class Bundle(object):
             if branch_name is None:
                 return list_released and (1, ()) or 1
 
-        new_tags = {}
-        # Release of all repos
+        started = self.releaseJournal(release_name, options=options)
+        if started is None:
+            return list_released and (1, ()) or 1
+        journal, new_tags = started
+
         descriptors = self.getRepoDescriptors()
-        for desc in descriptors:
-            if isinstance(desc, Tag):
-                logger.info("Target %s is a tag (%s). Just checking.",
-                            desc.target, desc.name)
-                desc.releaseCheck()
-                continue
-            try:
-                new_tags[desc.target] = desc.release(
-                    multiple_heads=options.multiple_heads,
-                    increment_major=options.increment_major)
-            except RepoReleaseError:
-                return list_released and (1, new_tags.keys()) or 1
-
-        # update xml tree
-        known_targets = set(desc.target for desc in descriptors)
+        to_release = [desc for desc in descriptors
+                      if desc.target not in new_tags]
+        if self.releasePreflight(to_release, options=options):
+            return list_released and (1, ()) or 1
+
+        released = self.releaseDescriptors(to_release, options=options,
+                                           journal=journal)
+        if released is None:
+            return list_released and (1, ()) or 1
+        new_tags.update(released)
+
+        self.updateManifestTags(dict((target, tag.name)
+                                     for target, tag in new_tags.items()))
+
+        if commit:
+            self.release_commit(branch_name, release_name, options=options)
+            journal.remove()
+            if getattr(options, 'auto_push', False):
+                status = self.reportFailures(
+                    self.autoPush(new_tags.keys(), options=options))
+                return list_released and (status, new_tags.keys()) or status
+
+        return list_released and (0, new_tags.keys()) or 0
+
+    def updateManifestTags(self, tag_names):
+        """Replace branches by the given tags in the manifest, and write it.
+
+        tag_names is a dict (target -> tag name).
+        """
+        known_targets = set(desc.target for desc in self.getRepoDescriptors())
         for s in self.getRoot().getchildren():
             if s.tag != 'server':
                 continue
@@ -584,22 +1249,18 @@ class Bundle(object):
                 if target not in known_targets:
                     raise ValueError(
                         "Released target name %s unknown before hand" % target)
-                new_tag = new_tags.get(target)
-                if new_tag is None:
+                tag_name = tag_names.get(target)
+                if tag_name is None:
                     # not relased, but not an error
                     continue
 
                 s.remove(r)
-                t = new_tag.xml()
+                t = Tag(desc.remote_url, desc.bundle_dir, target, tag_name,
+                        desc.xml_attrs).xml()
                 s.insert(i, t)
 
         self.writeManifest()
 
-        if commit:
-            self.release_commit(branch_name, release_name, options=options)
-
-        return list_released and (0, new_tags.keys()) or 0
-
     def release_abort(self):
         self.initBundleRepo()
         repo = self.bundle_repo
@@ -649,11 +1310,26 @@ class Bundle(object):
                                 "uncommited merge?")
                 return 1
             raise
+
+        # the bundle working directory is at the tag for resolution only,
+        # and just then locked exclusively. Extraction runs concurrently
+        # with other readers.
+        lock = self.command_lock
+        if lock is not None:
+            lock.upgrade()
         try:
-           self.updateToTag(tag_name)
-        except NodeNotFoundError:
-            logger.critical("Release (bundle tag) %s not found", tag_name)
-            return 1
+            try:
+                self.updateToTag(tag_name)
+            except NodeNotFoundError:
+                logger.critical("Release (bundle tag) %s not found", tag_name)
+                return 1
+            try:
+                descriptors = self.getRepoDescriptors()
+            finally:
+                self.updateToInitialNode()
+        finally:
+            if lock is not None:
+                lock.downgrade()
 
         logger.info("Creation of output directory %s", output_dir)
         os.mkdir(output_dir)
@@ -661,9 +1337,10 @@ class Bundle(object):
         self.createArchiveVersionFiles(tag_name, output_dir)
 
         has_sub = False
-        for desc in self.getRepoDescriptors():
+        cache = self.getExportCache(options)
+        for desc in descriptors:
             has_sub = has_sub or desc.is_sub
-            desc.archive(output_dir)
+            desc.archive(output_dir, cache=cache)
 
         if has_sub:
             aside = os.path.join(output_dir, ASIDE_REPOS)
@@ -674,8 +1351,6 @@ class Bundle(object):
             cmd = "rm -r %s" % aside
             os.system(cmd)
 
-        self.updateToInitialNode()
-
     def createArchiveVersionFiles(self, tag_name, output_dir):
         def in_ar(p):
             return os.path.join(output_dir, p)
@@ -685,9 +1360,9 @@ class Bundle(object):
                 tag_name, tag_name))
         f.close()
 
-    def changelog(self, tag1, tag2, options=None):
-        """Output a changelog between two tags."""
-
+    def changelogInitRepo(self):
+        """Bundle repo init for changelog commands. Return status if failed.
+        """
         try:
             self.initBundleRepo()
         except RepoNotFoundError:
@@ -701,20 +1376,23 @@ class Bundle(object):
                 return 1
             raise
 
+    def descriptorsAtTag(self, tag):
+        """Update the bundle to tag and return the descriptors it defines.
 
-        descs = []
-        for tag in (tag1, tag2):
-            try:
-                self.updateToTag(tag)
-            except NodeNotFoundError:
-                logger.critical("Release (bundle tag) %s not found", tag)
-                return 1
-            bdl = Bundle(self.bundle_dir)
-            descs.append(bdl.getRepoDescriptors(store=False))
+        Raise NodeNotFoundError if tag can't be found.
+        """
+        self.updateToTag(tag)
+        return Bundle(self.bundle_dir).getRepoDescriptors(store=False)
 
-        self.updateToInitialNode()
+    def changelogData(self, descs0, descs1, options=None, memo=None):
+        """Compute the changelog data between the two sets of descriptors.
 
-        targets = [ set(desc.target for desc in descs[i]) for i in (0,1)]
+        Return a dict, or None in case of failure.
+        If specified, memo is a dict used to share the parsed changelogs
+        of targets across calls.
+        """
+        targets = [set(desc.target for desc in descs)
+                   for descs in (descs0, descs1)]
         new_targets = targets[1].difference(targets[0])
         removed_targets = targets[0].difference(targets[1])
         check_targets = targets[0].intersection(targets[1])
@@ -725,10 +1403,11 @@ class Bundle(object):
         bug_fixes = []
         int_features = []
 
+        to_parse = []
         for target in check_targets:
             ds = [None, None]
-            for i in (0,1):
-                for d in descs[i]:
+            for i, descs in enumerate((descs0, descs1)):
+                for d in descs:
                     if d.target == target:
                         ds[i] = d
                         break
@@ -744,18 +1423,53 @@ class Bundle(object):
                 continue
 
             changed_targets.append((target, ttags[0], ttags[1]))
+            to_parse.append((ds[1], ttags))
+
+        if memo is None:
+            memo = {}
+        def memo_key(x):
+            return x[0].remote_url, x[1][0], x[1][1]
+
+        # now we ask the repos themselves, for what we don't know already
+        cache = DiskCache(os.path.join(USER_CACHE_DIR, CHANGELOG_CACHE))
+        jobs = getattr(options, 'jobs', None) or DEFAULT_JOBS
+        missing = [x for x in to_parse if memo_key(x) not in memo]
+        results = pool_map(lambda x: x[0].changelog(cache=cache, *x[1]),
+                           missing, jobs=jobs)
+
+        failed = False
+        for x, (parsed, exc_info) in zip(missing, results):
+            if exc_info is not None:
+                desc, ttags = x
+                logger.error("Could not extract changelog of %s between %s "
+                             "and %s: %s", desc.target, ttags[0], ttags[1],
+                             exc_info[1])
+                failed = True
+                continue
+            memo[memo_key(x)] = parsed
+        if failed:
+            return None
 
-            # now we ask the repo itself
-            req, feat, bug, int_feat = ds[1].changelog(*ttags)
-
+        for x in to_parse:
+            target = x[0].target
+            req, feat, bug, int_feat = memo[memo_key(x)]
             int_features.extend(['[%s] %s'% (target, line)
                                  for line in int_feat])
             features.extend(['[%s] %s'% (target, line) for line in feat])
             requires.extend(['[%s] %s'% (target, line) for line in req])
             bug_fixes.extend(['[%s] %s'% (target, line) for line in bug])
 
-        output_buffer = []
-        output = output_buffer.append
+        return dict(new_targets=new_targets,
+                    removed_targets=removed_targets,
+                    changed_targets=changed_targets,
+                    requires=requires, features=features,
+                    bug_fixes=bug_fixes, int_features=int_features)
+
+    def formatChangelog(self, tag1, tag2, output, new_targets=(),
+                        removed_targets=(), changed_targets=(),
+                        requires=(), features=(), bug_fixes=(),
+                        int_features=()):
+        """Output changelog data with the given output function."""
         output(rst_title("CHANGELOG between bundles tags %s and %s" %
                          (tag1, tag2), 0))
         output("New tag: %s\n" % tag2)
@@ -785,11 +1499,192 @@ class Bundle(object):
             output('* ' + '\n* '.join(int_features))
         output('\n')
 
-        if options.output:
+    def writeChangelog(self, output_buffer, options=None):
+        if getattr(options, 'output', None):
             f = open(options.output, 'w')
             f.writelines(output_buffer)
             f.close()
         else:
             sys.stdout.writelines(output_buffer)
+
+    def changelog(self, tag1, tag2, options=None):
+        """Output a changelog between two tags."""
+
+        status = self.changelogInitRepo()
+        if status:
+            return status
+
+        descs = []
+        for tag in (tag1, tag2):
+            try:
+                descs.append(self.descriptorsAtTag(tag))
+            except NodeNotFoundError:
+                logger.critical("Release (bundle tag) %s not found", tag)
+                self.updateToInitialNode()
+                return 1
+
+        self.updateToInitialNode()
+
+        data = self.changelogData(descs[0], descs[1], options=options)
+        if data is None:
+            return 1
+
+        output_buffer = []
+        self.formatChangelog(tag1, tag2, output_buffer.append, **data)
+        self.writeChangelog(output_buffer, options=options)
         return 0
 
+    def bundleTagsRange(self, tag1, tag2):
+        """Return the bundle tags from tag1 to tag2 (included), ordered.
+
+        Only the tags at which the manifest of this bundle exists are
+        taken into account.
+        Raise NodeNotFoundError if tag1 or tag2 can't be found.
+        """
+        repo = self.bundle_repo
+        tags = repo.tags()
+        revs = []
+        for tag in (tag1, tag2):
+            try:
+                revs.append(repo.changelog.rev(tags[tag]))
+            except KeyError:
+                raise NodeNotFoundError(tag)
+        rev1, rev2 = min(revs), max(revs)
+
+        # relative to the repository root, in Mercurial's format
+        # (os.path.relpath needs Python 2.6)
+        root = os.path.realpath(repo.root)
+        manifest = os.path.realpath(self.getManifestPath())
+        manifest = '/'.join(manifest[len(root):].split(os.sep)).lstrip('/')
+        found = []
+        for tag, node in tags.items():
+            if tag == 'tip':
+                continue
+            rev = repo.changelog.rev(node)
+            if rev < rev1 or rev > rev2:
+                continue
+            if manifest not in repo.changectx(node):
+                logger.debug("Tag %s is not a release of this bundle", tag)
+                continue
+            found.append((rev, tag))
+        found.sort()
+        return [tag for rev, tag in found]
+
+    def changelog_range(self, tag1, tag2, options=None):
+        """Output changelogs for all consecutive bundle tags from tag1 to tag2.
+
+        Each bundle tag is visited once, sharing changelogs of components
+        between the output sections (repositories are shared by the
+        repository pool), the most recent first.
+        """
+        status = self.changelogInitRepo()
+        if status:
+            return status
+
+        try:
+            tags = self.bundleTagsRange(tag1, tag2)
+        except NodeNotFoundError, e:
+            logger.critical("Release (bundle tag) %s not found", e)
+            return 1
+        logger.info("Bundle tags in range: %s", ', '.join(tags))
+
+        memo = {}
+        sections = []
+        previous = None
+        for tag in tags:
+            descs = self.descriptorsAtTag(tag)
+            if previous is not None:
+                data = self.changelogData(previous[1], descs, options=options,
+                                          memo=memo)
+                if data is None:
+                    self.updateToInitialNode()
+                    return 1
+                sections.append((previous[0], tag, data))
+            previous = tag, descs
+
+        self.updateToInitialNode()
+
+        output_buffer = []
+        sections.reverse()
+        for tag1, tag2, data in sections:
+            self.formatChangelog(tag1, tag2, output_buffer.append, **data)
+        self.writeChangelog(output_buffer, options=options)
+        return 0
+
+
+def release_union(bundles, release_name, options=None):
+    """Release several bundles of a same repository in one go.
+
+    Components are identified by their targets. Each of them is released
+    once, in its clone from the first bundle having it as a branch, and
+    then pulled in the clones of the other bundles. A target must therefore
+    be the same branch of the same repository in all bundles.
+    Return status.
+    """
+    first = bundles[0]
+    descriptors = []
+    owners = {} # target -> descriptor in which it gets released
+    followers = [] # (descriptor, owner descriptor)
+    for bundle in bundles:
+        for desc in bundle.getRepoDescriptors():
+            descriptors.append(desc)
+            if not isinstance(desc, Branch):
+                continue
+            owner = owners.get(desc.target)
+            if owner is None:
+                owners[desc.target] = desc
+                continue
+            if ((desc.remote_url, desc.getName())
+                != (owner.remote_url, owner.getName())):
+                logger.error("Target %s is branch %s of %s in bundle %s, but "
+                             "branch %s of %s in bundle %s. Can't release "
+                             "it once for both.", desc.target,
+                             owner.getName(), owner.remote_url,
+                             owner.bundle_dir, desc.getName(),
+                             desc.remote_url, desc.bundle_dir)
+                return 1
+            followers.append((desc, owner))
+
+    branch_name = first.release_repo_check(release_name, options=options)
+    if branch_name is None:
+        return 1
+
+    started = first.releaseJournal(release_name, options=options,
+                                   descriptors=owners.values())
+    if started is None:
+        return 1
+    journal, new_tags = started
+
+    if first.releasePreflight([desc for desc in descriptors
+                               if desc.target not in new_tags],
+                              options=options):
+        return 1
+
+    released = first.releaseDescriptors(
+        [desc for desc in owners.values() if desc.target not in new_tags],
+        options=options, journal=journal)
+    if released is None:
+        return 1
+    new_tags.update(released)
+
+    to_pull = [(desc, owner) for desc, owner in followers
+               if owner.target in new_tags]
+    failures = first.syncClones(to_pull, update=True, options=options)
+    if failures:
+        first.reportFailures(failures, 'pull')
+        logger.critical("Components released, but not propagated to all "
+                        "bundles. Fix the problem and use --resume.")
+        return 1
+
+    tag_names = dict((target, tag.name) for target, tag in new_tags.items())
+    for bundle in bundles:
+        bundle.updateManifestTags(tag_names)
+    first.release_commit(branch_name, release_name, options=options)
+    journal.remove()
+
+    if getattr(options, 'auto_push', False):
+        failures = first.pushDescriptors(
+            [owners[target] for target in new_tags], options=options)
+        failures.extend(first.autoPush((), options=options))
+        return first.reportFailures(failures)
+    return 0
@@ -18,14 +18,30 @@
 # $Id$
 
 import os
+import sys
+import shutil
+import threading
+from Queue import Queue, Empty
 import mercurial.util
 
+from constants import DEFAULT_JOBS
+
 try:
     HG_VERSION_STR = mercurial.util.version()
 except AttributeError:
     from mercurial.version import get_version
     HG_VERSION_STR = get_version()
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 try:
     from lxml import etree
 except ImportError:
@@ -51,6 +67,10 @@ class BranchNotFoundError(KeyError):
     pass
 
 
+class PushError(Exception):
+    pass
+
+
 def _findrepo(p):
     """Find with of path p is an hg repo.
 
@@ -75,4 +95,70 @@ def _currentNodeRev(repo):
         node = ctx.node()
     return node, ctx.rev()
 
-
+def intern_str(s):
+    """Intern s if it is a plain string (unicode ones can't be)."""
+    if type(s) is str:
+        return intern(s)
+    return s
+
+def hardlink_tree(src, dest):
+    """Reproduce the src tree as dest, hardlinking the files.
+
+    Falls back to copies if hardlinking is not possible (e.g., the cache and
+    the bundle are on different filesystems)."""
+
+    os.makedirs(dest)
+    for root, dirs, files in os.walk(src):
+        rel = root[len(src):].lstrip(os.path.sep)
+        dest_root = os.path.join(dest, rel)
+        for d in dirs:
+            path = os.path.join(root, d)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(dest_root, d))
+            else:
+                os.mkdir(os.path.join(dest_root, d))
+        for f in files:
+            path = os.path.join(root, f)
+            target = os.path.join(dest_root, f)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+                continue
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copy2(path, target)
+
+def pool_map(func, items, jobs=DEFAULT_JOBS):
+    """Apply func to all items on a pool of worker threads.
+
+    Return the list of (result, exc_info) pairs, in the order of items.
+    exc_info is None in case of success, the value of sys.exc_info() otherwise:
+    it's up to the caller to decide how to treat failures.
+    """
+    if jobs < 1:
+        raise ValueError("Need at least one job, got %r" % jobs)
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item), None
+            except:
+                results[i] = None, sys.exc_info()
+
+    workers = [threading.Thread(target=work)
+               for j in range(min(jobs, len(items)))]
+    for w in workers:
+        w.setDaemon(True)
+        w.start()
+    for w in workers:
+        w.join()
+    return results
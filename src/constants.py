@@ -17,3 +17,19 @@
 # $Id$
 
 ASIDE_REPOS = '.hgbundler'
+
+# Per-user cache directory, shared by all bundles (user expansion is up to
+# the caller)
+USER_CACHE_DIR = '~/.hgbundler-cache'
+
+# Default number of worker threads for parallel operations
+DEFAULT_JOBS = 8
+
+# Default maximum number of simultaneous pushes to a same server
+DEFAULT_SERVER_JOBS = 4
+
+# Bounds of the pool of open repositories: number, and estimated memory
+# (size of changelog and manifest indexes) in bytes. The number is raised to
+# the count of clones of the bundles at hand (see RepoPool.reserve())
+REPO_POOL_SIZE = 100
+REPO_POOL_MEMORY = 512 * 1024 * 1024
@@ -0,0 +1,82 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Simple persistent cache of marshalable values, one file per key.
+
+Values are stored with marshal rather than JSON, so that byte strings, such
+as HISTORY lines in arbitrary encodings, come back as they were given.
+"""
+
+import os
+import marshal
+import logging
+
+from common import sha1
+
+logger = logging.getLogger('hgbundler.diskcache')
+
+class DiskCache(object):
+    """Keys are tuples of strings, values anything marshal can dump.
+
+    Meant for values that are functions of their keys, e.g., keyed by
+    Mercurial nodes, therefore with no need for invalidation.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def keyPath(self, key):
+        h = sha1('\0'.join(key)).hexdigest()
+        return os.path.join(self.cache_dir, h[:2], h[2:])
+
+    def get(self, key, default=None):
+        try:
+            f = open(self.keyPath(key), 'rb')
+        except IOError:
+            return default
+        try:
+            try:
+                return marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                logger.warn("Ignoring corrupted cache file %s",
+                            self.keyPath(key))
+                return default
+        finally:
+            f.close()
+
+    def set(self, key, value):
+        path = self.keyPath(key)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError: # concurrent creation
+                pass
+        # atomic write, for concurrent processes and threads
+        tmp = '%s.tmp-%d-%d' % (path, os.getpid(), id(value))
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump(value, f)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
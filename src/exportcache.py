@@ -0,0 +1,131 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Shared cache of exported (plain file trees) tag components.
+
+Layout of the cache directory::
+
+  mirrors/<url hash>          clone without working copy, pulled on demand
+  exports/<url hash>/<node>   plain file tree of the given node
+
+Export trees are never modified once created. Bundles get them through
+hardlinks, hence it is a bad idea to edit files in exported components.
+"""
+
+import os
+import shutil
+import thread
+import logging
+
+from mercurial import hg
+from mercurial import archival
+from mercurial import commands as hg_commands
+from mercurial import cmdutil as hg_cmdutil
+from mercurial.node import hex as hg_fullhex
+
+from repodescriptor import HG_UI
+from repodescriptor import make_clone
+from common import sha1
+
+logger = logging.getLogger('hgbundler.exportcache')
+
+MIRRORS = 'mirrors'
+EXPORTS = 'exports'
+
+def url_key(url):
+    return sha1(url).hexdigest()
+
+def tmp_path(path):
+    """Return a temporary path, to be renamed to path once complete.
+
+    Unique to the process and thread."""
+    return '%s.tmp-%d-%d' % (path, os.getpid(), thread.get_ident())
+
+class ExportCache(object):
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.mirrors = {} # url -> repo, to pull at most once per process
+
+    def mirrorPath(self, url):
+        return os.path.join(self.cache_dir, MIRRORS, url_key(url))
+
+    def exportPath(self, url, node):
+        return os.path.join(self.cache_dir, EXPORTS, url_key(url),
+                            hg_fullhex(node))
+
+    def mirror(self, url):
+        """Return the up-to-date mirror repository for the given url."""
+        repo = self.mirrors.get(url)
+        if repo is not None:
+            return repo
+
+        path = self.mirrorPath(url)
+        if not os.path.isdir(path):
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            # several bundles may share the cache: make the mirror appear
+            # atomically
+            tmp = tmp_path(path)
+            logger.info("Creating mirror of %s in export cache", url)
+            if make_clone(url, tmp, noupdate=True):
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+                raise RuntimeError("Could not clone %s in export cache" % url)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # lost the race against another process
+                shutil.rmtree(tmp)
+            repo = hg.repository(HG_UI, path)
+        else:
+            repo = hg.repository(HG_UI, path)
+            logger.debug("Pulling %s in export cache mirror %s", url, path)
+            hg_commands.pull(HG_UI, repo, source=url)
+
+        self.mirrors[url] = repo
+        return repo
+
+    def export(self, url, node):
+        """Return the path to the export tree of node, creating it if needed.
+        """
+        path = self.exportPath(url, node)
+        if os.path.isdir(path):
+            logger.debug("Export of %s at %s already in cache", url,
+                         hg_fullhex(node))
+            return path
+
+        repo = self.mirror(url)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        # several bundles may share the cache: make the export appear
+        # atomically
+        tmp = tmp_path(path)
+        logger.info("Exporting %s at %s in cache", url, hg_fullhex(node))
+        archival.archive(repo, tmp, node, 'files', True,
+                         hg_cmdutil.match(repo, []))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # lost the race against another process
+            shutil.rmtree(tmp)
+        return path
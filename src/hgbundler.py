@@ -31,8 +31,13 @@ logger.addHandler(console_handler)
 logger.setLevel(logging.INFO)
 
 from bundle import Bundle
+from bundle import release_union
+from releasejournal import ReleaseJournal
 from common import _findrepo
 from server import read_servers
+from constants import USER_CACHE_DIR
+from constants import DEFAULT_JOBS
+from constants import DEFAULT_SERVER_JOBS
 
 def release_multiple_bundles(args, base_path='', options=None, opt_parser=None):
     """Release several bundles at once.
@@ -65,15 +70,36 @@ def release_multiple_bundles(args, base_path='', options=None, opt_parser=None):
         repo_path = path
 
     bundles = [Bundle(d) for d in bundle_dirs]
+    locks = lock_bundles(bundles)
+    try:
+        return release_bundles(bundles, release_name, options=options)
+    finally:
+        for lock in locks:
+            lock.release()
+
+def lock_bundles(bundles):
+    """Lock exclusively the bundles, return the list of locks.
+
+    Locks are acquired in the order of bundle directories, not to deadlock
+    against concurrent multiple releases of the same bundles."""
+    return [bundle.locks.bundleLock(exclusive=True)
+            for bundle in sorted(bundles, key=lambda b: b.bundle_dir)]
+
+def release_bundles(bundles, release_name, options=None):
+    """Release several bundles, the locks being acquired."""
+    if getattr(options, 'union', False):
+        return release_union(bundles, release_name, options=options)
 
     # First bundle does the common repo preparations
     # all hg operations on this repo can be delegated to the last acting bundle
     # (for commit or abort)
     branch_name = bundles[0].release_repo_check(release_name, options=options)
+    all_released = []
     for i, bundle in enumerate(bundles):
         status, released = bundle.release(release_name, options=options,
                                           check=False, commit=False,
                                           list_released=True)
+        all_released.append(released)
 
         if status:
             bundle.release_abort() # any bundle can do it
@@ -84,10 +110,29 @@ def release_multiple_bundles(args, base_path='', options=None, opt_parser=None):
         # same identifier (as shown by test_hgbundler),
         # so that this operation is actually not necessary
 
+        failures = []
         for rem in bundles[i+1:]:
-            rem.pull_clones(from_bundle=bundle, targets=released, update=True)
+            failures.extend(rem.pull_clones(from_bundle=bundle,
+                                            targets=released,
+                                            update=True, options=options))
+        if failures:
+            bundle.reportFailures(failures, 'pull')
+            logger.critical("Components released, but not propagated to all "
+                            "bundles. Fix the problem and use --resume.")
+            bundle.release_abort()
+            return 1
 
     bundle.release_commit(branch_name, release_name, options=options)
+    for bundle in bundles:
+        ReleaseJournal(bundle.bundle_dir).remove()
+
+    if getattr(options, 'auto_push', False):
+        failures = []
+        for bundle, released in zip(bundles, all_released):
+            failures.extend(bundle.autoPush(released, options=options,
+                                            bundle_repo=False))
+        failures.extend(bundle.autoPush((), options=options))
+        return bundle.reportFailures(failures)
 
 def attr_filter_callback(option, opt, value, parser):
     """Treatment of the attributes-filter option."""
@@ -107,12 +152,20 @@ def main():
                        'update-clones': 'update_clones',
                        'clones-update' : 'update_clones',
                        'clones-list': 'clones_list',
+                       'clones-status': 'clones_status',
                        'clones-refresh-url': 'clones_refresh_url',
                        'clones-out': 'clones_out',
+                       'clones-sync-from': 'clones_sync_from',
+                       'clones-sync-to': 'clones_sync_to',
+                       'lock': 'lock_manifest',
+                       'fingerprint': 'fingerprint',
+                       'watch': 'watch',
                        'release-clone': 'release_clone',
                        'release-bundle': 'release',
+                       'release-plan': 'release_plan',
                        'archive': 'archive',
-                       'bundle-changelog': 'changelog'}
+                       'bundle-changelog': 'changelog',
+                       'bundle-changelog-range': 'changelog_range'}
     usage = "usage: %prog [options] " + '|'.join(
         global_commands.keys() + bundle_commands.keys())
     usage += """ [command args] \n
@@ -123,9 +176,13 @@ def main():
     -----------------------------------------------------------
     release-clone       <clone relative path>         mandatory
     release-bundle      <release name>                mandatory
+    release-plan        <release name>                mandatory
     archive             <bundle tag> <output dir>     mandatory
+    clones-sync-from    <other bundle dir>            mandatory
+    clones-sync-to      <other bundle dir>            mandatory
     release-multiple    <bdl dir> [<bdl dir>]  <name> at least one bundle dir
     bundle-changelog    <bundle tag1> <bundle tag2>   both mandatory
+    bundle-changelog-range <bundle tag1> <bundle tag2> both mandatory
 """
     parser = OptionParser(usage=usage)
 
@@ -146,10 +203,31 @@ def main():
                       action='store_true',
                       help="Increment the most significatn version number. "
                       " For 'release-clone' command only.")
+    parser.add_option('--resume', action='store_true',
+                      help="Resume an interrupted bundle release, without "
+                      "releasing again the clones recorded as released")
+    parser.add_option('--union', action='store_true',
+                      help="For release-multiple, release once and in "
+                      "parallel the components shared by the bundles")
+    parser.add_option('--auto-push', action='store_true',
+                      help="After release, push the released clones "
+                      "and the bundle repository")
+    parser.add_option('--server-jobs', type='int',
+                      default=DEFAULT_SERVER_JOBS,
+                      help="Maximum number of simultaneous pushes to a same "
+                      "server (defaults to %d)" % DEFAULT_SERVER_JOBS)
+    parser.add_option('-j', '--jobs', type='int', default=DEFAULT_JOBS,
+                      help="Number of parallel workers for the commands "
+                      "that support it (default %d)" % DEFAULT_JOBS)
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
                       help="Sets the logging level to DEBUG")
     parser.add_option('-o', '--output', dest='output', metavar='FILE',
                       help="Output file for analysis command (e.g bundle-changelog)")
+    parser.add_option('--json', action='store_true',
+                      help="Output JSON (release-plan and clones-status "
+                      "commands)")
+    parser.add_option('--local-only', action='store_true',
+                      help="Skip the network checks (clones-status command)")
     parser.add_option('--branches-only', action='store_true',
                       help="Have clones-list list live branches only")
     parser.add_option('--tags-only', action='store_true',
@@ -157,6 +235,9 @@ def main():
     parser.add_option('--toplevel-only', action='store_true',
                       help="Have clones-list top level (not included) clones "
                       "only")
+    parser.add_option('--dirty-only', action='store_true',
+                      help="Have clones-list list clones with uncommited "
+                      "changes only")
     parser.add_option('--attributes-filter', action='callback',
                       callback=attr_filter_callback,
                       dest='attributes_filter', type="str",
@@ -165,6 +246,18 @@ def main():
                       "ATTRIBUTE=VALUE. Add a filter several times on "
                       "the same attribute, to build a list of accepted values."
                       )
+    parser.add_option('--export-tags', action='store_true',
+                      help="Have make-clones materialize tags as plain file "
+                      "trees (no history) taken from the export cache")
+    parser.add_option('--export-cache', metavar='DIR',
+                      help="Directory of the export cache, shared between "
+                      "bundles (defaults to %s)" % USER_CACHE_DIR)
+    parser.add_option('--minimal', action='store_true',
+                      help="Have make-clones restrict new clones to the "
+                      "named branch or to the ancestors of the tag")
+    parser.add_option('--locked', action='store_true',
+                      help="Have make-clones and update-clones use the nodes "
+                      "recorded by the lock command")
 
     options, arguments = parser.parse_args()
     if not arguments:
@@ -174,16 +267,49 @@ def main():
     if options.verbose:
         logger.setLevel(logging.DEBUG)
 
+    if options.jobs < 1:
+        parser.error("The number of jobs must be at least 1")
+    if options.server_jobs < 1:
+        parser.error("The number of jobs per server must be at least 1")
+
     command = arguments[0]
     if options.increment_major and command != 'release-clone':
         parser.error(
             "The selected options apply to the release-clone command only")
     if (options.tags_only or options.branches_only
         or options.attributes_filter or options.toplevel_only
-        ) and command != 'clones-list':
+        or options.dirty_only) and command != 'clones-list':
         parser.error(
             "The selected options apply to the clones-list command only")
 
+    if options.json and command not in ('release-plan', 'clones-status'):
+        parser.error("The selected options apply to the release-plan and "
+                     "clones-status commands only")
+    if options.local_only and command != 'clones-status':
+        parser.error(
+            "The selected options apply to the clones-status command only")
+    if options.union and command != 'release-multiple':
+        parser.error(
+            "The selected options apply to the release-multiple command only")
+    if options.auto_push and command not in ('release-clone',
+                                             'release-bundle',
+                                             'release-multiple'):
+        parser.error("The selected options apply to the release commands "
+                     "only")
+    if options.resume and command not in ('release-bundle',
+                                          'release-multiple'):
+        parser.error("The selected options apply to the release-bundle and "
+                     "release-multiple commands only")
+
+    if ((options.export_tags or options.minimal)
+        and command not in ('make-clones', 'clones-make')):
+        parser.error(
+            "The selected options apply to the make-clones command only")
+    if options.locked and command not in ('make-clones', 'clones-make',
+                                          'update-clones', 'clones-update'):
+        parser.error("The selected options apply to the make-clones and "
+                     "update-clones commands only")
+
     meth = global_commands.get(command)
     if meth is not None:
         status = meth(arguments[1:], options=options)
@@ -195,7 +321,12 @@ def main():
     if meth is None:
         parser.error("Unknown command: " + command)
 
-    status = getattr(bundle, meth)(*arguments[1:], **dict(options=options))
+    lock = bundle.commandLock(meth)
+    try:
+        status = getattr(bundle, meth)(*arguments[1:], **dict(options=options))
+    finally:
+        if lock is not None:
+            lock.release()
     sys.exit(status)
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Inter-process locks of a bundle and of its clones.
+
+Locks are advisory (flock) files in the aside directory of the bundle.
+Shared locks are for readers, exclusive ones for writers. Commands that
+only write in some clones take the bundle lock in shared mode, and the
+exclusive lock of each clone just while they work on it.
+
+Lock files are created by the first command needing them, be it a reader
+or a writer. Readers that can't create them, on bundles they can't write
+to, run without lock if the lock file does not exist yet.
+"""
+
+import os
+import errno
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from common import sha1
+from constants import ASIDE_REPOS
+
+logger = logging.getLogger('hgbundler.lockmanager')
+
+LOCKS_DIR = 'locks'
+BUNDLE_LOCK = 'bundle'
+CLONES_LOCKS = 'clones'
+
+class Lock(object):
+    """An acquired lock. Call release() when done."""
+
+    def __init__(self, path, exclusive=False):
+        self.path = path
+        self.fd = None
+        if fcntl is None:
+            return
+
+        self.fd = self.open(exclusive=exclusive)
+        if self.fd is None:
+            logger.debug("Can't create lock file %s, running without lock",
+                         path)
+            return
+        self.acquire(exclusive)
+
+    def open(self, exclusive=False):
+        """Return a file descriptor of the lock file, creating it if needed.
+
+        For a shared lock, if the lock file can't be created or written for
+        lack of permission, return an existing one opened read-only, or None.
+        """
+        try:
+            parent = os.path.dirname(self.path)
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError, e:
+                    if e.errno != errno.EEXIST: # concurrent creation is fine
+                        raise
+            return os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        except OSError, e:
+            if exclusive or e.errno not in (errno.EACCES, errno.EROFS):
+                raise
+
+        try:
+            return os.open(self.path, os.O_RDONLY)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+    def acquire(self, exclusive):
+        mode = exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH
+        try:
+            fcntl.flock(self.fd, mode | fcntl.LOCK_NB)
+        except IOError:
+            logger.info("Waiting for %s lock %s",
+                        exclusive and 'exclusive' or 'shared', self.path)
+            fcntl.flock(self.fd, mode)
+
+    def upgrade(self):
+        """Make the lock exclusive, until downgrade() is called.
+
+        As with flock, this is not atomic: the shared lock is released
+        before the exclusive one is waited for."""
+        if fcntl is None:
+            return
+        if self.fd is None:
+            self.fd = self.open(exclusive=True)
+        self.acquire(True)
+
+    def downgrade(self):
+        """Make the lock shared again."""
+        if self.fd is not None:
+            self.acquire(False)
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+class LockManager(object):
+
+    def __init__(self, bundle_dir):
+        self.locks_dir = os.path.join(bundle_dir, ASIDE_REPOS, LOCKS_DIR)
+        if fcntl is None:
+            logger.warn("No file locking on this platform. Don't run "
+                        "concurrent commands on a same bundle.")
+
+    def bundleLock(self, exclusive=False):
+        return Lock(os.path.join(self.locks_dir, BUNDLE_LOCK),
+                    exclusive=exclusive)
+
+    def cloneLock(self, local_path, exclusive=False):
+        key = sha1(os.path.abspath(local_path)).hexdigest()
+        return Lock(os.path.join(self.locks_dir, CLONES_LOCKS, key),
+                    exclusive=exclusive)
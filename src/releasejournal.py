@@ -0,0 +1,112 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Journal of the components released by an ongoing bundle release.
+
+It allows to resume a release that failed or got interrupted after some
+components have been released, without releasing them again.
+"""
+
+import os
+import marshal
+import threading
+import logging
+
+from constants import ASIDE_REPOS
+
+logger = logging.getLogger('hgbundler.releasejournal')
+
+JOURNAL_FILE = 'release-journal'
+
+class ReleaseJournal(object):
+    """Stored in the aside directory of the bundle.
+
+    For each released target, the journal records the new tag and the
+    hex nodes of the changesets made by the release. It is serialized with
+    marshal, so that targets and tag names stay byte strings.
+    """
+
+    def __init__(self, bundle_dir):
+        self.path = os.path.join(bundle_dir, ASIDE_REPOS, JOURNAL_FILE)
+        self.data = None
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        """Read the journal from disk and return its release name.
+
+        Raise ValueError if it can't be read."""
+        f = open(self.path, 'rb')
+        try:
+            try:
+                data = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                data = None
+        finally:
+            f.close()
+        if not isinstance(data, dict) or 'release' not in data:
+            raise ValueError("Unreadable release journal %s" % self.path)
+        self.data = data
+        return data['release']
+
+    def start(self, release_name):
+        """Start a new journal. Nothing is written before the first record.
+        """
+        self.data = dict(release=release_name, released={})
+
+    def write(self):
+        parent = os.path.dirname(self.path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        # atomic write: an interruption must not corrupt the journal
+        tmp = '%s.tmp-%d' % (self.path, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump(self.data, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def released(self):
+        """Return a dict target -> dict(tag=tag name, nodes=list of hex)."""
+        return self.data['released']
+
+    def record(self, target, tag_name, nodes):
+        self.lock.acquire()
+        try:
+            self.data['released'][target] = dict(tag=tag_name,
+                                                 nodes=list(nodes))
+            self.write()
+        finally:
+            self.lock.release()
+
+    def forget(self, target):
+        self.lock.acquire()
+        try:
+            self.data['released'].pop(target, None)
+            self.write()
+        finally:
+            self.lock.release()
+
+    def remove(self):
+        if self.exists():
+            logger.debug("Removing release journal %s", self.path)
+            os.unlink(self.path)
+        self.data = None
@@ -21,28 +21,42 @@ import logging
 from datetime import datetime
 
 from mercurial.node import short as hg_hex
-import mercurial.patch
 from mercurial import commands as hg_commands
 
 from bundleman.utils import parseZopeVersionFile, parseNuxeoVersionFile
 from bundleman.utils import parseVersionString, parseNuxeoChanges
 
+from common import _currentNodeRev
+
 logger = logging.getLogger('hgbundler.releaser')
 
-def gen_or_list_bool(gl):
-    """Same logic as bool(gl) except that it accepts lists and generators.
+def manifests_differ(repo, node1, node2):
+    """True if the files of the two changesets differ.
 
-    Consumes generator first object.
-    Use-case : mercurial.patch.diff returns list in 1.6.4 (Debian's 1.6.4-1)
+    Compares manifest nodes first, then file nodes, and finally contents
+    of files whose nodes differ (same contents can have different nodes).
     """
-    if isinstance(gl, list):
-        return bool(gl)
-    try:
-        gl.next()
-    except StopIteration:
+    if node1 == node2:
+        return False
+    cl = repo.changelog
+    mnode1, mnode2 = cl.read(node1)[0], cl.read(node2)[0]
+    if mnode1 == mnode2:
         return False
-    return True
 
+    mf1 = repo.manifest.read(mnode1)
+    mf2 = repo.manifest.read(mnode2)
+    if set(mf1) != set(mf2):
+        return True
+    for f, fnode1 in mf1.iteritems():
+        if mf1.flags(f) != mf2.flags(f):
+            return True
+        fnode2 = mf2[f]
+        if fnode1 == fnode2:
+            continue
+        flog = repo.file(f)
+        if flog.read(fnode1) != flog.read(fnode2):
+            return True
+    return False
 
 
 class RepoReleaseError(Exception):
@@ -179,32 +193,61 @@ First release built by: %s at: %s
         self.version_str = ret[1]
         self.release_nr = ret[2] and int(ret[2]) or None
 
+    def childrenIndex(self, start_rev):
+        """Map start_rev and later revisions to their children.
+
+        This reads the changelog index only, in a single pass, whereas each
+        ctx.children() call scans all later revisions (Mercurial < 1.7).
+        """
+        cl = self.repo.changelog
+        children = {}
+        for rev in xrange(start_rev + 1, len(cl)):
+            for p in cl.parentrevs(rev):
+                if p >= start_rev:
+                    children.setdefault(p, []).append(rev)
+        return children
+
+    def branchChildren(self, children, rev):
+        """Return the children of rev on our branch, from childrenIndex()."""
+        repo = self.repo
+        return [c for c in children.get(rev, ())
+                if repo.changectx(c).branch() == self.branch]
+
     def changedSinceTag(self, node, tag_name=None):
-        tag_ctx = self.repo.changectx(node)
-        def branch_children(ctx):
-            return [c for c in ctx.children() if c.branch() == self.branch]
+        """Tell if there are changes on the branch since the given tag.
+
+        The tagged changeset must have exactly one child on the branch
+        (the tag commit), which itself must have exactly one (the reinit of
+        CHANGES), as done by hgbundler. Changes are looked for between the
+        latter and the working directory.
+        """
+        repo = self.repo
+        tag_rev = repo.changelog.rev(node)
+        current_node = _currentNodeRev(repo)[0]
+        children = self.childrenIndex(tag_rev)
 
-        children = branch_children(tag_ctx)
         base_error_msg = ("Previous tag %s (from VERSION) " +
                          "not done by hgbundler. ")
-        if len(children) != 1:
+        tag_children = self.branchChildren(children, tag_rev)
+        if len(tag_children) != 1:
             logger.error(base_error_msg + "The tagged changeset would "
                          "otherwise have exactly."
                          "one child (commit of tag).", tag_name)
-            self.dumpLogSince(tag_ctx.node())
+            self.dumpLogSince(node)
             raise RepoReleaseError
 
-        children = branch_children(children[0])
-        if len(children) != 1:
+        reinit_children = self.branchChildren(children, tag_children[0])
+        if len(reinit_children) != 1:
             logger.error(base_error_msg + "The tag commit "
                          "would otherwise have exactly one child (reinit of "
                          "CHANGES). ", tag_name)
-            self.dumpLogSince(tag_ctx.node())
+            self.dumpLogSince(node)
             raise RepoReleaseError
 
-        node1 = children[0].node()
-        logger.debug("Checking diff since changeset %s", hg_hex(node1))
-        if not gen_or_list_bool(mercurial.patch.diff(self.repo, node1=node1)):
+        node1 = repo.changelog.node(reinit_children[0])
+        logger.debug("Checking changes since changeset %s", hg_hex(node1))
+        if (not manifests_differ(repo, node1, current_node)
+            and not filter(None, repo.status()[:4])):
             return False
 
         logger.warn("Diff since last release (node %s) not empty.",
@@ -232,15 +275,20 @@ First release built by: %s at: %s
         Return True if a new tag must be made,
                False if an existing tag must be used instead of the branch,
                None if no action is to be taken
+        In the first case, the bump attribute tells which part of the
+        version changes: 'major', 'minor', 'bugfix', or 'release' (number).
         """
+        self.bump = None
         if self.initial:
             logger.warn("No CHANGES file found in the branch '%s', "
                          "of %s. Assuming initial release", self.branch,
                          self.desc.local_path_rel)
             if self.increment_major:
                 self.version_new = ['1.0.0', 1]
+                self.bump = 'major'
             else:
                 self.version_new = ['0.0.1', 1]
+                self.bump = 'bugfix'
             return True
 
         changes = self.changes
@@ -250,7 +298,7 @@ First release built by: %s at: %s
         version_str = self.version_str
         version = parseVersionString(version_str)
         if not filter(None, changes) or not version:
-            tag_node = self.repo.tags().get(self.version_str)
+            tag_node = self.desc.getCache().tags().get(self.version_str)
             if tag_node is None:
                 if self.version_str:
                     # need to create the tag
@@ -278,19 +326,23 @@ First release built by: %s at: %s
             release = 1
             if self.increment_major:
                 # major++
+                self.bump = 'major'
                 version[0] += 1
                 version[1] = 0
                 version[2] = 0
             else:
                 # minor++
+                self.bump = 'minor'
                 version[1] = version[1] + 1
                 version[2] = 0
         elif changes[2]:
             # bug fixes
             release = 1
+            self.bump = 'bugfix'
             version[2] = version[2] + 1
         else:
             # release again
+            self.bump = 'release'
             release += 1
         str_version = '.'.join(map(str, version)[:-1])
         if self.branch != 'default':
@@ -0,0 +1,137 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Persistent cache of costly resolution data of a clone."""
+
+import os
+import marshal
+import logging
+
+from mercurial.node import hex as hg_fullhex
+from mercurial.node import bin as hg_bin
+
+logger = logging.getLogger('hgbundler.repocache')
+
+CACHE_FILE = 'hgbundler-repocache' # former JSON one was 'hgbundler-cache'
+
+class RepoCache(object):
+    """Branch tips, tags and bundleman children (see #2143) of a clone.
+
+    This is stored in the .hg directory of the clone, and valid as long as
+    the changelog tip and the local tags don't change. It is serialized with
+    marshal, so that branch and tag names stay byte strings, comparing
+    equal to those of the manifest and of Mercurial.
+
+    A read_only cache keeps the computed values in memory only, for the
+    commands that must not write anything.
+    """
+
+    def __init__(self, repo, read_only=False):
+        self.repo = repo
+        self.read_only = read_only
+        self.path = repo.join(CACHE_FILE)
+        self.data = None
+
+    def validity(self):
+        cl = self.repo.changelog
+        try:
+            st = os.stat(self.repo.join('localtags'))
+            localtags = [st.st_mtime, st.st_size]
+        except OSError:
+            localtags = None
+        return [hg_fullhex(cl.tip()), len(cl), localtags]
+
+    def load(self):
+        """Return the cached data, reset if not valid any more."""
+        validity = self.validity()
+        data = self.data
+        if data is not None and data['validity'] == validity:
+            return data
+
+        if data is None:
+            try:
+                f = open(self.path, 'rb')
+            except IOError:
+                pass
+            else:
+                try:
+                    try:
+                        data = marshal.load(f)
+                    except (EOFError, ValueError, TypeError):
+                        logger.warn("Ignoring corrupted cache file %s",
+                                    self.path)
+                finally:
+                    f.close()
+
+        if not isinstance(data, dict) or data.get('validity') != validity:
+            logger.debug("Resetting cache %s", self.path)
+            data = dict(validity=validity)
+        self.data = data
+        return data
+
+    def save(self):
+        if self.read_only:
+            return
+        tmp = self.path + '.tmp-%d' % os.getpid()
+        try:
+            f = open(tmp, 'wb')
+            try:
+                marshal.dump(self.data, f)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # could be a read-only clone: the cache is an optimization only
+            logger.debug("Could not write cache file %s", self.path)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def set(self, key, value):
+        self.load()[key] = value
+        self.save()
+
+    def cachedNodes(self, section, compute):
+        """Return a dict (name -> node) from section, computing if needed."""
+        data = self.load()
+        hexnodes = data.get(section)
+        if hexnodes is None:
+            hexnodes = data[section] = dict(
+                (name, hg_fullhex(node)) for name, node in compute().items())
+            self.save()
+        return dict((name, hg_bin(h)) for name, h in hexnodes.items())
+
+    def branchtags(self):
+        return self.cachedNodes('branchtags', self.repo.branchtags)
+
+    def tags(self):
+        return self.cachedNodes('tags', self.repo.tags)
+
+    def bundlemanChild(self, node, target, name, compute):
+        """Return the result of compute(node), cached for node, target, name.
+        """
+        data = self.load()
+        children = data.setdefault('bundleman', {})
+        key = ' '.join((hg_fullhex(node), target, name))
+        child = children.get(key)
+        if child is None:
+            child = children[key] = hg_fullhex(compute(node))
+            self.save()
+        return hg_bin(child)
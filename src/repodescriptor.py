@@ -22,14 +22,24 @@
 import os
 import re
 import sys
+import time
+import shutil
+import difflib
 import logging
 
 from mercurial import hg
 from mercurial import archival
-from mercurial import patch
+from mercurial import commands as hg_commands
+from mercurial import repair as hg_repair
 from mercurial.node import short as hg_hex
+from mercurial.node import hex as hg_fullhex
 from mercurial.node import nullid
 from mercurial import cmdutil as hg_cmdutil
+try:
+    from mercurial.error import LookupError as HgLookupError
+except ImportError:
+    # Mercurial < 1.2
+    from mercurial.revlog import LookupError as HgLookupError
 CMDUTIL_REMOTEUI = 'remoteui' in dir(hg_cmdutil)
 HG_REMOTEUI = 'remoteui' in dir(hg)
 CMDUTIL_SETREMOTE = 'setremoteui' in dir(hg_cmdutil)
@@ -41,6 +51,12 @@ import mercurial.ui
 from common import etree
 from common import _currentNodeRev
 from common import BranchNotFoundError
+from common import PushError
+from common import hardlink_tree
+from common import sha1
+from common import intern_str
+from repocache import RepoCache
+import repopool
 
 from bundleman.utils import parseNuxeoHistory
 
@@ -82,14 +98,56 @@ SEVERAL_PARENTS = 'several parents'
 
 BM_MERGE_RE = re.compile(r'^merging changes from \w+://')
 
-def make_clone(url, target_path):
+def make_clone(url, target_path, noupdate=False, revs=(), stream=False):
+    """Clone url to target_path and return the exit status.
+
+    If revs is not empty, the clone is restricted to these revisions and their
+    ancestors.
+    If stream is True, an uncompressed stream clone is requested. Mercurial
+    itself does an ordinary clone if the server lacks that capability. If the
+    stream clone fails anyway, we retry with an ordinary one.
+    """
     base_dir, target = os.path.split(target_path)
     if not os.path.isdir(base_dir):
-        os.mkdir(base_dir)
+        os.makedirs(base_dir)
     logger.debug("Cloning %s to %s", url, os.path.join(base_dir, target))
-    cmd = 'cd %s && hg clone %s %s' % (base_dir, url, target)
+    opts = noupdate and '-U ' or ''
+    opts += ''.join('-r %s ' % rev for rev in revs)
+    if stream and revs:
+        logger.debug("Stream clone not applicable to a restricted clone")
+        stream = False
+    if stream:
+        opts += '--uncompressed '
+    cmd = 'cd %s && hg clone %s%s %s' % (base_dir, opts, url, target)
     logger.debug(cmd)
-    os.system(cmd)
+    status = os.system(cmd)
+    if status and stream:
+        logger.warn("Stream clone of %s failed. Trying an ordinary clone.",
+                    url)
+        if os.path.exists(target_path):
+            shutil.rmtree(target_path)
+        return make_clone(url, target_path, noupdate=noupdate)
+    return status
+
+def added_lines(old, new):
+    """Return the lines of new that a diff from old would show as added."""
+    prefix_len = len(new) - len(old)
+    if new.endswith(old) and (prefix_len == 0 or new[prefix_len-1] == '\n'):
+        # usual case for HISTORY files: new sections on top
+        return new[:prefix_len].splitlines()
+
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    added = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('insert', 'replace'):
+            added.extend(new_lines[j1:j2])
+    return added
+
+def peer(url):
+    """Return a repository object for the remote url."""
+    return hg.repository(HG_UI, url)
 
 def repo_add(repo, fnames):
     """Add files to the given hg repository.
@@ -107,32 +165,47 @@ def repo_add(repo, fnames):
 
 class RepoDescriptor(object):
 
+    # bundles can have thousands of descriptors: no instance dict, and
+    # strings are interned, since most of them are repeated in other
+    # descriptors or bundles
+    __slots__ = ('remote_url', 'remote_url_push', 'stream', 'target',
+                 'bundle_dir', 'name', 'from_include', 'xml_attrs', 'is_sub',
+                 'subpath', 'clone_target', 'local_path_rel', 'cache',
+                 'cache_read_only', 'release_start')
+
     def __init__(self, remote_url, bundle_dir, target, name, attrs,
-                 from_include=False, remote_url_push=None):
+                 from_include=False, remote_url_push=None, stream=False):
         # name is an additional name to qualify used by subclasses
-        self.remote_url = remote_url
-        self.remote_url_push = remote_url_push
-        self.target = target
-        self.bundle_dir = bundle_dir
-        self.name = name
+        self.remote_url = intern_str(remote_url)
+        self.remote_url_push = intern_str(remote_url_push)
+        self.stream = stream
+        self.target = target = intern_str(target)
+        self.bundle_dir = intern_str(bundle_dir)
+        self.name = intern_str(name)
         self.from_include = from_include
 
         # TODO keep only xml attrs that are not redundant with this object
         # attributes to avoid confusion
-        self.xml_attrs = dict(attrs)
+        self.xml_attrs = dict((intern_str(k), intern_str(v))
+                              for k, v in attrs.items())
         subpath = attrs.get('subpath')
         if subpath is None:
             self.is_sub = False
             self.local_path_rel = target
         else:
             self.is_sub = True
-            self.subpath = subpath
-            self.clone_target = self.remote_url.rsplit('/')[-1]
-            self.local_path_rel = os.path.join(ASIDE_REPOS, self.clone_target)
+            self.subpath = intern_str(subpath)
+            self.clone_target = intern_str(self.remote_url.rsplit('/')[-1])
+            self.local_path_rel = intern_str(
+                os.path.join(ASIDE_REPOS, self.clone_target))
 
-        self.local_path = os.path.join(self.bundle_dir, self.local_path_rel)
+        self.cache = None # see getCache()
+        self.cache_read_only = False
+        self.release_start = None # see Branch.commitRelease()
 
-        self.repo = None # Mercurial repo (could not exist yet on fs)
+    @property
+    def local_path(self):
+        return os.path.join(self.bundle_dir, self.local_path_rel)
 
     def getAsideRepoPath(self):
         """Find the path to repo if it's aside (subpath situation)"""
@@ -170,29 +243,58 @@ class RepoDescriptor(object):
 
         return src, dest, clone
 
-    def make_clone(self):
-        """Make the clone if needed and return True if done."""
+    def make_clone(self, minimal=False, node=None):
+        """Make the clone if needed and return True if done.
+
+        If minimal is True, the clone is restricted to what's needed for the
+        update: the given node if any, or what cloneRevs() tells.
+        The rest can be pulled later on."""
 
         if os.path.exists(self.local_path):
             logger.debug("Ignoring the existing clone %s", self.local_path_rel)
         else:
             logger.info("Creating clone %s", self.local_path_rel)
-            make_clone(self.remote_url, self.local_path)
+            if not minimal:
+                revs = ()
+            elif node is not None:
+                revs = (hg_fullhex(node),)
+            else:
+                revs = self.cloneRevs()
+            make_clone(self.remote_url, self.local_path, revs=revs,
+                       stream=self.stream)
+            if revs and node is None:
+                self.completeClone(revs)
             if self.remote_url_push:
                 self.updateUrls()
 
-        if self.is_sub:
-            target_path = os.path.join(self.bundle_dir, self.target)
-            if os.path.exists(target_path):
-                logger.debug("Ignoring the existing target path %s",
-                             self.target)
-                return False
+        return self.makeSubLink()
+
+    def cloneRevs(self):
+        """Return the remote revisions a minimal clone must contain.
+
+        Empty means the whole repository."""
+        return ()
 
-            logger.info("Extracting to %s", self.target)
-            src, target_path, _ = self.subSrcDest()
-            logger.debug("Making symlink %s -> %s", target_path, src)
-            os.symlink(src, target_path)
+    def completeClone(self, revs):
+        """Called after a clone restricted to revs."""
 
+    def makeSubLink(self):
+        """Symlink the subpath to the target if needed and return True if done.
+
+        Always True if not a sub repo."""
+        if not self.is_sub:
+            return True
+
+        target_path = os.path.join(self.bundle_dir, self.target)
+        if os.path.exists(target_path):
+            logger.debug("Ignoring the existing target path %s",
+                         self.target)
+            return False
+
+        logger.info("Extracting to %s", self.target)
+        src, target_path, _ = self.subSrcDest()
+        logger.debug("Making symlink %s -> %s", target_path, src)
+        os.symlink(src, target_path)
         return True
 
     def release(self):
@@ -227,13 +329,17 @@ class RepoDescriptor(object):
             f.write('%s-%s\n\n' % (v, r))
             f.close()
 
-    def archive(self, output_dir):
+    def extract(self, dest, cache=None):
+        """Extract the files of the tip to dest."""
         repo = self.getRepo()
+        archival.archive(repo, dest, self.tip(),
+                         'files', True, hg_cmdutil.match(repo, []))
+
+    def archive(self, output_dir, cache=None):
         dest = os.path.join(output_dir, self.local_path_rel)
         logger.info("Extracting %s (%s) to %s",
                     self.local_path_rel, self.getName(), dest)
-        archival.archive(repo, dest, self.tip(),
-                         'files', True, hg_cmdutil.match(repo, []))
+        self.extract(dest, cache=cache)
 
         self.updateVersionFilesInArchive(dest)
 
@@ -250,20 +356,112 @@ class RepoDescriptor(object):
             os.system(cmd)
 
     def getRepo(self):
-        """Return mercurial repo object.
+        """Return mercurial repo object, from the repository pool.
         Raise an error if repo can't be found"""
-        if self.repo is None:
-            self.repo = hg.repository(HG_UI, self.local_path)
-        return self.repo
+        return repopool.pool.get(HG_UI, self.local_path)
 
-    def update(self):
-        """Update to named branch/tag if any, or to the default one."""
+    def getCache(self):
+        """Return the persistent cache for the clone (see RepoCache).
 
-        node = self.tip()
+        The cache is read-only if the cache_read_only attribute is set."""
+        repo = self.getRepo()
+        cache = self.cache
+        if (cache is None or cache.repo is not repo
+            or cache.read_only != self.cache_read_only):
+            self.cache = cache = RepoCache(repo,
+                                           read_only=self.cache_read_only)
+        return cache
+
+    def statSignature(self):
+        """Return a hash of stat info of the dirstate and tracked files.
+
+        Return None if this can't be trusted: missing files or files changed
+        too recently to be distinguished by their mtime.
+        """
+        repo = self.getRepo()
+        now = time.time()
+        h = sha1()
+        try:
+            st = os.stat(repo.join('dirstate'))
+        except OSError:
+            return None
+        h.update('%d %d\n' % (st.st_mtime, st.st_size))
+        for f in repo.dirstate:
+            try:
+                st = os.lstat(repo.wjoin(f))
+            except OSError:
+                return None
+            if st.st_mtime >= now - 1:
+                return None
+            h.update('%s %d %d\n' % (f, st.st_mtime, st.st_size))
+        return h.hexdigest()
+
+    def hasLocalChanges(self):
+        """True if there are uncommited changes in the working directory.
+
+        The full status walk is skipped if the dirstate and tracked files
+        still have the stat signature they had when the clone was last found
+        clean.
+        """
+        cache = self.getCache()
+        signature = self.statSignature()
+        if signature is not None and signature == cache.get('clean_stat'):
+            logger.debug("Clone %s unchanged since last found clean",
+                         self.local_path_rel)
+            return False
+
+        for x in self.getRepo().status():
+            if x:
+                return True
+
+        # status can update the dirstate
+        cache.set('clean_stat', self.statSignature())
+        return False
+
+    def localState(self):
+        """Return a dict describing the working directory of the clone.
+
+        Node is the (first) parent, merge tells if there's a second one."""
+        ctx = self.getRepo().changectx(None)
+        parents = ctx.parents()
+        return dict(node=hg_fullhex(parents[0].node()),
+                    merge=len(parents) > 1,
+                    branch=ctx.branch(),
+                    dirty=self.hasLocalChanges())
+
+    def update(self, node=None):
+        """Update to named branch/tag if any, or to the default one.
+
+        If node is specified (e.g., from a lock file), no resolution occurs
+        and the node gets pulled if missing in the clone."""
+
+        if node is None:
+            node = self.tip()
+            name = self.getName()
+        else:
+            self.fetchNode(node)
+            name = 'locked'
         logger.info("Updating %s to node %s (%s)", self.local_path_rel,
-                    hg_hex(node), self.getName())
+                    hg_hex(node), name)
         hg.update(self.getRepo(), node)
 
+    def pullFrom(self, source, update=False):
+        """Pull from source (typically a local clone) and possibly update."""
+        repo = self.getRepo()
+        logger.debug("Pulling %s from %s", self.local_path_rel, source)
+        hg_commands.pull(repo.ui, repo, source=source)
+        if update:
+            self.update()
+
+    def fetchNode(self, node):
+        """Pull the given node from remote url if not already in the clone."""
+        repo = self.getRepo()
+        if node in repo.changelog.nodemap:
+            return
+        logger.info("Pulling node %s in %s", hg_hex(node), self.local_path_rel)
+        hg_commands.pull(HG_UI, repo, source=self.remote_url,
+                         rev=[hg_fullhex(node)])
+
     def writeHgrcPaths(self):
         """Write the paths registered in config object to hgrc."""
         hgrc = os.path.join(self.local_path, '.hg', 'hgrc')
@@ -309,33 +507,75 @@ class RepoDescriptor(object):
     def tip(self):
         raise NotImplementedError()
 
+    def remoteNode(self):
+        """Resolve the descriptor on the remote url, without any clone."""
+        raise NotImplementedError()
+
     def outgoing(self):
         raise NotImplementedError()
 
+    def incoming(self):
+        raise NotImplementedError()
+
+    def exchangeCounts(self):
+        """Return the counts of outgoing() and incoming() together."""
+        raise NotImplementedError()
+
+    def pushUrl(self):
+        return self.remote_url_push or self.remote_url
+
     def getName(self):
         return 'no applicable name'
 
-    def changelog(self, rev1, rev2):
+    def changelog(self, rev1, rev2, cache=None):
         """Return parsed changelog between rev1 and rev2.
 
-        Usually, rev1 and rev2 would be tag names
+        Usually, rev1 and rev2 would be tag names.
+        The result is looked up in and stored to cache (a DiskCache instance)
+        if specified.
         """
 
         repo = self.getRepo()
         node1, node2 = hg_cmdutil.revpair(repo, (rev1, rev2))
-        opts = {}
-        m = hg_cmdutil.match(repo, pats=('path:HISTORY',))
+        if cache is None:
+            return self.parseChangelog(node1, node2)
+
+        key = (self.remote_url, hg_fullhex(node1), hg_fullhex(node2))
+        parsed = cache.get(key)
+        if parsed is None:
+            parsed = self.parseChangelog(node1, node2)
+            cache.set(key, parsed)
+        else:
+            logger.debug("Changelog for %s between %s and %s found in cache",
+                         self.local_path_rel, rev1, rev2)
+        return parsed
+
+    def parseChangelog(self, node1, node2):
+        """Return parsed changelog between the two nodes.
 
-        diffopts = patch.diffopts(repo.ui)
-        diff = []
-        for l in patch.diff(repo, node1, node2, match=m, opts=diffopts):
-            diff.extend([line[1:] for line in l.split('\n')
-                         if line.startswith('+') and not line.startswith('++')])
-        return parseNuxeoHistory('\n'.join(diff))
+        The HISTORY file revisions are read from the filelog, and the added
+        lines computed in-process."""
+        old = self.fileData(node1, 'HISTORY')
+        new = self.fileData(node2, 'HISTORY')
+        return parseNuxeoHistory('\n'.join(added_lines(old, new)))
+
+    def fileData(self, node, path):
+        """Return the contents of file at path for node, empty if missing."""
+        try:
+            return self.getRepo().changectx(node).filectx(path).data()
+        except HgLookupError:
+            return ''
 
 class Tag(RepoDescriptor):
 
+    __slots__ = ()
+
     def releaseCheck(self, **kw):
+        if self.isExported():
+            logger.info("Target %s is an export of tag %s. Nothing to check.",
+                        self.target, self.name)
+            return
+
         ctx = self.getRepo()[None]
         parents = ctx.parents()
         if len(parents) != 1:
@@ -352,10 +592,104 @@ class Tag(RepoDescriptor):
     def getName(self):
         return self.name
 
-    def nodeIfBundleman(self, node):
+    def isExported(self):
+        """True if materialized as a plain file tree (see export())."""
+        return (os.path.isdir(self.local_path) and
+                not os.path.isdir(os.path.join(self.local_path, '.hg')))
+
+    def exportedNode(self):
+        """Return the full hex node of an export, read from archival file.
+
+        Return None if that can't be found."""
+        try:
+            f = open(os.path.join(self.local_path, '.hg_archival.txt'))
+        except IOError:
+            return None
+        lines = f.readlines()
+        f.close()
+        for line in lines:
+            if line.startswith('node:'):
+                return line.split(':', 1)[1].strip()
+
+    def export(self, cache, node=None):
+        """Materialize the tag as a plain file tree, through the export cache.
+
+        Existing clones are left alone, existing exports are replaced if the
+        tag points to another node. Return True if the export has been done.
+        The node can be specified to skip tag resolution (lock files).
+        """
+        if os.path.exists(self.local_path) and not self.isExported():
+            logger.info("Keeping the existing clone %s instead of an export",
+                        self.local_path_rel)
+            return False
+
+        if node is None:
+            node = self.tip(repo=cache.mirror(self.remote_url))
+        if os.path.exists(self.local_path):
+            if self.exportedNode() == hg_fullhex(node):
+                logger.debug("Export %s already at tag %s",
+                             self.local_path_rel, self.name)
+                return False
+            logger.info("Replacing export %s by tag %s",
+                        self.local_path_rel, self.name)
+            shutil.rmtree(self.local_path)
+
+        logger.info("Exporting %s at tag %s (node %s)", self.local_path_rel,
+                    self.name, hg_hex(node))
+        hardlink_tree(cache.export(self.remote_url, node), self.local_path)
+        self.makeSubLink()
+        return True
+
+    def extract(self, dest, cache=None):
+        """Extract from the export cache if there's no clone to work on."""
+        if cache is None or not self.isExported():
+            return RepoDescriptor.extract(self, dest)
+
+        node = self.tip(repo=cache.mirror(self.remote_url))
+        shutil.copytree(cache.export(self.remote_url, node), dest,
+                        symlinks=True)
+
+    def cloneRevs(self):
+        return (hg_fullhex(self.remoteNode()),)
+
+    def remoteNode(self):
+        """Return the tag node, as seen by the remote url.
+
+        This is not the bundleman child (see #2143), but the latter is a
+        function of the former."""
+        return peer(self.remote_url).lookup(self.name)
+
+    def completeClone(self, revs):
+        """Make the tag usable in the restricted clone.
+
+        The tag commit being a descendant of the tag, the tag is missing
+        from .hgtags: record it as a local tag.
+        In case of conversions from subversion, the bundleman child (see #2143)
+        is also a descendant. We get it by pulling the branch of the tag.
+        """
+        repo = self.getRepo()
+        node = repo.lookup(revs[0])
+        if self.name not in repo.tags():
+            logger.debug("Recording local tag %s in %s", self.name,
+                         self.local_path_rel)
+            f = repo.opener('localtags', 'a')
+            f.write('%s %s\n' % (hg_fullhex(node), self.name))
+            f.close()
+
+        ctx = repo.changectx(node)
+        if ctx.extra().get('convert_revision', '').startswith('svn:'):
+            logger.info("Pulling branch %s in %s to look for bundleman child "
+                        "of converted tag %s", ctx.branch(),
+                        self.local_path_rel, self.name)
+            hg_commands.pull(HG_UI, repo, source=self.remote_url,
+                             rev=[ctx.branch()])
+
+    def nodeIfBundleman(self, node, repo=None):
         """If tag has been done by bundleman, return child. See #2143
         """
-        tag_ctx = self.repo.changectx(node)
+        if repo is None:
+            repo = self.getRepo()
+        tag_ctx = repo.changectx(node)
         children = tag_ctx.children()
         if not children:
             # not a bundleman tag
@@ -372,7 +706,7 @@ class Tag(RepoDescriptor):
 
         return node
 
-    def tip(self):
+    def tip(self, repo=None):
         """Cheating with terminology: in that case that's just the tag node.
 
         In the special case of bundleman made tags (see #2143)
@@ -380,8 +714,15 @@ class Tag(RepoDescriptor):
         before update of version files, because bundleman changed them later
         in the svn tag itself.
         Therefore, we need to go to the child (merge from the tag).
+
+        The tag is looked up in the clone, unless another repo is specified.
         """
-        tags = self.getRepo().tags()
+        own = repo is None
+        if own:
+            repo = self.getRepo()
+            tags = self.getCache().tags()
+        else:
+            tags = repo.tags()
         name = self.name
 
         try:
@@ -390,7 +731,11 @@ class Tag(RepoDescriptor):
             raise ValueError("Tag '%s' not found in repo %s", name,
                              self.local_path_rel)
 
-        return self.nodeIfBundleman(node)
+        if own:
+            return self.getCache().bundlemanChild(
+                node, self.target, name,
+                lambda n: self.nodeIfBundleman(n, repo=repo))
+        return self.nodeIfBundleman(node, repo=repo)
 
     def xml(self):
         t = etree.Element('tag')
@@ -402,8 +747,17 @@ class Tag(RepoDescriptor):
         """By definition, a tag has nothing to push."""
         return 0, None
 
+    def incoming(self):
+        """Tags don't follow their source."""
+        return 0, None
+
+    def exchangeCounts(self):
+        return 0, 0
+
 class Branch(RepoDescriptor):
 
+    __slots__ = ()
+
     def getName(self):
         """Return name, after infering it if necessary."""
 
@@ -413,15 +767,22 @@ class Branch(RepoDescriptor):
 
         # implicit specification (unique branch, or 'default')
         # mercurial has a cache for this (costly) dict (branch name) -> tip
-        branches = self.getRepo().branchtags()
-        logger.debug("Found branches: %s", branches.keys())
+        # we add ours on top of that, to spare the repeated computations
+        branches = self.getCache().branchtags()
+        name = self.inferName(branches.keys())
+        self.name = name
+        return name
+
+    def inferName(self, branches):
+        """Infer the branch name from the list of all branch names."""
+        logger.debug("Found branches: %s", branches)
 
         if len(branches) > 1:
             logger.debug(
                 "No specified branch, found several, trying 'default'")
             name = 'default'
         else:
-            name = branches.keys()[0]
+            name = branches[0]
             logger.debug("Using the unique branch '%s" % name)
 
         # final check
@@ -429,10 +790,46 @@ class Branch(RepoDescriptor):
             raise ValueError((
                 "Wrong specified or guessed branch '%s' for %s."
                 "Please specify an existing one") % (name, self.local_path_rel))
-
-        self.name = name
         return name
 
+    def cloneRevs(self):
+        """The branch, whose name is inferred from the remote if needed."""
+        name = self.name
+        if name is None:
+            try:
+                branches = peer(self.remote_url).branchmap().keys()
+            except AttributeError:
+                logger.warn("Can't infer the branch remotely for %s with "
+                            "this Mercurial version. Full clone.",
+                            self.local_path_rel)
+                return ()
+            name = self.inferName(branches)
+        return (name,)
+
+    def remoteNode(self):
+        """Return the tip of the branch, as seen by the remote url."""
+        other = peer(self.remote_url)
+        name = self.name
+        if name is None:
+            name = self.inferName(other.branchmap().keys())
+        return other.lookup(name)
+
+    def push(self, dest=None):
+        """Push the branch to dest (defaults to the push url).
+
+        Mercurial reports many failures (new heads refused, nothing pushed)
+        through the return status only: PushError is raised in that case.
+        """
+        if dest is None:
+            dest = self.pushUrl()
+        repo = self.getRepo()
+        logger.info("Pushing %s to %s", self.local_path_rel, dest)
+        status = hg_commands.push(repo.ui, repo, dest=dest,
+                                  rev=[hg_fullhex(self.tip())])
+        if status:
+            raise PushError("Push of %s to %s failed (status %r)" % (
+                    self.local_path_rel, dest, status))
+
     def checkLocalRepo(self):
         """Ensure that there are no local changes.
         TODO: if there are several branch and we're not on tip, this shows
@@ -448,12 +845,17 @@ class Branch(RepoDescriptor):
                          self.local_path_rel, current_branch, self.name)
             raise RepoReleaseError(WRONG_BRANCH)
 
-        st = repo.status()
-        for x in st:
-            if x:
-                logger.error("Uncommited changes in %s. Aborting.",
-                             self.local_path_rel)
-                raise RepoReleaseError(LOCAL_CHANGES)
+        if self.hasLocalChanges():
+            logger.error("Uncommited changes in %s. Aborting.",
+                         self.local_path_rel)
+            raise RepoReleaseError(LOCAL_CHANGES)
+
+    def releaseCheck(self, multiple_heads=False, **kw):
+        """Run the checks needed before release. See also StatusEngine."""
+        if not self.isHgBundlerManaged():
+            return
+        self.checkLocalRepo()
+        self.checkHeads(allow_multiple=multiple_heads)
 
     def isHgBundlerManaged(self):
         """True if the releases for this repo are managed through Hg Bundler"""
@@ -482,7 +884,7 @@ class Branch(RepoDescriptor):
                              name, self.local_path_rel)
                 raise RepoReleaseError(MULTIPLE_HEADS)
 
-        node, _ = _currentNodeRev(self.repo)
+        node, _ = _currentNodeRev(self.getRepo())
         if node not in heads:
             logger.error("Current node %s on branch %s of %s "
                          "not a head. Aborting.",
@@ -490,44 +892,138 @@ class Branch(RepoDescriptor):
             raise RepoReleaseError(NOT_HEAD)
 
     def release(self, multiple_heads=False, release_again=False,
-                increment_major=False):
+                increment_major=False, check=True):
+        """Release the clone.
+
+        Set check to False if releaseCheck has already been called."""
+        prepared = self.prepareRelease(multiple_heads=multiple_heads,
+                                       release_again=release_again,
+                                       increment_major=increment_major,
+                                       check=check)
+        if prepared is None:
+            return
+        return self.commitRelease(prepared)
+
+    def prepareRelease(self, multiple_heads=False, release_again=False,
+                       increment_major=False, check=True):
+        """First phase of release: checks and new version, without writes.
+
+        Return None if there's nothing to release, or an object to pass to
+        commitRelease().
+        """
         if not self.isHgBundlerManaged():
             logger.info("Does not look to be managed by hgbundler : %s",
                         self.local_path_rel)
             return
 
-        name = self.getName()
-        self.checkLocalRepo()
-        self.checkHeads(allow_multiple=multiple_heads)
+        if check:
+            self.releaseCheck(multiple_heads=multiple_heads)
         releaser = Releaser(self, release_again=release_again,
                             increment_major=increment_major)
 
         to_tag = releaser.newVersion()
         if to_tag is None:
             return
+        return releaser, to_tag
+
+    def planRelease(self, multiple_heads=False, increment_major=False,
+                    read_only=False):
+        """Dry run of release: checks and new version, without any write.
+
+        Return a dict describing what release would do. Its 'action' is
+        'release' (new version and tag), 'tag' (tag the current version),
+        'existing' (use the existing tag of the current version) or None.
+        If read_only is set, the cache of the clone isn't written either,
+        from now on.
+        """
+        if read_only:
+            self.cache_read_only = True
+        self.releaseCheck(multiple_heads=multiple_heads)
+        plan = dict(target=self.target, branch=self.getName(), action=None,
+                    current=None, tag=None, bump=None)
+        prepared = self.prepareRelease(increment_major=increment_major,
+                                       check=False)
+        if prepared is None:
+            return plan
+
+        releaser, to_tag = prepared
+        plan['current'] = releaser.version_str
+        if to_tag is True:
+            plan.update(action='release', tag=releaser.version_new[0],
+                        bump=releaser.bump)
         elif to_tag:
+            plan.update(action='tag', tag=releaser.version_str)
+        else:
+            plan.update(action='existing', tag=releaser.version_str)
+        return plan
+
+    def commitRelease(self, prepared):
+        """Second phase of release: version files, commits and tag.
+
+        Return the Tag descriptor of the release. If something goes wrong,
+        rollbackRelease() can be called.
+        """
+        releaser, to_tag = prepared
+        # the pool could give another repo object: stick to the releaser's
+        repo = releaser.repo
+        created = ()
+        if to_tag and releaser.initial:
+            # these would stay as unknown files after a rollback
+            created = [f for f in ('VERSION', 'HISTORY', 'CHANGES')
+                       if not os.path.exists(os.path.join(self.local_path, f))]
+        self.release_start = (len(repo.changelog), _currentNodeRev(repo)[0],
+                              created)
+        if to_tag:
             logger.info("Performing release of branch %s for %s",
-                        name, self.local_path_rel)
+                        self.getName(), self.local_path_rel)
             releaser.updateVersionFiles()
             if releaser.initial:
-                repo_add(self.getRepo(), ('VERSION', 'HISTORY'))
-            self.getRepo().commit(
-                text="hgbundler prepared version files for release")
+                repo_add(repo, ('VERSION', 'HISTORY'))
+            repo.commit(text="hgbundler prepared version files for release")
             tag_str = releaser.tag()
             releaser.initChangesFile()
             if releaser.initial:
-                repo_add(self.getRepo(), ('CHANGES',))
-            self.getRepo().commit(text="hgbundler init new CHANGES file")
+                repo_add(repo, ('CHANGES',))
+            repo.commit(text="hgbundler init new CHANGES file")
         else:
             tag_str = releaser.version_str
 
         return Tag(self.remote_url, self.bundle_dir, self.target, tag_str,
                        self.xml_attrs)
 
+    def releaseNodes(self):
+        """Return the nodes of the changesets made by commitRelease."""
+        start = self.release_start
+        if start is None:
+            return ()
+        cl = self.getRepo().changelog
+        return [cl.node(rev) for rev in xrange(start[0], len(cl))]
+
+    def rollbackRelease(self):
+        """Strip the changesets of commitRelease and revert the files.
+
+        The version files created by an initial release are removed."""
+        start = self.release_start
+        if start is None:
+            return
+        count, node, created = start
+        repo = self.getRepo()
+        if len(repo.changelog) > count:
+            logger.warn("Stripping release changesets from %s",
+                        self.local_path_rel)
+            hg_repair.strip(repo.ui, repo, repo.changelog.node(count),
+                            backup='none')
+        hg.clean(repo, node)
+        for f in created:
+            path = os.path.join(self.local_path, f)
+            if os.path.exists(path):
+                os.remove(path)
+        self.release_start = None
+
     def tip(self):
         """Return the tip of this branch."""
         try:
-            return self.getRepo().branchtags()[self.getName()]
+            return self.getCache().branchtags()[self.getName()]
         except KeyError:
             logger.error("Branch %s not found in repository %s ",
                          self.getName(), self.local_path_rel)
@@ -543,35 +1039,101 @@ class Branch(RepoDescriptor):
         Adapted from mercurial.commands to produce no output.
         """
         repo = self.getRepo()
-        ui = repo.ui
-        old_quiet = ui.quiet
+        dest = self.outgoingDest(repo, opts)
+
+        def find():
+            other = self.otherRepo(repo, dest, opts)
+            return self.findOutgoing(repo, other, force=opts.get('force'))
+        return len(self.quietCall(repo, find)), dest
+
+    def incoming(self, **opts):
+        """Tell how many changeset subtrees of the source are not in the clone
+
+        Counterpart of outgoing().
+        """
+        repo = self.getRepo()
+        source = repo.ui.expandpath('default')
+
+        def find():
+            other = self.otherRepo(repo, source, opts)
+            return self.findIncoming(repo, other, force=opts.get('force'))
+        return len(self.quietCall(repo, find)), source
+
+    def exchangeCounts(self, **opts):
+        """Return the counts of outgoing() and incoming() together.
+
+        If the push destination is the source, as usual, this takes a single
+        remote repository and discovery: outgoing changesets are deduced
+        from the common nodes found while looking for incoming ones.
+        """
+        repo = self.getRepo()
+        force = opts.get('force')
+        source = repo.ui.expandpath('default')
+        dest = self.outgoingDest(repo, opts)
+
+        def find():
+            other = self.otherRepo(repo, source, opts)
+            base = {}
+            i = self.findIncoming(repo, other, base=base, force=force)
+            if dest != source:
+                other = self.otherRepo(repo, dest, opts)
+                base = None
+            o = self.findOutgoing(repo, other, base=base, force=force)
+            return len(o), len(i)
+        return self.quietCall(repo, find)
+
+    def quietCall(self, repo, func):
+        """Call func with repo using a quiet copy of its ui.
+
+        The ui object of repo itself is left untouched. The repo object is
+        used by the current thread only (see repopool)."""
+        ui = repo.ui.copy()
         ui.quiet = True
-        limit = hg_cmdutil.loglimit(opts)
+        saved = repo.ui
+        repo.ui = ui
+        try:
+            return func()
+        finally:
+            repo.ui = saved
+
+    def outgoingDest(self, repo, opts):
         parsed = hg.parseurl(
-            ui.expandpath('default-push', 'default'), opts.get('rev'))
+            repo.ui.expandpath('default-push', 'default'), opts.get('rev'))
         if len(parsed) == 2:
             dest, (revs, checkout) = parsed
         else:
             dest, revs, checkout = parsed
+        return dest
 
-        if revs:
-            revs = [repo.lookup(rev) for rev in revs]
-        if CMDUTIL_REMOTEUI:
-            other = hg.repository(hg_cmdutil.remoteui(repo, opts), dest)
-        elif CMDUTIL_SETREMOTE:
-            hg_cmdutil.setremoteconfig(ui, opts)
-            other = hg.repository(ui, dest)
-        elif HG_REMOTEUI:
-            other = hg.repository(hg.remoteui(repo, opts), dest)
-        else:
-            logger.critical("Problem on this Mercurial version")
-            sys.exit(1)
+    def findIncoming(self, repo, other, base=None, force=False):
+        """Return the roots of incoming subtrees, filling base if specified
+        with the nodes known to be common."""
+        if HG_REMOTEUI:
+            from mercurial import discovery
+            return discovery.findincoming(repo, other, base=base,
+                                          force=force)
+        return repo.findincoming(other, base=base, force=force)
+
+    def findOutgoing(self, repo, other, base=None, force=False):
+        """Return the roots of outgoing changesets.
 
+        Discovery is skipped if base is the result of findIncoming()."""
         if HG_REMOTEUI:
             from mercurial import discovery
-            o = discovery.findoutgoing(repo, other, force=opts.get('force'))
-        else:
-            o = repo.findoutgoing(other, force=opts.get('force'))
-        ui.quiet = old_quiet
-        return len(o), dest
+            return discovery.findoutgoing(repo, other, base=base,
+                                          force=force)
+        return repo.findoutgoing(other, base=base, force=force)
+
+    def otherRepo(self, repo, url, opts):
+        """Return the remote repo object for url, across Mercurial versions.
+        """
+        if CMDUTIL_REMOTEUI:
+            return hg.repository(hg_cmdutil.remoteui(repo, opts), url)
+        elif CMDUTIL_SETREMOTE:
+            hg_cmdutil.setremoteconfig(repo.ui, opts)
+            return hg.repository(repo.ui, url)
+        elif HG_REMOTEUI:
+            return hg.repository(hg.remoteui(repo, opts), url)
+        logger.critical("Problem on this Mercurial version")
+        sys.exit(1)
 
@@ -0,0 +1,172 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Process-wide pool of Mercurial repository objects.
+
+Repository objects keep changelogs, manifests, dirstates and tags in
+memory. The pool bounds their number and estimated memory, evicting
+the least recently used ones, and opens a repository again when it has
+changed on disk since it has been opened.
+
+Repository objects are not thread-safe: each one is used by a single
+thread. Repositories of finished threads, such as the workers of a previous
+pool_map(), are handed over to the next thread asking for them.
+
+Commands iterate over all clones of a bundle, often several times: with
+less room than clones, LRU would evict each repository before its next
+use. Bundles therefore reserve room for all their clones, and only the
+memory budget limits that.
+"""
+
+import os
+import threading
+import logging
+
+from mercurial import hg
+
+from constants import REPO_POOL_SIZE, REPO_POOL_MEMORY
+
+logger = logging.getLogger('hgbundler.repopool')
+
+# files whose changes invalidate the repository object, relative to .hg
+WATCHED_FILES = ('store/00changelog.i', '00changelog.i', 'dirstate',
+                 'localtags', 'branch', 'hgrc')
+# the in-memory indexes, whose sizes estimate the memory of a repo
+INDEX_FILES = ('store/00changelog.i', 'store/00manifest.i',
+               '00changelog.i', '00manifest.i')
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+class RepoPool(object):
+
+    def __init__(self, max_repos=REPO_POOL_SIZE,
+                 max_memory=REPO_POOL_MEMORY):
+        self.min_repos = self.max_repos = max_repos
+        self.max_memory = max_memory
+        self.reservations = {} # key (e.g., bundle dir) -> number of repos
+        self.entries = {} # (thread, path) -> (repo, signature, cost)
+        self.lru = [] # keys of entries, the most recently used last
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def signature(self, path):
+        hg_dir = os.path.join(path, '.hg')
+        return tuple(_stat(os.path.join(hg_dir, f)) for f in WATCHED_FILES)
+
+    def cost(self, path):
+        hg_dir = os.path.join(path, '.hg')
+        return sum([(_stat(os.path.join(hg_dir, f)) or (0, 0))[1]
+                    for f in INDEX_FILES])
+
+    def get(self, ui, path):
+        """Return the repository object for path, opening it if needed.
+
+        The object is for the current thread only."""
+        path = os.path.abspath(path)
+        key = threading.currentThread(), path
+        signature = self.signature(path)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key) or self.adopt(key)
+            if entry is not None:
+                self.lru.remove(key)
+                if entry[1] == signature:
+                    self.lru.append(key)
+                    return entry[0]
+                logger.debug("Repository %s changed on disk", path)
+                self.memory -= entry[2]
+                del self.entries[key]
+        finally:
+            self.lock.release()
+
+        # opening reads the changelog index: don't block other threads
+        repo = hg.repository(ui, path)
+        cost = self.cost(path)
+
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                # keys are per thread, but stay exact in any case
+                self.lru.remove(key)
+                self.memory -= entry[2]
+            self.entries[key] = repo, signature, cost
+            self.lru.append(key)
+            self.memory += cost
+            self.evict()
+            return repo
+        finally:
+            self.lock.release()
+
+    def adopt(self, key):
+        """Hand an entry of a finished thread for the same path over to key.
+
+        Return the entry, or None. The lock must be held."""
+        path = key[1]
+        for i in range(len(self.lru) - 1, -1, -1):
+            other = self.lru[i]
+            if other[1] == path and not other[0].isAlive():
+                entry = self.entries.pop(other)
+                self.entries[key] = entry
+                self.lru[i] = key
+                return entry
+
+    def reserve(self, key, count):
+        """Make room for count repositories on behalf of key.
+
+        The number bound becomes the sum of reservations, if greater than
+        the initial one. A new reservation with the same key replaces the
+        previous one."""
+        self.lock.acquire()
+        try:
+            self.reservations[key] = count
+            self.max_repos = max(self.min_repos,
+                                 sum(self.reservations.values()))
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """Evict least recently used repositories to stay in the bounds.
+
+        The number bound applies to distinct paths, whatever the number of
+        threads using them. The most recently used one is always kept."""
+        while len(self.lru) > 1 and (
+            len(set([path for _, path in self.lru])) > self.max_repos
+            or self.memory > self.max_memory):
+            key = self.lru.pop(0)
+            logger.debug("Evicting repository %s from pool", key[1])
+            self.memory -= self.entries.pop(key)[2]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            del self.lru[:]
+            self.memory = 0
+            self.reservations.clear()
+            self.max_repos = self.min_repos
+        finally:
+            self.lock.release()
+
+pool = RepoPool()
@@ -0,0 +1,194 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Batch checks of the state of many clones."""
+
+import os
+import logging
+
+from mercurial.node import hex as hg_fullhex
+
+from common import pool_map
+from repodescriptor import Tag
+from constants import DEFAULT_JOBS
+from releaser import RepoReleaseError
+import watcher
+
+logger = logging.getLogger('hgbundler.statusengine')
+
+class StatusEngine(object):
+    """Runs checks on a set of descriptors with a pool of worker threads.
+
+    Instead of aborting on the first problem, the complete list of problems
+    is returned.
+    """
+
+    def __init__(self, jobs=DEFAULT_JOBS):
+        self.jobs = jobs
+
+    def releaseProblems(self, descs, multiple_heads=False):
+        """Run releaseCheck() on all descs.
+
+        Return the list of (descriptor, problem) pairs, problem being the
+        message of the RepoReleaseError (e.g, LOCAL_CHANGES) or of an
+        unexpected error.
+        """
+        def check(desc):
+            logger.debug("Checking %s", desc.local_path_rel)
+            try:
+                desc.releaseCheck(multiple_heads=multiple_heads)
+            except RepoReleaseError, e:
+                return str(e) or 'release check failed'
+
+        problems = []
+        results = pool_map(check, descs, jobs=self.jobs)
+        for desc, (problem, exc_info) in zip(descs, results):
+            if exc_info is not None:
+                problem = 'unexpected error: %s' % exc_info[1]
+            if problem is not None:
+                problems.append((desc, problem))
+        return problems
+
+    def releasePlans(self, descs, multiple_heads=False,
+                     increment_major=False, read_only=False):
+        """Run planRelease() on all branch descs.
+
+        If read_only is set, their caches aren't written (see RepoCache).
+        Return the list of plans and the list of (descriptor, problem)
+        pairs, as in releaseProblems().
+        """
+        def plan(desc):
+            logger.debug("Planning release of %s", desc.local_path_rel)
+            try:
+                return desc.planRelease(multiple_heads=multiple_heads,
+                                        increment_major=increment_major,
+                                        read_only=read_only), None
+            except RepoReleaseError, e:
+                return None, str(e) or 'release check failed'
+
+        plans = []
+        problems = []
+        results = pool_map(plan, descs, jobs=self.jobs)
+        for desc, (result, exc_info) in zip(descs, results):
+            if exc_info is not None:
+                result = None, 'unexpected error: %s' % exc_info[1]
+            if result[1] is not None:
+                problems.append((desc, result[1]))
+            else:
+                plans.append(result[0])
+        return plans, problems
+
+    def localStates(self, descs, bundle_dir=None, locks=None):
+        """Return a dict (local path of clone -> state) for all clones.
+
+        States are as described in RepoDescriptor.localState(). They are
+        asked to the watcher of bundle_dir if running, otherwise computed
+        on the worker pool, holding the shared clone locks of the given
+        LockManager, if any. Descriptors without clone are ignored.
+        """
+        clones = {} # one descriptor per clone
+        for desc in descs:
+            if os.path.isdir(os.path.join(desc.local_path, '.hg')):
+                clones.setdefault(desc.local_path_rel, desc)
+
+        if bundle_dir is not None:
+            states = watcher.query(bundle_dir)
+            if states is not None and set(clones).issubset(states):
+                logger.debug("Got clone states from the watcher")
+                return dict((path, states[path]) for path in clones)
+
+        def state(path):
+            desc = clones[path]
+            if locks is None:
+                return desc.localState()
+            lock = locks.cloneLock(desc.local_path)
+            try:
+                return desc.localState()
+            finally:
+                lock.release()
+
+        paths = clones.keys()
+        results = pool_map(state, paths, jobs=self.jobs)
+        states = {}
+        for path, (state, exc_info) in zip(paths, results):
+            if exc_info is not None:
+                state = dict(error=str(exc_info[1]))
+            states[path] = state
+        return states
+
+    def cloneStatuses(self, descs, bundle_dir=None, locks=None,
+                      local_only=False):
+        """Return the list of status dicts of all descs, in the same order.
+
+        Local states (see localStates()) are completed with the tip of the
+        descriptor, and, unless local_only is set, the counts of outgoing
+        and incoming changeset subtrees, which need the network. These are
+        computed once per clone.
+        """
+        states = self.localStates(descs, bundle_dir=bundle_dir, locks=locks)
+
+        def status(desc):
+            st = dict(target=desc.target, path=desc.local_path_rel,
+                      kind=desc.__class__.__name__.lower(),
+                      included=desc.from_include)
+            state = states.get(desc.local_path_rel)
+            if state is None:
+                if isinstance(desc, Tag) and desc.isExported():
+                    st.update(node=desc.exportedNode(), exported=True,
+                              at_tip=None)
+                else:
+                    st['error'] = 'missing clone'
+                return st
+            st.update(state)
+            if 'error' in state:
+                return st
+
+            tip = hg_fullhex(desc.tip())
+            st.update(tip=tip, at_tip=tip == state['node'])
+            return st
+
+        statuses = []
+        for desc, (st, exc_info) in zip(descs, pool_map(status, descs,
+                                                        jobs=self.jobs)):
+            if exc_info is not None:
+                st = dict(target=desc.target, path=desc.local_path_rel,
+                          error=str(exc_info[1]))
+            statuses.append(st)
+        if local_only:
+            return statuses
+
+        clones = {} # one descriptor per clone
+        for desc, st in zip(descs, statuses):
+            if 'tip' in st:
+                clones.setdefault(desc.local_path_rel, desc)
+        paths = clones.keys()
+        results = pool_map(lambda path: clones[path].exchangeCounts(), paths,
+                           jobs=self.jobs)
+        counts = dict(zip(paths, results))
+
+        for i, (desc, st) in enumerate(zip(descs, statuses)):
+            if 'tip' not in st:
+                continue
+            result, exc_info = counts[desc.local_path_rel]
+            if exc_info is not None:
+                statuses[i] = dict(target=desc.target,
+                                   path=desc.local_path_rel,
+                                   error=str(exc_info[1]))
+            else:
+                st['outgoing'], st['incoming'] = result
+        return statuses
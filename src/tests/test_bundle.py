@@ -17,6 +17,7 @@
 # $Id$
 
 import os
+import time
 import logging
 import unittest
 import tests
@@ -27,9 +28,13 @@ from subprocess import call
 from StringIO import StringIO
 from mercurial import hg
 from mercurial import commands as hg_commands
+from mercurial.node import hex as hg_fullhex
+from mercurial.node import bin as hg_bin
+from common import etree
 from bundle import Server, Bundle
 from bundle import MANIFEST_FILE
 from repodescriptor import HG_UI
+import repopool
 
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(
@@ -38,6 +43,11 @@ logger = logging.getLogger('hgbundler')
 logger.addHandler(console_handler)
 logger.setLevel(logging.INFO)
 
+def write(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
 class ServerTestCase(unittest.TestCase):
 
     def xtest_dummy(self):
@@ -171,6 +181,58 @@ class BundleTestCase(unittest.TestCase):
         self.assertTrue('VERSION' in l)
         self.assertTrue('HISTORY' in l)
 
+    def test_rollback_very_first(self):
+        bundle = self.prepareBundle('bundle', 'bundle1.xml')
+        hg_init(bundle.bundle_dir)
+
+        bundle.make_clones()
+        for desc in bundle.getRepoDescriptors():
+            if desc.target == 'NeverReleased':
+                break
+
+        before = set(os.listdir(desc.local_path))
+        desc.commitRelease(desc.prepareRelease())
+        desc.rollbackRelease()
+        self.assertEquals(set(os.listdir(desc.local_path)), before)
+        self.assertFalse(desc.hasLocalChanges())
+        self.assertEquals(desc.getRepo().status(unknown=True)[4], [])
+
+    def test_pool_reservation(self):
+        bundle = self.prepareBundle('bundle', 'bundle1.xml')
+        bundle.getRepoDescriptors()
+        self.assertEquals(repopool.pool.reservations[bundle.bundle_dir], 3)
+
+    def test_clone_map(self):
+        bundle = self.prepareBundle('bundle', 'bundle1.xml')
+
+        class Desc(object):
+            def __init__(self, target, local_path):
+                self.target = target
+                self.local_path = os.path.join(bundle.bundle_dir, local_path)
+
+        descs = [Desc('a/x', 'a'), Desc('b', 'b'), Desc('a/y', 'a'),
+                 Desc('a/z', 'a')]
+        busy = set()
+        calls = []
+        def func(desc):
+            # never two calls at once on the same clone
+            self.assertFalse(desc.local_path in busy)
+            busy.add(desc.local_path)
+            time.sleep(0.01)
+            calls.append(desc.target)
+            busy.remove(desc.local_path)
+            if desc.target == 'a/y':
+                raise ValueError(desc.target)
+            return desc.target
+
+        results = bundle.cloneMap(func, descs, jobs=4)
+        self.assertEquals([r for r, _ in results], ['a/x', 'b', None, 'a/z'])
+        self.assertEquals([e and e[0] for _, e in results],
+                          [None, None, ValueError, None])
+        # in order within a clone, even after a failure
+        self.assertEquals([t for t in calls if t.startswith('a/')],
+                          ['a/x', 'a/y', 'a/z'])
+
     def test_release_abort(self):
         bundle = self.prepareBundle('bundle', 'bundle1.xml')
         path = bundle.bundle_dir
@@ -195,6 +257,111 @@ class BundleTestCase(unittest.TestCase):
                                   'BUNDLE_MANIFEST.xml']))
         bundle.clones_out()
 
+    def test_lock(self):
+        bundle = self.prepareBundle('bundle', 'with_sub.xml')
+        bundle.make_clones()
+        self.assertEquals(bundle.lock_manifest(), 0)
+
+        bundle = Bundle(self.bundle_path)
+        bundle.readLockFile()
+        for desc in bundle.getRepoDescriptors():
+            self.assertEquals(bundle.lockedNode(desc), desc.tip())
+        for desc in bundle.getSubBundles()[0]['descriptors']:
+            self.assertEquals(bundle.lockedNode(desc, included=True),
+                              desc.tip())
+
+    def prepareLocalRepo(self, name):
+        """Create a repository under the local server of local.xml."""
+        path = os.path.join(self.tmpdir, 'repos', name)
+        os.makedirs(path)
+        write(os.path.join(path, 'file'), 'initial\n')
+        hg_init(path)
+        return path
+
+    def test_lock_round_trip(self):
+        source = self.prepareLocalRepo('Comp')
+        bundle = self.prepareBundle('bundle', 'local.xml')
+        bundle.make_clones()
+        self.assertEquals(bundle.lock_manifest(), 0)
+        locked = bundle.getRepoDescriptors()[0].tip()
+
+        root = etree.parse(bundle.getLockPath()).getroot()
+        self.assertEquals(root.attrib['manifest-sha1'], bundle.manifestHash())
+        self.assertEquals([(elt.attrib['target'], elt.attrib['node'],
+                            elt.attrib.get('included')) for elt in root],
+                          [('Comp', hg_fullhex(locked), None)])
+
+        # move the branch, and make the clone again
+        write(os.path.join(source, 'file'), 'moved\n')
+        os.system('cd %s; hg ci -m moved' % source)
+        desc = bundle.getRepoDescriptors()[0]
+        rmr(desc.local_path)
+
+        bundle = Bundle(self.bundle_path)
+        bundle.make_clones(options=Options(locked=True))
+        desc = bundle.getRepoDescriptors()[0]
+        self.assertNotEquals(desc.tip(), locked)
+        self.assertEquals(desc.getRepo().dirstate.parents()[0], locked)
+
+        # without the lock file, the branch is followed
+        bundle = Bundle(self.bundle_path)
+        bundle.update_clones()
+        desc = bundle.getRepoDescriptors()[0]
+        self.assertEquals(desc.getRepo().dirstate.parents()[0], desc.tip())
+
+    def test_lock_included(self):
+        self.prepareLocalRepo('Comp')
+        bundle = self.prepareBundle('bundle', 'local.xml')
+        bundle.make_clones()
+        # same target at top level and in an included bundle
+        write(bundle.getLockPath(),
+              '<?xml version="1.0"?>\n<bundle-lock manifest-sha1="%s">\n'
+              '  <clone target="Comp" node="%s"/>\n'
+              '  <clone target="Comp" node="%s" included="true"/>\n'
+              '</bundle-lock>\n' % (bundle.manifestHash(), '1' * 40,
+                                     '2' * 40))
+
+        bundle = Bundle(self.bundle_path)
+        bundle.readLockFile()
+        desc = bundle.getRepoDescriptors()[0]
+        self.assertEquals(bundle.lockedNode(desc), hg_bin('1' * 40))
+        self.assertEquals(bundle.lockedNode(desc, included=True),
+                          hg_bin('2' * 40))
+
+    def test_sync_clones(self):
+        self.prepareLocalRepo('Comp')
+        bundle = self.prepareBundle('bundle', 'local.xml')
+        other = self.prepareBundle('other', 'local.xml')
+        for bdl in bundle, other:
+            bdl.make_clones()
+        desc = bundle.getRepoDescriptors()[0]
+        other_desc = other.getRepoDescriptors()[0]
+        self.assertEquals(other.sharedPairs(bundle), [(other_desc, desc)])
+        self.assertEquals(other.sharedPairs(bundle, targets=()), [])
+
+        def commit(desc, content):
+            write(os.path.join(desc.local_path, 'file'), content)
+            os.system('cd %s; hg ci -m "%s"' % (desc.local_path, content))
+            return desc.getRepo().changelog.tip()
+
+        node = commit(desc, 'pulled')
+        self.assertEquals(other.clones_sync_from(bundle.bundle_dir), 0)
+        self.assertTrue(node in other_desc.getRepo().changelog.nodemap)
+
+        node = commit(desc, 'pushed')
+        self.assertEquals(bundle.clones_sync_to(other.bundle_dir), 0)
+        self.assertTrue(node in other_desc.getRepo().changelog.nodemap)
+
+        # an unrelated repository can't pull
+        rmr(other_desc.local_path)
+        os.mkdir(other_desc.local_path)
+        write(os.path.join(other_desc.local_path, 'unrelated'), 'unrelated\n')
+        hg_init(other_desc.local_path)
+        failures = other.pull_clones(from_bundle=bundle, targets=None)
+        self.assertEquals([path for path, exc in failures],
+                          [other_desc.local_path])
+        self.assertEquals(other.clones_sync_from(bundle.bundle_dir), 1)
+
     def tearDown(self):
         rmr(self.tmpdir)
 
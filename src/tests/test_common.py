@@ -0,0 +1,48 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from common import pool_map
+
+class PoolMapTestCase(unittest.TestCase):
+
+    def test_order_and_failures(self):
+        def func(x):
+            if x == 3:
+                raise ValueError(x)
+            return x * 2
+
+        results = pool_map(func, range(10), jobs=4)
+        self.assertEquals([r[0] for r in results],
+                          [0, 2, 4, None, 8, 10, 12, 14, 16, 18])
+        self.assertEquals([i for i, r in enumerate(results)
+                           if r[1] is not None], [3])
+        self.assertTrue(results[3][1][0] is ValueError)
+
+    def test_empty(self):
+        self.assertEquals(pool_map(lambda x: x, ()), [])
+
+    def test_no_jobs(self):
+        self.assertRaises(ValueError, pool_map, lambda x: x, range(3), jobs=0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PoolMapTestCase))
+    return suite
@@ -0,0 +1,59 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr
+
+from diskcache import DiskCache
+
+class DiskCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_diskcache')
+        os.mkdir(self.tmpdir)
+        self.cache = DiskCache(self.tmpdir)
+
+    def test_missing(self):
+        self.assertEquals(self.cache.get(('a', 'b'), default=3), 3)
+
+    def test_bytes_preserved(self):
+        # latin-1 and utf-8 lines, as can be found in HISTORY files
+        value = (['caf\xe9', 'caf\xc3\xa9'], [], ['plain'], [])
+        self.cache.set(('url', 'node1', 'node2'), value)
+        got = self.cache.get(('url', 'node1', 'node2'))
+        self.assertEquals(got, value)
+        for line in got[0]:
+            self.assertTrue(isinstance(line, str))
+
+    def test_failed_write(self):
+        key = ('url', 'node1', 'node2')
+        self.assertRaises(ValueError, self.cache.set, key, object())
+        self.assertEquals(self.cache.get(key), None)
+        parent = os.path.dirname(self.cache.keyPath(key))
+        self.assertEquals(os.listdir(parent), [])
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DiskCacheTestCase))
+    return suite
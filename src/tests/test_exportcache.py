@@ -0,0 +1,121 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr, hg_init
+
+from mercurial import hg
+from mercurial.node import hex as hg_fullhex
+from repodescriptor import HG_UI, Tag
+from exportcache import ExportCache, MIRRORS
+
+def write(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+def read(path):
+    f = open(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class ExportCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_exportcache')
+        os.mkdir(self.tmpdir)
+
+        # the component, with a tag and a later change
+        self.url = os.path.join(self.tmpdir, 'comp')
+        os.mkdir(self.url)
+        write(os.path.join(self.url, 'file'), 'at tag\n')
+        hg_init(self.url)
+        os.system('cd %s && hg tag 1.0' % self.url)
+        self.src = hg.repository(HG_UI, self.url)
+        self.node = self.src.tags()['1.0']
+        write(os.path.join(self.url, 'file'), 'after tag\n')
+        os.system('cd %s && hg commit -m "after tag"' % self.url)
+
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.bundle_dir = os.path.join(self.tmpdir, 'bundle')
+        os.mkdir(self.bundle_dir)
+
+    def test_mirror(self):
+        cache = ExportCache(self.cache_dir)
+        repo = cache.mirror(self.url)
+        self.assertEquals(len(repo.changelog), len(self.src.changelog))
+        # pulled at most once per process
+        self.assertTrue(cache.mirror(self.url) is repo)
+        # no leftover of the atomic creation
+        self.assertEquals(os.listdir(os.path.join(self.cache_dir, MIRRORS)),
+                          [os.path.basename(cache.mirrorPath(self.url))])
+
+        # another process pulls in the existing mirror
+        os.system('cd %s && hg tag 2.0' % self.url)
+        repo = ExportCache(self.cache_dir).mirror(self.url)
+        self.assertTrue('2.0' in repo.tags())
+
+    def test_mirror_failure(self):
+        cache = ExportCache(self.cache_dir)
+        self.assertRaises(RuntimeError, cache.mirror,
+                          os.path.join(self.tmpdir, 'missing'))
+        self.assertEquals(os.listdir(os.path.join(self.cache_dir, MIRRORS)),
+                          [])
+
+    def test_export(self):
+        cache = ExportCache(self.cache_dir)
+        path = cache.export(self.url, self.node)
+        self.assertEquals(path, cache.exportPath(self.url, self.node))
+        self.assertEquals(read(os.path.join(path, 'file')), 'at tag\n')
+        self.assertFalse(os.path.exists(os.path.join(path, '.hg')))
+        self.assertEquals(cache.export(self.url, self.node), path)
+
+    def test_tag_export(self):
+        cache = ExportCache(self.cache_dir)
+        desc = Tag(self.url, self.bundle_dir, 'comp', '1.0', {})
+        self.assertFalse(desc.isExported())
+        self.assertEquals(desc.exportedNode(), None)
+
+        self.assertTrue(desc.export(cache))
+        self.assertTrue(desc.isExported())
+        self.assertEquals(desc.exportedNode(), hg_fullhex(self.node))
+        self.assertEquals(read(os.path.join(desc.local_path, 'file')),
+                          'at tag\n')
+        # already there
+        self.assertFalse(desc.export(cache))
+
+    def test_tag_export_keeps_clone(self):
+        cache = ExportCache(self.cache_dir)
+        desc = Tag(self.url, self.bundle_dir, 'comp', '1.0', {})
+        os.system('hg clone -q %s %s' % (self.url, desc.local_path))
+        self.assertFalse(desc.export(cache))
+        self.assertFalse(desc.isExported())
+        self.assertTrue(os.path.isdir(os.path.join(desc.local_path, '.hg')))
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ExportCacheTestCase))
+    return suite
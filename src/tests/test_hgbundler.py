@@ -17,6 +17,7 @@
 # $Id$
 
 import os
+import logging
 import mercurial
 
 import unittest
@@ -32,6 +33,15 @@ from repodescriptor import HG_UI
 from repodescriptor import repo_add
 from hgbundler import release_multiple_bundles
 
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
 class HgBundlerTestCase(unittest.TestCase):
     """For entry point commands"""
 
@@ -108,6 +118,67 @@ class HgBundlerTestCase(unittest.TestCase):
         for x in bdl_repo.status():
             self.assertEquals(x, [])
 
+    def test_union_mismatch(self):
+        base_path = self.prepareMultiBundle('bundles',
+                                            ('bundle1.xml', 'bundle3.xml'))
+        # ToRelease is now another branch in the second bundle
+        mf_path = os.path.join(base_path, 'bundle3', MANIFEST_FILE)
+        s = open(mf_path).read()
+        f = open(mf_path, 'w')
+        f.write(s.replace('<branch path="ToRelease" />',
+                          '<branch path="ToRelease" name="other" />'))
+        f.close()
+
+        options = tests.Options()
+        options.union = True
+        status = release_multiple_bundles(('bundle1', 'bundle3', 'TEST-MULTI'),
+                                          base_path=base_path,
+                                          options=options)
+        self.assertEquals(status, 1)
+        # nothing has been done to the bundles
+        bdl_repo = hg.repository(mercurial.ui.ui(), base_path)
+        for x in bdl_repo.status():
+            self.assertEquals(x, [])
+
+    def test_multi_release_pull_failure(self):
+        base_path = self.prepareMultiBundle('bundles',
+                                            ('bundle1.xml', 'bundle3.xml'))
+        bundles = [Bundle(os.path.join(base_path, b))
+                   for b in ('bundle1', 'bundle3')]
+        for bdl in bundles:
+            bdl.make_clones()
+
+        # ToRelease of the second bundle can't pull from the first one's
+        clone = bundles[1].getRepoDescriptorByTarget('ToRelease').local_path
+        rmr(clone)
+        os.mkdir(clone)
+        f = open(os.path.join(clone, 'unrelated'), 'w')
+        f.write("unrelated\n")
+        f.close()
+        hg_init(clone)
+        tip = hg.repository(mercurial.ui.ui(), clone).changelog.tip()
+
+        handler = RecordingHandler()
+        logger = logging.getLogger('hgbundler')
+        logger.addHandler(handler)
+        try:
+            status = release_multiple_bundles(
+                ('bundle1', 'bundle3', 'TEST-MULTI'), base_path=base_path,
+                options=tests.Options())
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(status, 1)
+        self.assertTrue("1 pull operation(s) failed:" in handler.messages)
+
+        # the second bundle hasn't been released
+        repo = hg.repository(mercurial.ui.ui(), clone)
+        self.assertEquals(repo.changelog.tip(), tip)
+        # the bundle repository has been reverted, not tagged
+        bdl_repo = hg.repository(mercurial.ui.ui(), base_path)
+        self.assertFalse('TEST-MULTI' in bdl_repo.tags())
+        for x in bdl_repo.status():
+            self.assertEquals(x, [])
+
     def tearDown(self):
         rmr(self.tmpdir)
 
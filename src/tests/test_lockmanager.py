@@ -0,0 +1,150 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr
+
+import lockmanager
+from lockmanager import LockManager, LOCKS_DIR, BUNDLE_LOCK
+from constants import ASIDE_REPOS
+from bundle import Bundle, MANIFEST_FILE
+from hgbundler import lock_bundles
+
+fcntl = lockmanager.fcntl
+
+class LockManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_lockmanager')
+        os.mkdir(self.tmpdir)
+        self.locks = LockManager(self.tmpdir)
+        self.path = os.path.join(self.locks.locks_dir, 'bundle')
+
+    def tryLock(self, exclusive):
+        """Tell if the bundle lock could be taken by another process.
+
+        flock locks of different open files of a same process conflict as
+        those of different processes would."""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            mode = exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            return True
+        finally:
+            os.close(fd)
+
+    def test_shared_creates_file(self):
+        # otherwise a writer starting later would not wait for this reader
+        if fcntl is None:
+            return
+        lock = self.locks.bundleLock()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(self.tryLock(True))
+        lock.release()
+
+    def test_read_only_bundle(self):
+        if fcntl is None or os.geteuid() == 0: # root can write anyway
+            return
+        aside = os.path.dirname(self.locks.locks_dir)
+        os.mkdir(aside)
+        os.chmod(aside, 0555)
+        try:
+            lock = self.locks.bundleLock()
+            self.assertEquals(lock.fd, None)
+            lock.release()
+            self.assertRaises(OSError, self.locks.bundleLock, exclusive=True)
+        finally:
+            os.chmod(aside, 0755)
+
+    def test_exclusive(self):
+        if fcntl is None:
+            return
+        lock = self.locks.bundleLock(exclusive=True)
+        self.assertFalse(self.tryLock(False))
+        self.assertFalse(self.tryLock(True))
+        lock.release()
+        self.assertTrue(self.tryLock(True))
+
+    def test_shared(self):
+        if fcntl is None:
+            return
+        self.locks.bundleLock(exclusive=True).release() # creates the file
+        lock = self.locks.bundleLock()
+        other = self.locks.bundleLock()
+        self.assertTrue(self.tryLock(False))
+        self.assertFalse(self.tryLock(True))
+        lock.release()
+        other.release()
+        self.assertTrue(self.tryLock(True))
+
+    def test_upgrade(self):
+        if fcntl is None:
+            return
+        lock = self.locks.bundleLock()
+        lock.upgrade()
+        self.assertFalse(self.tryLock(False))
+        lock.downgrade()
+        self.assertTrue(self.tryLock(False))
+        self.assertFalse(self.tryLock(True))
+        lock.release()
+
+    def test_clone_locks(self):
+        if fcntl is None:
+            return
+        lock = self.locks.cloneLock(os.path.join(self.tmpdir, 'a'),
+                                    exclusive=True)
+        # independent of other clones
+        other = self.locks.cloneLock(os.path.join(self.tmpdir, 'b'),
+                                     exclusive=True)
+        self.assertNotEquals(lock.path, other.path)
+        lock.release()
+        other.release()
+
+    def test_bundles_order(self):
+        bundles = []
+        for name in ('c', 'a', 'b'):
+            path = os.path.join(self.tmpdir, name)
+            os.mkdir(path)
+            f = open(os.path.join(path, MANIFEST_FILE), 'w')
+            f.write('<?xml version="1.0"?>\n<bundle/>\n')
+            f.close()
+            bundles.append(Bundle(path))
+
+        locks = lock_bundles(bundles)
+        try:
+            self.assertEquals([lock.path for lock in locks],
+                              [os.path.join(self.tmpdir, name, ASIDE_REPOS,
+                                            LOCKS_DIR, BUNDLE_LOCK)
+                               for name in ('a', 'b', 'c')])
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LockManagerTestCase))
+    return suite
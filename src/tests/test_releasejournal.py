@@ -0,0 +1,157 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr
+
+from mercurial.node import hex as hg_fullhex
+from bundle import Bundle, MANIFEST_FILE
+from repodescriptor import Branch, Tag
+from releasejournal import ReleaseJournal
+
+class Options(object):
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class FakeChangelog(object):
+
+    def __init__(self, nodes):
+        self.nodemap = dict((n, i) for i, n in enumerate(nodes))
+
+class FakeRepo(object):
+
+    def __init__(self, tags=(), nodes=()):
+        self._tags = dict((t, None) for t in tags)
+        self.changelog = FakeChangelog(nodes)
+
+    def tags(self):
+        return self._tags
+
+class FakeBranch(Branch):
+    """A branch whose repository is a FakeRepo."""
+
+    def __init__(self, target, repo, bundle_dir='/nowhere'):
+        Branch.__init__(self, 'http://hg.example/' + target, bundle_dir,
+                        target, 'default', {})
+        self.fake_repo = repo
+
+    def getRepo(self):
+        return self.fake_repo
+
+NODE = '\x01' * 20
+
+class ReleaseJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_releasejournal')
+        os.mkdir(self.tmpdir)
+        f = open(os.path.join(self.tmpdir, MANIFEST_FILE), 'w')
+        f.write('<?xml version="1.0"?>\n<bundle/>\n')
+        f.close()
+
+    def test_start_writes_nothing(self):
+        journal = ReleaseJournal(self.tmpdir)
+        journal.start('REL')
+        self.assertFalse(journal.exists())
+
+    def test_record_forget(self):
+        journal = ReleaseJournal(self.tmpdir)
+        journal.start('REL')
+        journal.record('Comp', '1.0.1', [hg_fullhex(NODE)])
+        journal.record('Caf\xc3\xa9', '2.0.0', ())
+        journal.forget('Comp')
+
+        other = ReleaseJournal(self.tmpdir)
+        self.assertEquals(other.load(), 'REL')
+        self.assertEquals(other.released(),
+                          {'Caf\xc3\xa9': dict(tag='2.0.0', nodes=[])})
+        self.assertTrue(isinstance(other.released().keys()[0], str))
+
+        other.remove()
+        self.assertFalse(journal.exists())
+
+    def test_unreadable(self):
+        journal = ReleaseJournal(self.tmpdir)
+        journal.start('REL')
+        journal.write()
+        f = open(journal.path, 'w')
+        f.write('{"release": "REL", "released": {}}')
+        f.close()
+        self.assertRaises(ValueError, journal.load)
+        self.assertEquals(Bundle(self.tmpdir).releaseJournal(
+                'REL', options=Options(resume=True)), None)
+
+    def recordRelease(self):
+        journal = ReleaseJournal(self.tmpdir)
+        journal.start('REL')
+        journal.record('Comp', '1.0.1', [hg_fullhex(NODE)])
+        return journal
+
+    def test_resume(self):
+        self.recordRelease()
+        bundle = Bundle(self.tmpdir)
+        descs = [FakeBranch('Comp', FakeRepo(tags=['1.0.1'], nodes=[NODE]),
+                            bundle_dir=self.tmpdir),
+                 FakeBranch('Other', FakeRepo(), bundle_dir=self.tmpdir)]
+
+        # without --resume, the journal blocks the release
+        self.assertEquals(bundle.releaseJournal(
+                'REL', options=Options(resume=False), descriptors=descs),
+                          None)
+        # resuming another release is refused
+        self.assertEquals(bundle.releaseJournal(
+                'OTHER', options=Options(resume=True), descriptors=descs),
+                          None)
+
+        journal, released = bundle.releaseJournal(
+            'REL', options=Options(resume=True), descriptors=descs)
+        self.assertEquals(released.keys(), ['Comp'])
+        tag = released['Comp']
+        self.assertTrue(isinstance(tag, Tag))
+        self.assertEquals(tag.name, '1.0.1')
+        self.assertEquals(journal.released().keys(), ['Comp'])
+
+    def test_resume_missing_changesets(self):
+        self.recordRelease()
+        descs = [FakeBranch('Comp', FakeRepo(tags=['1.0.1']),
+                            bundle_dir=self.tmpdir)]
+        self.assertEquals(Bundle(self.tmpdir).releaseJournal(
+                'REL', options=Options(resume=True), descriptors=descs),
+                          None)
+
+    def test_empty_journal(self):
+        # a journal without released component doesn't block
+        journal = ReleaseJournal(self.tmpdir)
+        journal.start('OLD')
+        journal.write()
+        journal, released = Bundle(self.tmpdir).releaseJournal(
+            'REL', options=Options(resume=False), descriptors=())
+        self.assertEquals(released, {})
+        self.assertEquals(journal.data['release'], 'REL')
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ReleaseJournalTestCase))
+    return suite
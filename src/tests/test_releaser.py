@@ -0,0 +1,105 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr, hg_init
+
+from repodescriptor import Branch
+from releaser import Releaser, RepoReleaseError
+
+def write(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+class ChangedSinceTagTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_releaser')
+        os.mkdir(self.tmpdir)
+        self.desc = Branch('http://hg.example/comp', self.tmpdir, 'comp',
+                           'default', {})
+        self.path = path = self.desc.local_path
+        os.mkdir(path)
+
+        # tag and reinit commits, as done by a release
+        self.write('file', 'released\n')
+        hg_init(path)
+        self.hg('tag 1.0')
+        self.write('CHANGES.tmp', 'reinit\n')
+        self.hg('add CHANGES.tmp')
+        self.hg('ci -m reinit')
+        self.tag_node = self.desc.getRepo().tags()['1.0']
+
+    def write(self, name, content):
+        write(os.path.join(self.path, name), content)
+
+    def hg(self, cmd):
+        os.system('cd %s; hg -q %s' % (self.path, cmd))
+
+    def changed(self):
+        releaser = Releaser(self.desc)
+        return releaser.changedSinceTag(self.tag_node, tag_name='1.0')
+
+    def test_unchanged(self):
+        self.assertFalse(self.changed())
+
+    def test_changed_file(self):
+        self.write('file', 'changed\n')
+        self.hg('ci -m change')
+        self.assertTrue(self.changed())
+
+    def test_modified_working_dir(self):
+        self.write('file', 'changed\n')
+        self.assertTrue(self.changed())
+
+    def test_other_branch(self):
+        # children of the tagged changeset on other branches don't count
+        self.hg('up 0')
+        self.hg('branch other')
+        self.write('file', 'other\n')
+        self.hg('ci -m other')
+        self.hg('up default')
+        self.assertFalse(self.changed())
+
+    def test_two_children(self):
+        # a second head off the tagged changeset, not an ancestor of the
+        # working directory
+        self.hg('up 0')
+        self.write('file', 'second head\n')
+        self.hg('ci -m "second head"')
+        self.hg('up 2')
+        self.assertRaises(RepoReleaseError, self.changed)
+
+    def test_two_reinit_children(self):
+        self.hg('up 1')
+        self.write('file', 'second head\n')
+        self.hg('ci -m "second head"')
+        self.hg('up 2')
+        self.assertRaises(RepoReleaseError, self.changed)
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ChangedSinceTagTestCase))
+    return suite
@@ -0,0 +1,68 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr, hg_init
+
+from mercurial import hg
+from repodescriptor import HG_UI
+from repocache import RepoCache
+
+class RepoCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_repocache')
+        os.mkdir(self.tmpdir)
+        hg_init(self.tmpdir)
+        self.repo = hg.repository(HG_UI, self.tmpdir)
+
+    def test_names_stay_bytes(self):
+        name = 'caf\xc3\xa9'
+        node = self.repo.changelog.tip()
+        RepoCache(self.repo).cachedNodes('tags', lambda: {name: node})
+
+        # a new instance reads the file
+        nodes = RepoCache(self.repo).cachedNodes('tags', lambda: {})
+        self.assertEquals(nodes, {name: node})
+        self.assertTrue(isinstance(nodes.keys()[0], str))
+
+    def test_corrupted(self):
+        f = open(self.repo.join('hgbundler-repocache'), 'wb')
+        f.write('{"validity": []}')
+        f.close()
+        self.assertEquals(RepoCache(self.repo).get('tags'), None)
+
+    def test_read_only(self):
+        node = self.repo.changelog.tip()
+        cache = RepoCache(self.repo, read_only=True)
+        nodes = cache.cachedNodes('tags', lambda: {'tip': node})
+        cache.set('clean_stat', 'signature')
+        self.assertEquals(nodes, {'tip': node})
+        self.assertEquals(cache.get('clean_stat'), 'signature')
+        self.assertFalse(os.path.exists(cache.path))
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RepoCacheTestCase))
+    return suite
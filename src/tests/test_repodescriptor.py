@@ -0,0 +1,50 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from repodescriptor import added_lines
+
+class AddedLinesTestCase(unittest.TestCase):
+
+    old = "Package: Prod 1.0.0\nFirst release\n"
+
+    def test_new_section_on_top(self):
+        new = "Package: Prod 1.1.0\n- New feature\n" + self.old
+        self.assertEquals(added_lines(self.old, new),
+                          ['Package: Prod 1.1.0', '- New feature'])
+
+    def test_from_scratch(self):
+        self.assertEquals(added_lines('', self.old),
+                          ['Package: Prod 1.0.0', 'First release'])
+
+    def test_unchanged(self):
+        self.assertEquals(added_lines(self.old, self.old), [])
+
+    def test_not_a_line_boundary(self):
+        self.assertEquals(added_lines('abc\n', 'xabc\n'), ['xabc'])
+
+    def test_edit_in_the_middle(self):
+        new = "Package: Prod 1.0.0\n- Forgotten\nFirst release\n"
+        self.assertEquals(added_lines(self.old, new), ['- Forgotten'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AddedLinesTestCase))
+    return suite
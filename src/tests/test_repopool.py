@@ -0,0 +1,134 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import time
+import threading
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr, hg_init
+
+from repodescriptor import HG_UI
+from repopool import RepoPool
+
+class RepoPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_repopool')
+        os.mkdir(self.tmpdir)
+        self.paths = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.tmpdir, name)
+            os.mkdir(path)
+            hg_init(path)
+            self.paths.append(path)
+
+    def test_reuse(self):
+        pool = RepoPool()
+        repo = pool.get(HG_UI, self.paths[0])
+        self.assertTrue(pool.get(HG_UI, self.paths[0]) is repo)
+
+    def test_lru_eviction(self):
+        pool = RepoPool(max_repos=2)
+        a = pool.get(HG_UI, self.paths[0])
+        pool.get(HG_UI, self.paths[1])
+        pool.get(HG_UI, self.paths[0]) # a is now the most recently used
+        pool.get(HG_UI, self.paths[2])
+        self.assertEquals(set([path for _, path in pool.entries]),
+                          set([self.paths[0], self.paths[2]]))
+        self.assertTrue(pool.get(HG_UI, self.paths[0]) is a)
+
+    def test_reserve(self):
+        # more clones than the initial limit, used cyclically
+        pool = RepoPool(max_repos=2)
+        pool.reserve('bundle', len(self.paths))
+        repos = [pool.get(HG_UI, path) for path in self.paths]
+        for i in range(2):
+            for path, repo in zip(self.paths, repos):
+                self.assertTrue(pool.get(HG_UI, path) is repo)
+
+        # reservations of several bundles add up
+        pool.reserve('other', 2)
+        self.assertEquals(pool.max_repos, len(self.paths) + 2)
+        pool.reserve('other', 0)
+        pool.reserve('bundle', 1)
+        self.assertEquals(pool.max_repos, 2)
+        self.assertEquals(len(pool.entries), 2)
+
+    def test_memory_budget(self):
+        pool = RepoPool(max_memory=1)
+        for path in self.paths:
+            pool.get(HG_UI, path)
+        # the most recent one is always kept
+        self.assertEquals([path for _, path in pool.entries],
+                          [self.paths[2]])
+
+    def inThread(self, func, *args):
+        result = []
+        t = threading.Thread(target=lambda: result.append(func(*args)))
+        t.start()
+        t.join()
+        return result[0]
+
+    def test_threads(self):
+        pool = RepoPool()
+        path = self.paths[0]
+        repo = pool.get(HG_UI, path)
+
+        # not shared with another running thread
+        event = threading.Event()
+        other = []
+        def work():
+            other.append(pool.get(HG_UI, path))
+            event.wait()
+        t = threading.Thread(target=work)
+        t.start()
+        while not other:
+            time.sleep(0.01)
+        self.assertFalse(other[0] is repo)
+        self.assertTrue(pool.get(HG_UI, path) is repo)
+        event.set()
+        t.join()
+
+        # handed over once the thread is finished
+        self.assertTrue(self.inThread(pool.get, HG_UI, path) is other[0])
+        # both count as one against the bound
+        pool.reserve('bundle', 1)
+        self.assertEquals(len(pool.entries), 2)
+
+    def test_changed_on_disk(self):
+        pool = RepoPool()
+        path = self.paths[0]
+        repo = pool.get(HG_UI, path)
+        length = len(repo.changelog)
+        f = open(os.path.join(path, 'file'), 'w')
+        f.write('content\n')
+        f.close()
+        os.system('cd %s; hg add file; hg ci -m "change"' % path)
+        other = pool.get(HG_UI, path)
+        self.assertFalse(other is repo)
+        self.assertEquals(len(other.changelog), length + 1)
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RepoPoolTestCase))
+    return suite
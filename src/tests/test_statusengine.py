@@ -0,0 +1,237 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr, hg_init
+
+from releaser import RepoReleaseError
+from repodescriptor import Branch
+from repodescriptor import LOCAL_CHANGES, MULTIPLE_HEADS
+from statusengine import StatusEngine
+
+def write(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+class FakeDescriptor(object):
+    """Has just what the engine needs, with canned results."""
+
+    def __init__(self, target, problem=None, error=None, local_path=None,
+                 local_path_rel=None):
+        self.target = target
+        self.local_path_rel = local_path_rel or target
+        self.local_path = local_path or os.path.join('/nowhere', target)
+        self.from_include = False
+        self.problem = problem
+        self.error = error
+        self.checked = None
+        self.exchanges = 0
+
+    def releaseCheck(self, multiple_heads=False):
+        self.checked = dict(multiple_heads=multiple_heads)
+        if self.error is not None:
+            raise self.error
+        if self.problem is not None:
+            raise RepoReleaseError(self.problem)
+
+    def planRelease(self, multiple_heads=False, increment_major=False,
+                    read_only=False):
+        self.releaseCheck(multiple_heads=multiple_heads)
+        return dict(target=self.target, increment_major=increment_major,
+                    read_only=read_only)
+
+    def localState(self):
+        if self.error is not None:
+            raise self.error
+        return dict(node='0' * 40, merge=False)
+
+    def tip(self):
+        return '\0' * 20
+
+    def exchangeCounts(self):
+        self.exchanges += 1
+        if self.target == 'offline':
+            raise IOError('no network')
+        return 1, 2
+
+class FakeReleaser(object):
+
+    def __init__(self, version_str, version_new=None, bump=None):
+        self.version_str = version_str
+        self.version_new = version_new
+        self.bump = bump
+
+class PlannedBranch(Branch):
+    """A branch whose release preparation is canned."""
+
+    def __init__(self, target, prepared):
+        Branch.__init__(self, 'http://hg.example/' + target, '/nowhere',
+                        target, 'default', {})
+        self.prepared = prepared
+
+    def releaseCheck(self, multiple_heads=False, **kw):
+        pass
+
+    def prepareRelease(self, **kw):
+        return self.prepared
+
+class StatusEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_statusengine')
+        os.mkdir(self.tmpdir)
+
+    def test_release_problems(self):
+        descs = [FakeDescriptor('ok'),
+                 FakeDescriptor('dirty', problem=LOCAL_CHANGES),
+                 FakeDescriptor('heads', problem=MULTIPLE_HEADS),
+                 FakeDescriptor('anonymous', problem=''),
+                 FakeDescriptor('broken', error=KeyError('x'))]
+        problems = StatusEngine(jobs=3).releaseProblems(descs,
+                                                        multiple_heads=True)
+        # all problems, in the order of descriptors
+        self.assertEquals([(d.target, p) for d, p in problems],
+                          [('dirty', LOCAL_CHANGES),
+                           ('heads', MULTIPLE_HEADS),
+                           ('anonymous', 'release check failed'),
+                           ('broken', "unexpected error: 'x'")])
+        for desc in descs:
+            self.assertEquals(desc.checked, dict(multiple_heads=True))
+
+    def test_release_problems_none(self):
+        descs = [FakeDescriptor('a'), FakeDescriptor('b')]
+        self.assertEquals(StatusEngine().releaseProblems(descs), [])
+
+    def test_release_plans(self):
+        descs = [FakeDescriptor('a'),
+                 FakeDescriptor('dirty', problem=LOCAL_CHANGES),
+                 FakeDescriptor('b')]
+        plans, problems = StatusEngine(jobs=2).releasePlans(
+            descs, increment_major=True, read_only=True)
+        self.assertEquals(plans, [dict(target='a', increment_major=True,
+                                       read_only=True),
+                                  dict(target='b', increment_major=True,
+                                       read_only=True)])
+        self.assertEquals([(d.target, p) for d, p in problems],
+                          [('dirty', LOCAL_CHANGES)])
+
+    def test_plan_release(self):
+        def plan(prepared):
+            return PlannedBranch('comp', prepared).planRelease()
+
+        self.assertEquals(plan(None)['action'], None)
+
+        p = plan((FakeReleaser('1.0.0', version_new=['1.0.1', '1'],
+                               bump='bugfix'), True))
+        self.assertEquals((p['action'], p['current'], p['tag'], p['bump']),
+                          ('release', '1.0.0', '1.0.1', 'bugfix'))
+        self.assertEquals(p['target'], 'comp')
+        self.assertEquals(p['branch'], 'default')
+
+        p = plan((FakeReleaser('1.0.0'), ('1.0.0', '1')))
+        self.assertEquals((p['action'], p['tag']), ('tag', '1.0.0'))
+
+        p = plan((FakeReleaser('1.0.0'), False))
+        self.assertEquals((p['action'], p['tag']), ('existing', '1.0.0'))
+
+    def test_plan_release_read_only(self):
+        desc = PlannedBranch('comp', None)
+        desc.planRelease()
+        self.assertFalse(desc.cache_read_only)
+        desc.planRelease(read_only=True)
+        self.assertTrue(desc.cache_read_only)
+
+    def test_local_states(self):
+        descs = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.join(path, '.hg'))
+            descs.append(FakeDescriptor(name, local_path=path))
+        descs[1].error = ValueError('boom')
+        # no clone for this one
+        descs.append(FakeDescriptor('missing'))
+
+        states = StatusEngine(jobs=2).localStates(descs)
+        self.assertEquals(sorted(states), ['a', 'b', 'c'])
+        self.assertEquals(states['a'], dict(node='0' * 40, merge=False))
+        self.assertEquals(states['b'], dict(error='boom'))
+
+    def test_clone_statuses(self):
+        descs = []
+        for name in ('a', 'offline'):
+            path = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.join(path, '.hg'))
+            descs.append(FakeDescriptor(name, local_path=path))
+        # subpath targets sharing the clone of 'a'
+        for name in ('a/x', 'a/y'):
+            descs.append(FakeDescriptor(name, local_path=descs[0].local_path,
+                                        local_path_rel='a'))
+        descs.append(FakeDescriptor('missing'))
+
+        engine = StatusEngine(jobs=2)
+        statuses = engine.cloneStatuses(descs)
+        self.assertEquals([st['target'] for st in statuses],
+                          ['a', 'offline', 'a/x', 'a/y', 'missing'])
+        for st in statuses[0], statuses[2], statuses[3]:
+            self.assertEquals((st['path'], st['at_tip'], st['outgoing'],
+                               st['incoming']), ('a', True, 1, 2))
+        self.assertEquals(statuses[1]['error'], 'no network')
+        self.assertEquals(statuses[4]['error'], 'missing clone')
+        # once per clone
+        self.assertEquals([d.exchanges for d in descs], [1, 1, 0, 0, 0])
+
+        statuses = engine.cloneStatuses(descs, local_only=True)
+        self.assertFalse('outgoing' in statuses[0])
+        self.assertFalse('error' in statuses[1])
+        self.assertEquals(descs[0].exchanges, 1)
+
+    def test_exchange_counts(self):
+        source = os.path.join(self.tmpdir, 'source')
+        os.mkdir(source)
+        write(os.path.join(source, 'file'), 'init\n')
+        hg_init(source)
+        bundle_dir = os.path.join(self.tmpdir, 'bundle')
+        os.mkdir(bundle_dir)
+        desc = Branch(source, bundle_dir, 'comp', 'default', {})
+        os.system('hg clone -q %s %s' % (source, desc.local_path))
+        self.assertEquals(desc.exchangeCounts(), (0, 0))
+
+        # two new subtrees in source, one changeset in the clone
+        write(os.path.join(source, 'file'), 'one\n')
+        os.system('cd %s; hg ci -q -m one; hg up -q 0' % source)
+        write(os.path.join(source, 'file'), 'two\n')
+        os.system('cd %s; hg branch -q other; hg ci -q -m two' % source)
+        write(os.path.join(desc.local_path, 'file'), 'local\n')
+        os.system('cd %s; hg ci -q -m local' % desc.local_path)
+        self.assertEquals(desc.exchangeCounts(), (1, 2))
+        self.assertEquals(desc.outgoing()[0], 1)
+        self.assertEquals(desc.incoming()[0], 2)
+        # the ui of the repository is left as it was
+        self.assertFalse(desc.getRepo().ui.quiet)
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(StatusEngineTestCase))
+    return suite
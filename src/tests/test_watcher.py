@@ -0,0 +1,116 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import threading
+import unittest
+from tests import TEST_DATA_PATH
+from tests import rmr
+
+import watcher
+from watcher import Watcher, Server, RequestHandler
+from repocache import CACHE_FILE
+
+class FakeDescriptor(object):
+    """Counts the computations of its local state."""
+
+    def __init__(self, bundle_dir, target):
+        self.local_path_rel = target
+        self.local_path = os.path.join(bundle_dir, target)
+        self.calls = 0
+        self.error = None
+
+    def localState(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return dict(node='%040d' % self.calls, merge=False)
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.join(TEST_DATA_PATH, 'tmp_watcher')
+        os.mkdir(self.tmpdir)
+        self.descs = []
+        for name in ('a', 'ab'):
+            os.makedirs(os.path.join(self.tmpdir, name, '.hg'))
+            self.descs.append(FakeDescriptor(self.tmpdir, name))
+        # no clone for this one (e.g., exported tag)
+        self.descs.append(FakeDescriptor(self.tmpdir, 'exported'))
+        self.watcher = Watcher(self.descs)
+
+    def test_refresh_stale_only(self):
+        a, ab, exported = self.descs
+        states = self.watcher.states()
+        self.assertEquals(sorted(states), ['a', 'ab'])
+        self.assertEquals((a.calls, ab.calls, exported.calls), (1, 1, 0))
+
+        self.watcher.states()
+        self.assertEquals((a.calls, ab.calls), (1, 1))
+
+        # a file in 'ab' is not in 'a', despite the common prefix
+        self.watcher.touched(os.path.join(ab.local_path, 'some_file'))
+        states = self.watcher.states()
+        self.assertEquals((a.calls, ab.calls), (1, 2))
+        self.assertEquals(states['ab']['node'], '%040d' % 2)
+
+    def test_own_writes_ignored(self):
+        a = self.descs[0]
+        self.watcher.states()
+        self.watcher.touched(os.path.join(a.local_path, '.hg', CACHE_FILE))
+        self.watcher.touched(os.path.join(a.local_path, '.hg',
+                                          CACHE_FILE + '.tmp-123'))
+        self.watcher.touched(os.path.join(self.tmpdir, 'elsewhere'))
+        self.watcher.states()
+        self.assertEquals(a.calls, 1)
+
+    def test_error(self):
+        self.descs[0].error = ValueError('boom')
+        self.assertEquals(self.watcher.states()['a'], dict(error='boom'))
+
+    def test_query(self):
+        self.assertEquals(watcher.query(self.tmpdir), None)
+
+        path = watcher.socket_path(self.tmpdir)
+        os.mkdir(os.path.dirname(path))
+        server = Server(path, RequestHandler)
+        server.watcher = self.watcher
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            self.assertEquals(watcher.query(self.tmpdir, command='ping'),
+                              'pong')
+            states = watcher.query(self.tmpdir)
+            self.assertEquals(sorted(states), ['a', 'ab'])
+            self.assertEquals(states['a']['merge'], False)
+            self.assertTrue('error' in watcher.query(self.tmpdir,
+                                                     command='foo'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(path)
+
+    def tearDown(self):
+        rmr(self.tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(WatcherTestCase))
+    return suite
@@ -0,0 +1,74 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+from StringIO import StringIO
+
+from common import etree
+from xmlwriter import write_pretty
+
+class PrettyWriterTestCase(unittest.TestCase):
+
+    def pretty(self, source, **kw):
+        out = StringIO()
+        write_pretty(etree.fromstring(source), out, **kw)
+        return out.getvalue()
+
+    def test_indentation(self):
+        self.assertEquals(self.pretty(
+                '<bundle><server url="http://hg.example"><branch path="A"/>'
+                '<tag path="B" name="1.0"/></server></bundle>'),
+                          '<?xml version="1.0"?>\n'
+                          '<bundle>\n'
+                          '  <server url="http://hg.example">\n'
+                          '    <branch path="A" />\n'
+                          '    <tag path="B"\n'
+                          '         name="1.0" />\n'
+                          '  </server>\n'
+                          '</bundle>\n')
+
+    def test_comment_and_escaping(self):
+        self.assertEquals(self.pretty(
+                '<bundle>\n  <!-- keep me -->\n'
+                '<server url="http://hg.example/?a=1&amp;b=&quot;2&quot;"/>'
+                '</bundle>'),
+                          '<?xml version="1.0"?>\n'
+                          '<bundle>\n'
+                          '  <!-- keep me -->\n'
+                          '  <server url="http://hg.example/?a=1&amp;'
+                          'b=&quot;2&quot;" />\n'
+                          '</bundle>\n')
+
+    def test_text_wrapping(self):
+        words = ' '.join(['word'] * 30)
+        self.assertEquals(self.pretty('<a><b>short</b><c>%s</c></a>' % words,
+                                      width=40),
+                          '<?xml version="1.0"?>\n'
+                          '<a>\n'
+                          '  <b>short</b>\n'
+                          '  <c>\n' +
+                          ('    ' + ' '.join(['word'] * 7) + '\n') * 4 +
+                          '    word word\n'
+                          '  </c>\n'
+                          '</a>\n')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PrettyWriterTestCase))
+    return suite
@@ -0,0 +1,197 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Watcher daemon keeping the state of the clones of a bundle in memory.
+
+Relies on inotify through the optional pyinotify library. Clients query it
+on a unix socket (see query()), and must fall back to a normal scan if it is
+not running.
+
+Protocol: the client sends a command line, the server answers in JSON and
+closes the connection. Commands:
+
+  - status: dict (local path of clone -> state, see
+            RepoDescriptor.localState())
+  - ping:   answers "pong"
+  - stop:   stops the daemon
+"""
+
+import os
+import socket
+import logging
+import threading
+import SocketServer
+
+from common import json
+from constants import ASIDE_REPOS
+from repocache import CACHE_FILE
+
+logger = logging.getLogger('hgbundler.watcher')
+
+SOCKET_FILE = 'watch.sock'
+QUERY_TIMEOUT = 5
+
+def socket_path(bundle_dir):
+    return os.path.join(os.path.abspath(bundle_dir), ASIDE_REPOS, SOCKET_FILE)
+
+def query(bundle_dir, command='status'):
+    """Send command to the watcher of bundle_dir and return its answer.
+
+    Return None if the watcher is not running."""
+    path = socket_path(bundle_dir)
+    if not os.path.exists(path):
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.settimeout(QUERY_TIMEOUT)
+            s.connect(path)
+            s.sendall(command + '\n')
+            chunks = []
+            while True:
+                data = s.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            return json.loads(''.join(chunks))
+        except (socket.error, ValueError), e:
+            logger.debug("Watcher of %s not answering: %s", bundle_dir, e)
+            return None
+    finally:
+        s.close()
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline().strip()
+        watcher = self.server.watcher
+        if command == 'status':
+            answer = watcher.states()
+        elif command == 'ping':
+            answer = 'pong'
+        elif command == 'stop':
+            answer = 'stopping'
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            answer = dict(error='unknown command %r' % command)
+        self.wfile.write(json.dumps(answer))
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class Watcher(object):
+    """Maintains the states of clones, refreshed upon inotify events."""
+
+    def __init__(self, descriptors):
+        self.descs = {} # local path -> descriptor, exported tags excluded
+        for desc in descriptors:
+            if os.path.isdir(os.path.join(desc.local_path, '.hg')):
+                self.descs.setdefault(desc.local_path, desc)
+        self.cached = {} # local path -> state
+        self.stale = set(self.descs)
+        self.lock = threading.Lock() # for the stale set
+        self.refresh_lock = threading.Lock() # one refresher at a time
+
+    def touched(self, pathname):
+        """Mark the clone containing pathname as stale."""
+        if pathname.endswith(CACHE_FILE) or '.tmp-' in pathname:
+            return # our own writes (see RepoCache)
+        for path in self.descs:
+            if pathname == path or pathname.startswith(path + os.path.sep):
+                self.lock.acquire()
+                self.stale.add(path)
+                self.lock.release()
+                return
+
+    def refresh(self, path):
+        desc = self.descs[path]
+        try:
+            state = desc.localState()
+        except Exception, e:
+            logger.error("Could not read state of %s: %s",
+                         desc.local_path_rel, e)
+            state = dict(error=str(e))
+        self.cached[path] = state
+
+    def states(self):
+        """Return the states of all clones, refreshing the stale ones."""
+        self.refresh_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                stale, self.stale = self.stale, set()
+            finally:
+                self.lock.release()
+            for path in stale:
+                logger.debug("Refreshing state of %s", path)
+                self.refresh(path)
+            return dict((self.descs[path].local_path_rel, state)
+                        for path, state in self.cached.items())
+        finally:
+            self.refresh_lock.release()
+
+    def serve(self, bundle_dir):
+        try:
+            import pyinotify
+        except ImportError:
+            logger.critical("The watch command needs pyinotify")
+            return 1
+
+        class EventHandler(pyinotify.ProcessEvent):
+            def process_default(handler, event):
+                self.touched(event.pathname)
+
+        wm = pyinotify.WatchManager()
+        mask = (pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB |
+                pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+        notifier = pyinotify.ThreadedNotifier(wm, EventHandler())
+        notifier.setDaemon(True)
+        notifier.start()
+        for path in self.descs:
+            logger.debug("Watching %s", path)
+            wm.add_watch(path, mask, rec=True, auto_add=True)
+
+        path = socket_path(bundle_dir)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.mkdir(os.path.dirname(path))
+        if os.path.exists(path):
+            if query(bundle_dir, command='ping') is not None:
+                logger.critical("A watcher is already running for %s",
+                                bundle_dir)
+                notifier.stop()
+                return 1
+            os.unlink(path) # leftover of a previous run
+
+        self.states() # initial scan
+        server = Server(path, RequestHandler)
+        server.watcher = self
+        logger.info("Watching %d clones. Listening on %s",
+                    len(self.descs), path)
+        try:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            logger.info("Stopping watcher")
+            notifier.stop()
+            server.server_close()
+            os.unlink(path)
+        return 0
@@ -0,0 +1,146 @@
+# (C) Copyright 2010 Georges Racinet <georges@racinet.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+"""Pretty printing of XML trees, for manifest files.
+
+This produces the layout of ``tidy -xml -wrap 79 --indent yes
+--indent-attributes yes --indent-spaces 2``, without the subprocess:
+one element per line, attributes after the first one aligned under it,
+text wrapped. Comments and attribute order are kept.
+Works with lxml and ElementTree trees.
+"""
+
+import textwrap
+
+def escape_text(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def escape_attr(s):
+    return escape_text(s).replace('"', '&quot;')
+
+def node_kind(elt):
+    """Return 'element', 'comment', 'pi' or None for other nodes."""
+    tag = elt.tag
+    if isinstance(tag, basestring):
+        return 'element'
+    name = getattr(tag, '__name__', '')
+    if name == 'Comment':
+        return 'comment'
+    if name in ('ProcessingInstruction', 'PI'):
+        return 'pi'
+
+class PrettyWriter(object):
+
+    def __init__(self, out, width=79, indent=2):
+        self.out = out
+        self.width = width
+        self.indent = indent
+
+    def writeLine(self, line):
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.out.write(line + '\n')
+
+    def writeText(self, text, level):
+        """Write significant text, wrapped at the given level."""
+        text = ' '.join(text.split())
+        if not text:
+            return
+        pad = ' ' * (level * self.indent)
+        for line in textwrap.wrap(escape_text(text),
+                                  width=max(self.width - len(pad), 20),
+                                  break_long_words=False):
+            self.writeLine(pad + line)
+
+    def startTag(self, elt, level):
+        """Return the lines of the start tag, still to be closed."""
+        pad = ' ' * (level * self.indent)
+        items = elt.attrib.items()
+        if not items:
+            return [pad + '<' + elt.tag]
+        align = ' ' * (len(pad) + len(elt.tag) + 2)
+        lines = ['%s<%s %s="%s"' % (pad, elt.tag, items[0][0],
+                                    escape_attr(items[0][1]))]
+        lines.extend('%s%s="%s"' % (align, name, escape_attr(value))
+                     for name, value in items[1:])
+        return lines
+
+    def writeNode(self, elt, level=0):
+        pad = ' ' * (level * self.indent)
+        kind = node_kind(elt)
+        if kind == 'comment':
+            self.writeLine('%s<!--%s-->' % (pad, elt.text or ''))
+            return
+        if kind == 'pi':
+            target = getattr(elt, 'target', None) or elt.text
+            text = getattr(elt, 'target', None) and elt.text or ''
+            self.writeLine('%s<?%s %s?>' % (pad, target, text or ''))
+            return
+        if kind is None:
+            return
+
+        lines = self.startTag(elt, level)
+        children = list(elt)
+        text = (elt.text or '').strip()
+        if not children and not text:
+            lines[-1] += ' />'
+            for line in lines:
+                self.writeLine(line)
+            return
+
+        end = '</%s>' % elt.tag
+        if not children and len(lines) == 1:
+            inline = '%s>%s%s' % (lines[0], escape_text(' '.join(
+                        text.split())), end)
+            if len(inline) <= self.width:
+                self.writeLine(inline)
+                return
+
+        lines[-1] += '>'
+        for line in lines:
+            self.writeLine(line)
+        self.writeText(text, level + 1)
+        for child in children:
+            self.writeNode(child, level + 1)
+            self.writeText(child.tail or '', level + 1)
+        self.writeLine(pad + end)
+
+    def write(self, tree):
+        """Write the whole tree (or the tree of the given root element)."""
+        getroot = getattr(tree, 'getroot', None)
+        if getroot is None:
+            root = tree
+        else:
+            root = getroot()
+
+        self.writeLine('<?xml version="1.0"?>')
+        # top level comments, as only lxml knows them
+        siblings = getattr(root, 'itersiblings', None)
+        if siblings is not None:
+            before = list(siblings(preceding=True))
+            before.reverse()
+            for node in before:
+                self.writeNode(node)
+        self.writeNode(root)
+        if siblings is not None:
+            for node in siblings():
+                self.writeNode(node)
+
+def write_pretty(tree, out, width=79, indent=2):
+    """Pretty print the XML tree or element in the out file object."""
+    PrettyWriter(out, width=width, indent=indent).write(tree)